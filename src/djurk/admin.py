@@ -1,60 +1,118 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+"""Admin of the Djurk models
+
+With the DJURK_ADMIN_MODE setting set to 'high_scale', the changelists
+are made for tables of millions of rows: related objects are joined,
+counts are estimated, large text columns are not loaded, there is no
+date hierarchy, and searches only match IDs exactly (=field) or by
+prefix (^field), case-sensitively, so that they can use indexes.
+
+The actions that poll, update or dispose of HITs queue Jobs, which the
+djurk_worker command runs; their progress is shown by JobAdmin. The
+approvals, rejections and expirations are recorded in the outbox
+(MutationAdmin) and a job sending the outbox is queued, so they reach
+Mechanical Turk as soon as a worker picks it up (or djurk_dispatch
+sends them).
+"""
+
+import operator
+
 from django.contrib import admin
 from django.contrib import messages
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList
+from django.core.paginator import InvalidPage, Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.html import escape
+
+from djurk.common import HIGH_SCALE_ADMIN, get_admin_mode
+from djurk.models import Assignment, HIT, Job, KeyValue, Mutation
+
+# Tables estimated to have fewer rows than this are counted exactly
+ESTIMATE_THRESHOLD = 100000
+# Filtered changelists count at most this many rows
+COUNT_LIMIT = 100000
+
+
+def _enqueue(request, kind, hit=None):
+    job, created = Job.objects.enqueue(kind, hit=hit,
+                                       requested_by=request.user.username)
+    if created:
+        messages.info(request, "Queued %s; djurk_worker will run it." % job)
+    else:
+        messages.info(request, "%s is already queued." % job)
 
-from djurk.models import Assignment, HIT, KeyValue
-from djurk.helpers import update_all_hits, update_reviewable_hits
+
+def _queue_mutations(request, what, recorded, selected):
+    Job.objects.enqueue(Job.DISPATCH_MUTATIONS,
+                        requested_by=request.user.username)
+    messages.info(request, "Queued %d %s; they are not made on Mechanical "
+                  "Turk until djurk_worker sends them." % (len(recorded),
+                                                           what))
+    if len(recorded) < len(selected):
+        messages.info(request, "%d were already queued." % (
+                len(selected) - len(recorded)))
 
 
 def dispose_hit(modeladmin, request, queryset):
     for hit in queryset:
-        hit.dispose()
-        messages.info(request, "Disposed data for %s." % hit)
+        _enqueue(request, Job.DISPOSE_HIT, hit)
 dispose_hit.short_description = "Dispose of HIT data from Mechanical Turk"
 
 
 def expire_hit(modeladmin, request, queryset):
-    for hit in queryset:
-        hit.expire()
-        messages.info(request, "Expired %s." % hit)
+    hits = list(queryset)
+    _queue_mutations(request, "expiration(s)",
+                     Mutation.objects.expire(hits), hits)
 expire_hit.short_description = "Expire HIT on Mechanical Turk"
 
 
 def poll_all_hits(modeladmin, request, queryset):
-    update_all_hits()
-    messages.info(request, "Poll all HITs finished.")
+    _enqueue(request, Job.POLL_ALL_HITS)
 poll_all_hits.short_description = "Poll all HITs from Mechanical Turk"
 
 
 def poll_reviewable_hits(modeladmin, request, queryset):
-    update_reviewable_hits()
-    messages.info(request, "Poll reviewable HITs finished.")
+    _enqueue(request, Job.POLL_REVIEWABLE_HITS)
 poll_reviewable_hits.short_description = "Poll reviewable HITs from MTurk"
 
 
 def update_hit(modeladmin, request, queryset):
     for hit in queryset:
-        hit.update(do_update_assignments=True)
-        messages.info(request, "Updated %s." % hit)
+        _enqueue(request, Job.UPDATE_HIT, hit)
 update_hit.short_description = "Update this HIT from Mechanical Turk"
 
 
 def approve_assignment(modeladmin, request, queryset):
-    for assignment in queryset:
-        assignment.approve()
-        messages.info(request, "Approved %s." % assignment)
+    assignments = list(queryset)
+    _queue_mutations(request, "approval(s)",
+                     Mutation.objects.approve(assignments), assignments)
 approve_assignment.short_description = "Approve assignment and pay worker"
 
 
 def reject_assignment(modeladmin, request, queryset):
-    for assignment in queryset:
-        assignment.reject()
-        messages.info(request, "Rejected %s." % assignment)
+    assignments = list(queryset)
+    _queue_mutations(request, "rejection(s)",
+                     Mutation.objects.reject(assignments), assignments)
 reject_assignment.short_description = "Reject assignment (Don't pay worker)"
 
 
+def retry_mutation(modeladmin, request, queryset):
+    failed = queryset.filter(status=Mutation.FAILED).count()
+    retried = Mutation.objects.retry(queryset)
+    messages.info(request, "%d failed mutation(s) will be sent again." %
+                  retried)
+    if retried < failed:
+        messages.warning(request, "%d bonus(es) or extension(s) were first "
+                         "sent more than a day ago, and may have been made "
+                         "already: they were not retried." % (
+                                 failed - retried))
+retry_mutation.short_description = "Send failed mutation again"
+
+
 class KeyValueInline(admin.TabularInline):
     model = KeyValue
     readonly_fields = ('key', 'value')
@@ -176,13 +234,26 @@ class AssignmentAdmin(admin.ModelAdmin):
                            'deadline',
                            ),
             }),
+            ('Answers', {
+                'fields': ('packed_answer_pairs',),
+            }),
     )
     readonly_fields = ('mturk_id', 'hit',
-                       'worker_id', 'status')
+                       'worker_id', 'status', 'packed_answer_pairs')
     inlines = [
         KeyValueInline,
     ]
 
+    def packed_answer_pairs(self, assignment):
+        """Show packed answers, which KeyValueInline has no rows for"""
+        if assignment.packed_answers is None:
+            return u"Stored as Key-Value Pairs (below)"
+        return u'<br>'.join(u'%s=%s' % (escape(pair.key),
+                                        escape(pair.short_value()))
+                            for pair in assignment.answer_pairs())
+    packed_answer_pairs.short_description = "Packed answers"
+    packed_answer_pairs.allow_tags = True
+
 
 class KeyValueAdmin(admin.ModelAdmin):
     list_display = (
@@ -191,6 +262,189 @@ class KeyValueAdmin(admin.ModelAdmin):
         'short_value',
     )
 
-admin.site.register(HIT, HIT_Admin)
-admin.site.register(Assignment, AssignmentAdmin)
-admin.site.register(KeyValue, KeyValueAdmin)
+
+class JobAdmin(admin.ModelAdmin):
+    """Progress and results of the jobs queued by the actions"""
+    list_display = (
+        'id',
+        'kind',
+        'hit',
+        'status',
+        'progress',
+        'requested_by',
+        'created',
+        'started',
+        'finished',
+    )
+    list_filter = (
+        'status',
+        'kind',
+    )
+    readonly_fields = ('kind', 'hit', 'status', 'requested_by', 'created',
+                       'started', 'finished', 'heartbeat', 'progress',
+                       'result', 'error')
+
+    def has_add_permission(self, request):
+        return False
+
+
+class MutationAdmin(admin.ModelAdmin):
+    """The outbox of changes to make on Mechanical Turk"""
+    actions = [retry_mutation]
+    list_display = (
+        'id',
+        'operation',
+        'assignment',
+        'hit',
+        'status',
+        'attempts',
+        'next_attempt',
+        'created',
+        'confirmed',
+    )
+    list_filter = (
+        'status',
+        'operation',
+    )
+    list_select_related = True
+    readonly_fields = ('operation', 'assignment', 'hit', 'parameters',
+                       'status', 'attempts', 'next_attempt', 'claimed',
+                       'confirmed', 'last_error')
+
+    def has_add_permission(self, request):
+        return False
+
+
+def estimated_row_count(model, using='default'):
+    """Return the database's estimate of the rows of model's table
+
+    Returns None if the database doesn't keep one (SQLite).
+    """
+    connection = connections[using]
+    cursor = connection.cursor()
+    table = model._meta.db_table
+    if connection.vendor == 'postgresql':
+        cursor.execute("SELECT reltuples FROM pg_class WHERE relname = %s",
+                       [table])
+    elif connection.vendor == 'mysql':
+        cursor.execute("SELECT table_rows FROM information_schema.tables "
+                       "WHERE table_schema = DATABASE() AND table_name = %s",
+                       [table])
+    else:
+        return None
+    row = cursor.fetchone()
+    if row is None or row[0] is None:
+        return None
+    return int(row[0])
+
+
+class EstimatedCountPaginator(Paginator):
+    """A Paginator of querysets that doesn't count large tables
+
+    An unfiltered queryset of a large table is counted with the
+    database's estimate, and a filtered one up to COUNT_LIMIT.
+    """
+
+    def _get_count(self):
+        if self._count is None:
+            self._count = estimated_count(self.object_list)
+        return self._count
+    count = property(_get_count)
+
+
+def estimated_count(queryset):
+    if not queryset.query.where:
+        estimate = estimated_row_count(queryset.model, queryset.db)
+        if estimate is not None and estimate >= ESTIMATE_THRESHOLD:
+            return estimate
+        return queryset.count()
+    return queryset[:COUNT_LIMIT].count()
+
+
+class HighScaleChangeList(ChangeList):
+    """A ChangeList for HighScaleAdmin"""
+
+    def get_query_set(self, request):
+        # Django's search is replaced
+        query, self.query = self.query, ''
+        try:
+            queryset = ChangeList.get_query_set(self, request)
+        finally:
+            self.query = query
+        queryset = queryset.select_related(
+                *self.model_admin.select_related_fields).defer(
+                        *self.model_admin.deferred_fields)
+
+        query = query.strip()
+        lookups = {'=': 'exact', '^': 'startswith'}
+        conditions = [Q(**{'%s__%s' % (field[1:], lookups[field[0]]): query})
+                      for field in self.search_fields if field[0] in lookups]
+        if query and conditions:
+            queryset = queryset.filter(reduce(operator.or_, conditions))
+        return queryset
+
+    def get_results(self, request):
+        paginator = self.model_admin.get_paginator(request, self.query_set,
+                                                   self.list_per_page)
+        self.result_count = paginator.count
+        if not self.query_set.query.where:
+            self.full_result_count = self.result_count
+        else:
+            self.full_result_count = estimated_count(self.root_query_set)
+        self.can_show_all = self.result_count <= self.list_max_show_all
+        self.multi_page = self.result_count > self.list_per_page
+        if (self.show_all and self.can_show_all) or not self.multi_page:
+            self.result_list = self.query_set._clone()
+        else:
+            try:
+                self.result_list = paginator.page(
+                        self.page_num + 1).object_list
+            except InvalidPage:
+                raise IncorrectLookupParameters
+        self.paginator = paginator
+
+
+class HighScaleAdmin(object):
+    """Changelists for tables of millions of rows (a ModelAdmin mixin)
+
+    select_related_fields are joined in the changelist query and
+    deferred_fields are not loaded. search_fields must be ID fields
+    prefixed with = (exact match) or ^ (prefix match).
+    """
+    paginator = EstimatedCountPaginator
+    date_hierarchy = None
+    select_related_fields = ()
+    deferred_fields = ()
+
+    def get_changelist(self, request, **kwargs):
+        return HighScaleChangeList
+
+
+class HighScaleHITAdmin(HighScaleAdmin, HIT_Admin):
+    deferred_fields = ('description', 'keywords', 'requester_annotation')
+    search_fields = ('=mturk_id', '^hit_type_id')
+
+
+class HighScaleAssignmentAdmin(HighScaleAdmin, AssignmentAdmin):
+    raw_id_fields = ('hit',)
+    select_related_fields = ('hit',)
+    deferred_fields = ('requester_feedback', 'packed_answers')
+    search_fields = ('=mturk_id', '^worker_id', '=hit__mturk_id')
+
+
+class HighScaleKeyValueAdmin(HighScaleAdmin, KeyValueAdmin):
+    raw_id_fields = ('assignment',)
+    select_related_fields = ('assignment',)
+    search_fields = ('=assignment__mturk_id', '=key')
+
+
+if get_admin_mode() == HIGH_SCALE_ADMIN:
+    admin.site.register(HIT, HighScaleHITAdmin)
+    admin.site.register(Assignment, HighScaleAssignmentAdmin)
+    admin.site.register(KeyValue, HighScaleKeyValueAdmin)
+else:
+    admin.site.register(HIT, HIT_Admin)
+    admin.site.register(Assignment, AssignmentAdmin)
+    admin.site.register(KeyValue, KeyValueAdmin)
+admin.site.register(Job, JobAdmin)
+admin.site.register(Mutation, MutationAdmin)
@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmarks of Djurk's hot paths against a seeded fake Mechanical Turk
+
+A Benchmark seeds a djurk.fake.FakeMTurk with a number of HITs,
+assignments per HIT and answers per assignment, points Djurk at it and
+runs the scenarios in SCENARIOS in order. Each scenario is measured for
+wall time, Mechanical Turk requests, database queries, rows written
+and the peak resident set size of the process. The query_plans
+scenario reports how the database runs the queries of the admin and
+of the sync, without and with the indexes of migration 0005.
+
+The scenarios write to the database, so they should only be run
+against a scratch database; the djurk_benchmark command makes a test
+database for them.
+"""
+
+import collections
+import datetime
+import time
+
+from django.contrib import admin
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.contrib.auth.models import User
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+from djurk.common import (FAKE_HOST, MAX_PAGE_SIZE, get_fake_service,
+        pooled_connection)
+from djurk.fake import DEFAULT_REVIEWABLE
+from djurk.helpers import update_all_hits, update_reviewable_hits
+from djurk.models import HIT, Assignment, KeyValue
+from djurk.stats import QueryCounter
+
+SCENARIOS = (
+    'update_all_hits',
+    'update_reviewable_hits',
+    'update_assignments',
+    'answer_ingest',
+    'admin_changelist',
+    'dispose',
+    'query_plans',
+)
+# The indexes created by migration 0005, which a database made by
+# syncdb (like the benchmark's test database) doesn't have
+INDEXES = (
+    ('djurk_hit', ('status', 'creation_time')),
+    ('djurk_hit', ('review_status', 'creation_time')),
+    ('djurk_hit', ('creation_time',)),
+    ('djurk_hit', ('hit_type_id',)),
+    ('djurk_hit', ('content_type_id', 'content_id')),
+    ('djurk_assignment', ('hit_id', 'status')),
+    ('djurk_assignment', ('status', 'submit_time')),
+    ('djurk_assignment', ('submit_time',)),
+    ('djurk_assignment', ('worker_id', 'submit_time')),
+)
+EXPLAIN = {
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+    'postgresql': 'EXPLAIN ',
+    'mysql': 'EXPLAIN ',
+}
+# Requests per second allowed by the local rate limiter; the fake
+# service needs no protection
+UNLIMITED_RATE = 1e6
+
+
+def peak_rss():
+    """Return the peak resident set size of the process, or None
+
+    This is as reported by getrusage(), in kilobytes on Linux.
+    """
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _vendor():
+    vendor = connection.vendor
+    return 'postgresql' if vendor.startswith('postgresql') else vendor
+
+
+def explain(queryset):
+    """Return the query plan of queryset, as a list of lines"""
+    sql, params = queryset.query.sql_with_params()
+    cursor = connection.cursor()
+    cursor.execute(EXPLAIN[_vendor()] + sql, params)
+    return [u' '.join(unicode(column) for column in row)
+            for row in cursor.fetchall()]
+
+
+def _index_name(table, columns):
+    return 'djurk_bench_%s_%s' % (table[len('djurk_'):], '_'.join(columns))
+
+
+def create_indexes(indexes=INDEXES):
+    """Create indexes, a sequence of (table, columns), and analyze them"""
+    quote = connection.ops.quote_name
+    cursor = connection.cursor()
+    for table, columns in indexes:
+        cursor.execute('CREATE INDEX %s ON %s (%s)' % (
+                quote(_index_name(table, columns)), quote(table),
+                ', '.join(quote(column) for column in columns)))
+    if _vendor() in ('sqlite', 'postgresql'):
+        cursor.execute('ANALYZE')
+
+
+def drop_indexes(indexes=INDEXES):
+    quote = connection.ops.quote_name
+    cursor = connection.cursor()
+    for table, columns in indexes:
+        if _vendor() == 'mysql':
+            cursor.execute('DROP INDEX %s ON %s' % (
+                    quote(_index_name(table, columns)), quote(table)))
+        else:
+            cursor.execute('DROP INDEX %s' % quote(
+                    _index_name(table, columns)))
+
+
+class Measurement(object):
+    """Measures what happens inside a with block
+
+    Queries are counted on the default database connection of the
+    current thread, which is the one Djurk writes with.
+    """
+
+    def __init__(self, service):
+        self.service = service
+        self.queries = QueryCounter()
+
+    def __enter__(self):
+        self.queries.__enter__()
+        self._requests = self.service.requests.copy()
+        self._started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wall_time = time.time() - self._started
+        self.queries.__exit__(*exc_info)
+        self.requests = self.service.requests - self._requests
+
+    def as_dict(self):
+        return {
+            'wall_time': self.wall_time,
+            'api_calls': sum(self.requests.values()),
+            'api_calls_by_operation': dict(self.requests),
+            'queries': self.queries.queries,
+            'query_time': self.queries.time,
+            'rows_written': self.queries.rows_written,
+            'peak_rss_kb': peak_rss(),
+        }
+
+
+class Benchmark(object):
+    """The scenarios, at one scale
+
+    The scenarios working on HITs one at a time (update_assignments,
+    answer_ingest and dispose) work on the Reviewable HITs, or on the
+    first sample of them. Whatever a scenario needs from the previous
+    ones is done, unmeasured, when it is run on its own.
+    """
+
+    def __init__(self, hits, assignments_per_hit=1, answer_fields=5,
+                 reviewable=DEFAULT_REVIEWABLE, latency=0.0, sample=None,
+                 rate_limit=UNLIMITED_RATE):
+        self.hits = hits
+        self.assignments_per_hit = assignments_per_hit
+        self.answer_fields = answer_fields
+        self.reviewable = reviewable
+        self.latency = latency
+        self.sample = sample
+        self.rate_limit = rate_limit
+
+    @property
+    def scale(self):
+        return {
+            'hits': self.hits,
+            'assignments_per_hit': self.assignments_per_hit,
+            'answer_fields': self.answer_fields,
+            'reviewable': self.reviewable,
+            'latency': self.latency,
+            'sample': self.sample,
+        }
+
+    def djurk_settings(self):
+        return {
+            'host': FAKE_HOST,
+            'rate_limit': self.rate_limit,
+            'fake_hits': self.hits,
+            'fake_assignments_per_hit': self.assignments_per_hit,
+            'fake_answer_fields': self.answer_fields,
+            'fake_reviewable': self.reviewable,
+            'fake_latency': self.latency,
+        }
+
+    def run(self, scenarios=SCENARIOS, callback=None):
+        """Run the scenarios, returning a list of result dictionaries
+
+        callback, if given, is called with each result as soon as its
+        scenario is done.
+        """
+        results = []
+        with override_settings(DJURK=self.djurk_settings(),
+                               DJURK_CONFIG_FILE=None):
+            service = get_fake_service()
+            for name in scenarios:
+                prepare = getattr(self, 'prepare_%s' % name, None)
+                arguments = prepare() if prepare is not None else ()
+                with Measurement(service) as measurement:
+                    details = getattr(self, 'run_%s' % name)(*arguments)
+                result = {'scenario': name, 'scale': self.scale}
+                result.update(measurement.as_dict())
+                result['details'] = details
+                if callback is not None:
+                    callback(result)
+                results.append(result)
+        return results
+
+    def _reviewable_hits(self):
+        """Return the HITs the per-HIT scenarios work on, as a queryset"""
+        hits = HIT.objects.filter(status=HIT.REVIEWABLE).order_by('pk')
+        if not hits.exists():
+            update_reviewable_hits(batch_size=MAX_PAGE_SIZE)
+        if self.sample is not None:
+            last = hits.values_list('pk', flat=True)[self.sample - 1:
+                                                     self.sample]
+            if last:
+                hits = hits.filter(pk__lte=last[0])
+        return hits
+
+    def _with_assignments(self, hits):
+        synced = set(Assignment.objects.filter(hit__in=hits).values_list(
+                'hit', flat=True).distinct())
+        for hit in hits:
+            if hit.pk not in synced:
+                hit.update_assignments()
+        return hits
+
+    def run_update_all_hits(self):
+        return update_all_hits(batch_size=MAX_PAGE_SIZE).as_dict()
+
+    def run_update_reviewable_hits(self):
+        return update_reviewable_hits(batch_size=MAX_PAGE_SIZE).as_dict()
+
+    def prepare_update_assignments(self):
+        return (list(self._reviewable_hits()),)
+
+    def run_update_assignments(self, hits):
+        counts = collections.Counter()
+        for hit in hits:
+            counts.update(hit.update_assignments())
+        counts['hits'] = len(hits)
+        return dict(counts)
+
+    def prepare_answer_ingest(self):
+        """Fetch the assignments, and forget their stored answers"""
+        hits = self._with_assignments(self._reviewable_hits())
+        remote = {}
+        with pooled_connection() as connection:
+            for hit in hits:
+                for page in range(1, self.assignments_per_hit //
+                                  MAX_PAGE_SIZE + 2):
+                    for mturk_assignment in connection.get_assignments(
+                            hit.mturk_id, page_size=MAX_PAGE_SIZE,
+                            page_number=page):
+                        remote[mturk_assignment.AssignmentId] = \
+                                mturk_assignment
+        KeyValue.objects.filter(assignment__hit__in=hits).delete()
+        Assignment.objects.filter(hit__in=hits).update(
+                mturk_fingerprint=None)
+        assignments = Assignment.objects.filter(hit__in=hits)
+        return ([(assignment, remote[assignment.mturk_id])
+                 for assignment in assignments],)
+
+    def run_answer_ingest(self, pairs):
+        for assignment, mturk_assignment in pairs:
+            assignment.update(mturk_assignment)
+        return {'assignments': len(pairs)}
+
+    def prepare_admin_changelist(self):
+        if not HIT.objects.exists():
+            update_all_hits(batch_size=MAX_PAGE_SIZE)
+        admin.autodiscover()
+        user = User(username='benchmark', is_active=True, is_staff=True,
+                    is_superuser=True)
+        return (user,)
+
+    def run_admin_changelist(self, user):
+        factory = RequestFactory()
+        sizes = {}
+        for model in (HIT, Assignment, KeyValue):
+            model_admin = admin.site._registry[model]
+            request = factory.get('/admin/djurk/%s/' %
+                                  model._meta.module_name)
+            request.user = user
+            response = model_admin.changelist_view(request)
+            response.render()
+            sizes[model._meta.module_name] = len(response.content)
+        return {'bytes': sizes}
+
+    def prepare_dispose(self):
+        hits = self._with_assignments(self._reviewable_hits())
+        return hits, list(hits)
+
+    def run_dispose(self, hits, hit_list):
+        """Approve the submitted assignments, then dispose of the HITs"""
+        approved, failed = Assignment.objects.approve(
+                Assignment.objects.filter(hit__in=hits,
+                                          status=Assignment.SUBMITTED))
+        for hit in hit_list:
+            hit.dispose()
+        return {'hits': len(hit_list), 'approved': len(approved),
+                'failed': len(failed)}
+
+    def access_paths(self):
+        """Return the queries the indexes are for, by name"""
+        hit = HIT.objects.order_by('pk')[0]
+        assignment = Assignment.objects.order_by('pk')[0]
+        since = datetime.datetime.utcnow() - datetime.timedelta(days=30)
+        return {
+            'hits_by_status': HIT.objects.filter(
+                    status=HIT.REVIEWABLE).order_by('-creation_time')[:100],
+            'hits_by_review_status': HIT.objects.filter(
+                    review_status=HIT.NOT_REVIEWED).order_by(
+                            '-creation_time')[:100],
+            'hits_by_creation_time': HIT.objects.filter(
+                    creation_time__gte=since)[:100],
+            'hits_of_type': HIT.objects.filter(hit_type_id=hit.hit_type_id),
+            'hits_attached_to': HIT.objects.filter(
+                    content_type=ContentType.objects.get_for_model(User),
+                    content_id=1),
+            'assignments_of_hit': Assignment.objects.filter(
+                    hit=hit, status=Assignment.SUBMITTED),
+            'assignments_by_status': Assignment.objects.filter(
+                    status=Assignment.SUBMITTED).order_by(
+                            'submit_time')[:100],
+            'assignments_of_worker': Assignment.objects.filter(
+                    worker_id=assignment.worker_id).order_by(
+                            '-submit_time')[:100],
+            'answer': KeyValue.objects.filter(assignment=assignment,
+                                              key='favorite_color'),
+        }
+
+    def prepare_query_plans(self):
+        self._with_assignments(self._reviewable_hits())
+        return (self.access_paths(),)
+
+    def run_query_plans(self, paths):
+        """Explain and time each query without, then with the indexes"""
+        details = dict((name, {'sql': unicode(queryset.query)})
+                       for name, queryset in paths.items())
+        if _vendor() not in EXPLAIN:
+            return details
+        for stage in ('before', 'after'):
+            if stage == 'after':
+                create_indexes()
+            for name, queryset in paths.items():
+                started = time.time()
+                list(queryset._clone())
+                details[name][stage + '_time'] = time.time() - started
+                details[name][stage] = explain(queryset)
+        drop_indexes()
+        return details
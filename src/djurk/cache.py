@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Short-lived cache of Mechanical Turk responses
+
+Refreshing a HIT after each change made to it (see HIT.dispose() or
+Assignment.approve()) means the same GetHIT and GetAssignmentsForHIT
+requests are often made several times within seconds. When the
+cache_ttl setting is set, the connections returned by
+djurk.common.get_connection() answer those from a ResponseCache shared
+by the process:
+
+ - Entries expire after ttl seconds, and no more than max_size are kept
+   (the least recently used are dropped first).
+ - Concurrent requests for the same entry are coalesced: the first one
+   goes to Mechanical Turk and the others wait for its response.
+ - Requests that change a HIT or one of its assignments invalidate the
+   HIT's entries.
+
+Cached responses are shared by every caller, so they must be treated
+as read-only.
+"""
+
+import collections
+import sys
+import threading
+import time
+
+from djurk.throttle import ThrottledMTurkConnection
+
+DEFAULT_TTL = 10  # seconds
+DEFAULT_MAX_SIZE = 1000
+# Assignments whose HIT is remembered, to invalidate it on changes
+ASSIGNMENT_INDEX_SIZE = 100000
+
+CACHED_REQUESTS = ('GetHIT', 'GetAssignmentsForHIT')
+HIT_MUTATIONS = ('DisableHIT', 'DisposeHIT', 'ExtendHIT', 'ForceExpireHIT',
+                 'SetHITAsReviewing')
+ASSIGNMENT_MUTATIONS = ('ApproveAssignment', 'GrantBonus', 'RejectAssignment')
+
+
+class _Call(object):
+    """A request in flight, which other callers can wait for"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.invalidated = False
+        self.result = None
+        self.exc_info = None
+
+    def wait(self):
+        self.done.wait()
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+
+class ResponseCache(object):
+    """Thread-safe TTL and LRU cache of responses, grouped by HIT ID"""
+
+    def __init__(self, ttl=DEFAULT_TTL, max_size=DEFAULT_MAX_SIZE,
+                 clock=time.time):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.clock = clock
+        self._lock = threading.Lock()
+        # key -> (expiry time, HIT ID, response), least recently used first
+        self._entries = collections.OrderedDict()
+        self._in_flight = {}
+        self._assignment_hits = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, key, hit_id, function):
+        """Return the cached response for key, or call function for it
+
+        hit_id is the HIT the response describes, to invalidate it with.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[0] > self.clock():
+                self._entries[key] = entry
+                self.hits += 1
+                return entry[2]
+            call = self._in_flight.get(key)
+            leader = call is None
+            if leader:
+                self.misses += 1
+                call = self._in_flight[key] = _Call()
+            else:
+                self.coalesced += 1
+        if not leader:
+            return call.wait()
+
+        try:
+            call.result = function()
+        except BaseException:
+            call.exc_info = sys.exc_info()
+        with self._lock:
+            if self._in_flight.get(key) is call:
+                del self._in_flight[key]
+            if call.exc_info is None and not call.invalidated:
+                self._store(key, hit_id, call.result)
+        call.done.set()
+        return call.wait()
+
+    def _store(self, key, hit_id, response):
+        self._entries[key] = (self.clock() + self.ttl, hit_id, response)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        for item in response:
+            assignment_id = getattr(item, 'AssignmentId', None)
+            if assignment_id is not None:
+                self._assignment_hits.pop(assignment_id, None)
+                self._assignment_hits[assignment_id] = hit_id
+        while len(self._assignment_hits) > ASSIGNMENT_INDEX_SIZE:
+            self._assignment_hits.popitem(last=False)
+
+    def invalidate(self, hit_id):
+        """Drop the responses about a HIT, including those in flight"""
+        with self._lock:
+            for key, entry in self._entries.items():
+                if entry[1] == hit_id:
+                    del self._entries[key]
+            for key, call in self._in_flight.items():
+                if key[1] == hit_id:
+                    call.invalidated = True
+                    del self._in_flight[key]
+
+    def invalidate_assignment(self, assignment_id):
+        """Drop the responses about an assignment's HIT
+
+        If the HIT is not known, everything is dropped.
+        """
+        with self._lock:
+            hit_id = self._assignment_hits.get(assignment_id)
+        if hit_id is None:
+            self.clear()
+        else:
+            self.invalidate(hit_id)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            for call in self._in_flight.values():
+                call.invalidated = True
+            self._in_flight.clear()
+
+    def status(self):
+        """Return the size of the cache and its counters as a dictionary"""
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+            }
+
+
+class CachedMTurkConnection(ThrottledMTurkConnection):
+    """A ThrottledMTurkConnection that answers from a ResponseCache
+
+    Only GetHIT and GetAssignmentsForHIT responses are cached; cached
+    responses do not count against the rate limit.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.response_cache = kwargs.pop('response_cache', None)
+        ThrottledMTurkConnection.__init__(self, *args, **kwargs)
+
+    def _process_request(self, request_type, params, marker_elems=None):
+        request = lambda: ThrottledMTurkConnection._process_request(
+                self, request_type, params, marker_elems)
+        cache = self.response_cache
+        if cache is None:
+            return request()
+        if request_type in CACHED_REQUESTS:
+            key = (request_type, params['HITId'],
+                   tuple(sorted(params.items())))
+            return cache.get(key, params['HITId'], request)
+        try:
+            return request()
+        finally:
+            # Whether or not the change was made, cached data may be stale
+            if request_type in HIT_MUTATIONS:
+                cache.invalidate(params['HITId'])
+            elif request_type in ASSIGNMENT_MUTATIONS:
+                cache.invalidate_assignment(params['AssignmentId'])
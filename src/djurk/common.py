@@ -1,17 +1,46 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import collections
 import ConfigParser
 import datetime
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
-from boto.mturk.connection import MTurkConnection
 from django.conf import settings
+try:
+    from django.test.signals import setting_changed
+except ImportError:
+    # Django < 1.4 has no setting_changed signal
+    setting_changed = None
+
+from djurk.cache import (DEFAULT_MAX_SIZE, CachedMTurkConnection,
+        ResponseCache)
+from djurk.metrics import connect_receivers
+from djurk.fake import (DEFAULT_ANSWER_FIELDS, DEFAULT_ASSIGNMENTS_PER_HIT,
+        DEFAULT_REVIEWABLE, FakeMTurk, FakeMTurkConnection)
+from djurk.throttle import DEFAULT_MAX_RETRIES, DEFAULT_RATE, TokenBucket
 
 
 PRODUCTION_HOST = u'mechanicalturk.amazonaws.com'
 PRODUCTION_WORKER_URL = u'https://www.mturk.com'
 SANDBOX_HOST = u'mechanicalturk.sandbox.amazonaws.com'
 SANDBOX_WORKER_URL = u'https://workersandbox.mturk.com'
+FAKE_HOST = u'fake'  # Answered in-process by djurk.fake.FakeMTurk
+DEFAULT_POOL_SIZE = 10
+CONFIG_CHECK_INTERVAL = 1  # seconds between config file mtime checks
+MAX_PAGE_SIZE = 100  # Largest PageSize Mechanical Turk accepts
+DEFAULT_FETCH_WORKERS = 4
+# How the answers of assignments are stored (the DJURK_ANSWER_STORAGE
+# setting): one KeyValue row per answer, or packed in one column of the
+# assignment
+KEYVALUE_ANSWERS, PACKED_ANSWERS = 'keyvalue', 'packed'
+# Admin classes registered by djurk.admin (the DJURK_ADMIN_MODE setting)
+DEFAULT_ADMIN, HIGH_SCALE_ADMIN = 'default', 'high_scale'
 
 
 class InvalidDjurkSettings(Exception):
@@ -24,6 +53,31 @@ class InvalidDjurkSettings(Exception):
     __str__ = __unicode__
 
 
+def get_answer_storage():
+    """Return how answers are stored, from DJURK_ANSWER_STORAGE
+
+    This is a plain Django setting, so it is read without the connection
+    settings (DJURK or DJURK_CONFIG_FILE).
+    """
+    storage = getattr(settings, 'DJURK_ANSWER_STORAGE', KEYVALUE_ANSWERS)
+    if storage not in (KEYVALUE_ANSWERS, PACKED_ANSWERS):
+        raise InvalidDjurkSettings("Unknown DJURK_ANSWER_STORAGE %s"
+                                   % storage)
+    return storage
+
+
+def get_admin_mode():
+    """Return the admin classes to register, from DJURK_ADMIN_MODE
+
+    djurk.admin reads this when it is imported, so like
+    get_answer_storage() it doesn't need the connection settings.
+    """
+    mode = getattr(settings, 'DJURK_ADMIN_MODE', DEFAULT_ADMIN)
+    if mode not in (DEFAULT_ADMIN, HIGH_SCALE_ADMIN):
+        raise InvalidDjurkSettings("Unknown DJURK_ADMIN_MODE %s" % mode)
+    return mode
+
+
 def amazon_string_to_datetime(amazon_string):
     """Return datetime from passed Amazon format datestring"""
 
@@ -33,6 +87,135 @@ def amazon_string_to_datetime(amazon_string):
             amazon_iso_format)
 
 
+class DjurkConfig(object):
+    """Connection settings resolved from DJURK or DJURK_CONFIG_FILE
+
+    Resolving the settings means reading and parsing the configuration
+    file, so this is done once and the result is cached by get_config().
+    The options are kept as found; missing options are only reported
+    (with the same exceptions the settings dictionary or ConfigParser
+    would raise) when they are asked for.
+    """
+    _missing = object()
+
+    def __init__(self, options=None, config_file=None):
+        self.options = options
+        self.config_file = config_file
+        self.file_stamp = _file_stamp(config_file)
+        self.checked_at = time.time()
+        # Made by get_rate_limiter(), get_response_cache() and
+        # get_fake_service() when first needed
+        self.rate_limiter = None
+        self.response_cache = None
+        self.fake_service = None
+
+    @classmethod
+    def from_settings(cls):
+        """Resolve configuration from the current Django settings"""
+
+        if getattr(settings, 'DJURK', None) is not None:
+            return cls(options=dict(settings.DJURK))
+        config_file = getattr(settings, 'DJURK_CONFIG_FILE', None)
+        if config_file is not None:
+            config = ConfigParser.ConfigParser()
+            config.read(config_file)
+            options = {}
+            if config.has_section('Connection'):
+                options = dict(config.items('Connection'))
+            return cls(options=options, config_file=config_file)
+        return cls()
+
+    @property
+    def found(self):
+        """Return True if either DJURK or DJURK_CONFIG_FILE is set"""
+        return self.options is not None
+
+    def get(self, option, default=_missing):
+        """Return option, raising like the settings source if missing"""
+
+        if self.options is None:
+            raise InvalidDjurkSettings("Djurk settings not found")
+        if option in self.options:
+            return self.options[option]
+        if default is not self._missing:
+            return default
+        if self.config_file is not None:
+            raise ConfigParser.NoOptionError(option, 'Connection')
+        raise KeyError(option)
+
+    @property
+    def host(self):
+        host = (self.options or {}).get('host', PRODUCTION_HOST)
+
+        if host.startswith('http://'):
+            host = host.replace('http://', '', 1)
+
+        if host.startswith('https://'):
+            host = host.replace('https://', '', 1)
+
+        return host
+
+    def is_stale(self):
+        """Return True if the configuration file changed on disk
+
+        The file is only looked at once every CONFIG_CHECK_INTERVAL
+        seconds so that frequent callers don't pay for a stat() each.
+        """
+        if self.config_file is None:
+            return False
+        now = time.time()
+        if now - self.checked_at < CONFIG_CHECK_INTERVAL:
+            return False
+        self.checked_at = now
+        return _file_stamp(self.config_file) != self.file_stamp
+
+
+def _file_stamp(filename):
+    if filename is None:
+        return None
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size)
+
+
+_config = None
+_config_lock = threading.Lock()
+
+
+def get_config():
+    """Return the cached DjurkConfig, resolving it first if needed"""
+
+    global _config
+    config = _config
+    if config is None or config.is_stale():
+        with _config_lock:
+            if _config is config:
+                if config is not None:
+                    connection_pool.clear()
+                _config = DjurkConfig.from_settings()
+            config = _config
+    return config
+
+
+def invalidate_config(**kwargs):
+    """Forget the cached configuration and the connections made with it
+
+    This is connected to Django's setting_changed signal, which is sent
+    by override_settings, so it accepts (and ignores) signal arguments.
+    """
+    global _config
+    with _config_lock:
+        _config = None
+    connection_pool.clear()
+
+
+if setting_changed is not None:
+    setting_changed.connect(invalidate_config,
+                            dispatch_uid='djurk.common.invalidate_config')
+
+
 def get_host():
     """Read configuration file and get proper host
 
@@ -41,26 +224,12 @@ def get_host():
     parameter is optional, if it is omitted, the PRODUCTION_HOST is
     returned. Therefore, to use the sandbox, one has to explicitly set
     the host parameter to 'mechanicalturk.sandbox.amazonaws.com' in
-    either the DJURK or DJURK_CONFIG_FILE parmeters/files.
+    either the DJURK or DJURK_CONFIG_FILE parmeters/files. The host
+    'fake' (FAKE_HOST) is also accepted; see get_fake_service().
     """
-    host = PRODUCTION_HOST
-    if hasattr(settings, 'DJURK') and settings.DJURK is not None:
-        if 'host' in settings.DJURK:
-            host = settings.DJURK['host']
-    elif hasattr(settings, 'DJURK_CONFIG_FILE') and\
-                          settings.DJURK_CONFIG_FILE is not None:
-        config = ConfigParser.ConfigParser()
-        config.read(settings.DJURK_CONFIG_FILE)
-        if config.has_option('Connection', 'host'):
-            host = config.get('Connection', 'host')
+    host = get_config().host
 
-    if host.startswith('http://'):
-        host = host.replace('http://', '', 1)
-
-    if host.startswith('https://'):
-        host = host.replace('https://', '', 1)
-
-    assert host in [SANDBOX_HOST, PRODUCTION_HOST]
+    assert host in [SANDBOX_HOST, PRODUCTION_HOST, FAKE_HOST]
 
     return host
 
@@ -124,32 +293,243 @@ def get_connection():
     aws_secret_access_key: 'g8Xw/sCOLY5WYtS091kcVdy0cMUZgdSdS'
     host: 'mechanicalturk.amazonaws.com'
     debug: 1
+
+    All requests made with the connection are rate limited by the
+    TokenBucket returned by get_rate_limiter(), which is configured by
+    the optional rate_limit, rate_limit_burst, rate_limit_file and
+    max_retries parameters. If the cache_ttl parameter is set, GetHIT
+    and GetAssignmentsForHIT responses are cached by the ResponseCache
+    returned by get_response_cache().
+
+    If the host is 'fake', the connection talks to the in-process
+    FakeMTurk returned by get_fake_service() instead, and the
+    credentials are not needed.
     """
 
     host = get_host()
-    debug = 1
-
-    if hasattr(settings, 'DJURK') and settings.DJURK is not None:
-        aws_access_key_id = settings.DJURK['aws_access_key_id']
-        aws_secret_access_key = settings.DJURK['aws_secret_access_key']
-        if 'debug' in settings.DJURK:
-            debug = settings.DJURK['debug']
-    elif hasattr(settings, 'DJURK_CONFIG_FILE') and\
-                          settings.DJURK_CONFIG_FILE is not None:
-        config = ConfigParser.ConfigParser()
-        config.read(settings.DJURK_CONFIG_FILE)
-
-        aws_access_key_id = config.get('Connection',
-                                       'aws_access_key_id')
-        aws_secret_access_key = config.get('Connection',
-                                           'aws_secret_access_key')
-        if config.has_option('Connection', 'debug'):
-            debug = config.get('Connection', 'debug')
-    else:
-        raise InvalidDjurkSettings("Djurk settings not found")
-
-    return MTurkConnection(
-        aws_access_key_id=aws_access_key_id,
-        aws_secret_access_key=aws_secret_access_key,
+    config = get_config()
+    options = dict(
         host=host,
-        debug=debug)
+        debug=config.get('debug', 1),
+        rate_limiter=get_rate_limiter(),
+        response_cache=get_response_cache(),
+        max_retries=int(config.get('max_retries', DEFAULT_MAX_RETRIES)))
+
+    if host == FAKE_HOST:
+        return FakeMTurkConnection(service=get_fake_service(), **options)
+    return CachedMTurkConnection(
+        aws_access_key_id=config.get('aws_access_key_id'),
+        aws_secret_access_key=config.get('aws_secret_access_key'),
+        **options)
+
+
+def get_rate_limiter():
+    """Return the TokenBucket shared by all connections of the process
+
+    rate_limit is the number of requests per second, and
+    rate_limit_burst the number of requests that may be made at once
+    after a quiet period. If rate_limit_file is set, the bucket is kept
+    in that file and shared by every process that uses it. A new
+    bucket is made when the configuration changes.
+    """
+    config = get_config()
+    with _config_lock:
+        if config.rate_limiter is None:
+            burst = config.get('rate_limit_burst', None)
+            config.rate_limiter = TokenBucket(
+                    rate=float(config.get('rate_limit', DEFAULT_RATE)),
+                    burst=burst and float(burst),
+                    path=config.get('rate_limit_file', None))
+        return config.rate_limiter
+
+
+def get_response_cache():
+    """Return the ResponseCache shared by all connections of the process
+
+    Caching is off (None is returned) unless the cache_ttl option is
+    set: responses are then kept for cache_ttl seconds, and at most
+    cache_size of them are kept. Cached responses can be up to cache_ttl
+    seconds behind changes made on Mechanical Turk by other processes.
+    A new cache is made when the configuration changes.
+    """
+    config = get_config()
+    ttl = float(config.get('cache_ttl', 0))
+    if not ttl:
+        return None
+    with _config_lock:
+        if config.response_cache is None:
+            config.response_cache = ResponseCache(
+                    ttl=ttl,
+                    max_size=int(config.get('cache_size', DEFAULT_MAX_SIZE)))
+        return config.response_cache
+
+
+def get_fake_service():
+    """Return the FakeMTurk answering the 'fake' host in this process
+
+    It is configured by the optional fake_hits (the number of seeded
+    HITs), fake_assignments_per_hit, fake_answer_fields (answers per
+    assignment), fake_reviewable (the fraction of seeded HITs that are
+    Reviewable), fake_latency (seconds per request), fake_rate_limit
+    (requests per second), fake_throttle_rate and fake_error_rate
+    (fractions of requests refused) and fake_seed parameters. A new,
+    freshly seeded service is made when the configuration changes.
+    """
+    config = get_config()
+    with _config_lock:
+        if config.fake_service is None:
+            rate_limit = config.get('fake_rate_limit', None)
+            seed = config.get('fake_seed', None)
+            config.fake_service = FakeMTurk(
+                    hits=int(config.get('fake_hits', 0)),
+                    assignments_per_hit=int(config.get(
+                            'fake_assignments_per_hit',
+                            DEFAULT_ASSIGNMENTS_PER_HIT)),
+                    answer_fields=int(config.get('fake_answer_fields',
+                                                 DEFAULT_ANSWER_FIELDS)),
+                    reviewable=float(config.get('fake_reviewable',
+                                                DEFAULT_REVIEWABLE)),
+                    latency=float(config.get('fake_latency', 0)),
+                    rate_limit=rate_limit and float(rate_limit),
+                    throttle_rate=float(config.get('fake_throttle_rate', 0)),
+                    error_rate=float(config.get('fake_error_rate', 0)),
+                    seed=seed and int(seed))
+        return config.fake_service
+
+
+class ConnectionPool(object):
+    """Thread-safe pool of Mechanical Turk connections
+
+    Connections are created lazily, the first time one is checked out,
+    and are handed back to the pool when the caller is done with them.
+    Because boto keeps its HTTP connections alive between requests,
+    reusing a connection object also reuses the underlying HTTP
+    session. No more than max_size connections are checked out at
+    once; additional callers block until a connection is returned.
+
+    Connections are created with get_connection() unless another
+    factory is given. Creating one connects the receivers collecting
+    the process's metrics (see djurk.metrics.connect_receivers()).
+    """
+
+    def __init__(self, max_size=DEFAULT_POOL_SIZE, factory=None):
+        self.max_size = max_size
+        self.factory = factory
+        self._idle = []
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+
+    def _create(self):
+        connect_receivers()
+        if self.factory is not None:
+            return self.factory()
+        return get_connection()
+
+    def checkout(self):
+        """Return an idle connection, creating one if none is idle"""
+
+        self._slots.acquire()
+        try:
+            with self._lock:
+                generation = self._generation
+                if self._idle:
+                    return self._idle.pop()
+            connection = self._create()
+            connection._djurk_pool_generation = generation
+            return connection
+        except:
+            self._slots.release()
+            raise
+
+    def checkin(self, connection):
+        """Return a connection obtained from checkout() to the pool
+
+        Connections created before the last call to clear() are closed
+        instead of being reused.
+        """
+        try:
+            with self._lock:
+                if getattr(connection, '_djurk_pool_generation',
+                           None) == self._generation:
+                    self._idle.append(connection)
+                    connection = None
+            if connection is not None:
+                connection.close()
+        finally:
+            self._slots.release()
+
+    def clear(self):
+        """Close idle connections and retire the ones checked out
+
+        This is needed when the connection settings change, or in a
+        child process that must not share sockets with its parent.
+        """
+        with self._lock:
+            self._generation += 1
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection for the duration of a with block"""
+
+        connection = self.checkout()
+        try:
+            yield connection
+        finally:
+            self.checkin(connection)
+
+
+connection_pool = ConnectionPool()
+
+
+def pooled_connection():
+    """Borrow a connection from the process-wide connection pool
+
+    This is meant to be used as a context manager around the calls
+    that actually talk to Mechanical Turk:
+
+    with pooled_connection() as connection:
+        connection.expire_hit(hit_id)
+    """
+    return connection_pool.connection()
+
+
+def iter_pages(fetch_page, page_size=MAX_PAGE_SIZE,
+               workers=DEFAULT_FETCH_WORKERS):
+    """Yield every page of a paged Mechanical Turk listing, in order
+
+    fetch_page(page_number, page_size) should return one page as a Boto
+    ResultSet. The first page is fetched on its own to learn
+    TotalNumResults; the remaining pages are then fetched concurrently
+    by up to workers threads. No more than workers pages are fetched
+    ahead of the caller, which keeps memory bounded however many pages
+    there are.
+    """
+    first = fetch_page(1, page_size)
+    yield first
+
+    total = int(getattr(first, 'TotalNumResults', 0))
+    page_count = (total + page_size - 1) // page_size
+    page_numbers = iter(xrange(2, page_count + 1))
+    workers = min(workers, page_count - 1)
+    if workers <= 1:
+        for page_number in page_numbers:
+            yield fetch_page(page_number, page_size)
+        return
+
+    pool = ThreadPool(workers)
+    try:
+        window = collections.deque(
+                pool.apply_async(fetch_page, (page_number, page_size))
+                for page_number in itertools.islice(page_numbers, workers))
+        while window:
+            page = window.popleft().get()
+            for page_number in itertools.islice(page_numbers, 1):
+                window.append(pool.apply_async(fetch_page,
+                                               (page_number, page_size)))
+            yield page
+    finally:
+        pool.terminate()
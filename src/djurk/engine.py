@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Pipelined synchronization engine
+
+The helpers in djurk.helpers alternate between waiting for Mechanical
+Turk and writing to the database. The PipelinedSync engine overlaps the
+two: a pool of fetcher threads issues the SearchHITs, GetReviewableHITs,
+GetHIT and GetAssignmentsForHIT requests, and the thread that runs the
+engine does nothing but write the parsed results to the database as
+they arrive. The end result is the same as that of
+update_all_hits(do_update_assignments=True).
+"""
+
+import functools
+import logging
+import Queue
+import threading
+from multiprocessing.pool import ThreadPool
+
+from django.db import transaction
+
+from djurk.common import (MAX_PAGE_SIZE, get_config, iter_pages,
+        pooled_connection)
+from djurk.helpers import ALL_HITS, REVIEWABLE_HITS
+from djurk.models import HIT, Assignment
+from djurk.signals import sync_finished
+from djurk.stats import SyncStats
+
+DEFAULT_CONCURRENCY = 8
+# Pages of results that may wait for the database writer
+DEFAULT_QUEUE_SIZE = 32
+
+logger = logging.getLogger(__name__)
+
+_account_semaphores = {}
+_account_semaphores_lock = threading.Lock()
+
+
+def account_semaphore(concurrency=DEFAULT_CONCURRENCY):
+    """Return the semaphore bounding requests for the current account
+
+    All engines in this process that use the same AWS access key share
+    one semaphore, so concurrency is bounded per account rather than
+    per engine. The first caller for an account decides the bound.
+    """
+    account = get_config().get('aws_access_key_id', None)
+    with _account_semaphores_lock:
+        if account not in _account_semaphores:
+            _account_semaphores[account] = threading.BoundedSemaphore(
+                    concurrency)
+        return _account_semaphores[account]
+
+
+class PipelinedSync(object):
+    """Synchronize HITs, and optionally assignments, with overlapped I/O
+
+    Fetcher threads put pages of Boto objects on a bounded queue, which
+    the thread calling run() drains into the database with the bulk
+    sync_from_mturk() manager methods. The queue bound keeps memory
+    constant; when the database falls behind, the fetchers wait.
+    """
+
+    def __init__(self, source=ALL_HITS, do_update_assignments=True,
+                 concurrency=DEFAULT_CONCURRENCY,
+                 queue_size=DEFAULT_QUEUE_SIZE):
+        assert source in (ALL_HITS, REVIEWABLE_HITS)
+        self.source = source
+        self.do_update_assignments = do_update_assignments
+        self.concurrency = concurrency
+        self.queue = Queue.Queue(queue_size)
+        self.semaphore = account_semaphore(concurrency)
+        self.stopped = threading.Event()
+
+    def put(self, message):
+        """Queue a message for the writer, unless the writer gave up"""
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(message, timeout=1)
+                return
+            except Queue.Full:
+                pass
+
+    def request(self, method, *args, **kwargs):
+        """Call a Boto connection method within the account's bound"""
+        with self.semaphore:
+            with pooled_connection() as connection:
+                return getattr(connection, method)(*args, **kwargs)
+
+    def fetch_hit_page(self, page_number, page_size):
+        if self.source == REVIEWABLE_HITS:
+            page = self.request('get_reviewable_hits', page_size=page_size,
+                                page_number=page_number)
+            # GetReviewableHITs only returns HIT IDs
+            details = [self.request('get_hit', mturk_hit.HITId)[0]
+                       for mturk_hit in page]
+            page[:] = details
+            return page
+        return self.request('search_hits', page_size=page_size,
+                            page_number=page_number)
+
+    def fetch_assignment_page(self, mturk_id, page_number, page_size):
+        return self.request('get_assignments', mturk_id,
+                            page_size=page_size, page_number=page_number)
+
+    def fetch_assignments(self, mturk_id):
+        """Fetch every page of a HIT's assignments (in a fetcher thread)"""
+        if self.stopped.is_set():
+            return
+        try:
+            fetch_page = functools.partial(self.fetch_assignment_page,
+                                           mturk_id)
+            for page in iter_pages(fetch_page, page_size=MAX_PAGE_SIZE,
+                                   workers=1):
+                self.put(('assignments', mturk_id, page))
+        except Exception:
+            logger.exception("Fetching assignments of HIT %s failed",
+                             mturk_id)
+            self.put(('error', mturk_id, None))
+        self.put(('done', mturk_id, None))
+
+    def list_hits(self, pool):
+        """Fetch the HIT listing and queue assignment fetches
+
+        This runs in its own thread. A HIT page is always queued before
+        the fetches of its assignments are started, so the writer has
+        stored a HIT before any of its assignments arrive. When
+        everything has been fetched, None is queued.
+        """
+        try:
+            for page in iter_pages(self.fetch_hit_page,
+                                   page_size=MAX_PAGE_SIZE,
+                                   workers=self.concurrency):
+                if self.stopped.is_set():
+                    # The writer failed: fetching the rest is wasted
+                    break
+                self.put(('hits', None, page))
+                if self.do_update_assignments:
+                    for mturk_hit in page:
+                        pool.apply_async(self.fetch_assignments,
+                                         (mturk_hit.HITId,))
+        except Exception:
+            logger.exception("Fetching %s HITs failed", self.source)
+            self.put(('error', None, None))
+        finally:
+            pool.close()
+            pool.join()
+            self.put(None)
+
+    def write(self, kind, mturk_id, page, hits, stats):
+        if kind == 'hits':
+            stats.count('hits', HIT.objects.sync_from_mturk(page))
+            if self.do_update_assignments:
+                mturk_ids = [mturk_hit.HITId for mturk_hit in page]
+                hits.update((hit.mturk_id, hit) for hit in
+                            HIT.objects.filter(mturk_id__in=mturk_ids))
+        else:
+            stats.count('assignments', Assignment.objects.sync_from_mturk(
+                    hits[mturk_id], page))
+
+    def run(self):
+        """Run the engine, writing results in this thread
+
+        Returns a SyncStats object describing the cycle, which is also
+        sent with the djurk.signals.sync_finished signal.
+        """
+        stats = SyncStats()
+        with stats.instrument():
+            self._write_results(stats)
+        stats.finish()
+        sync_finished.send(sender=self.__class__, source=self.source,
+                           stats=stats)
+        return stats
+
+    def _write_results(self, stats):
+        pool = ThreadPool(self.concurrency)
+        lister = threading.Thread(target=self.list_hits, args=(pool,))
+        lister.daemon = True
+        lister.start()
+
+        # HITs whose assignments are still being fetched
+        hits = {}
+        try:
+            for kind, mturk_id, page in iter(self.queue.get, None):
+                if kind == 'error':
+                    stats.errors += 1
+                elif kind == 'done':
+                    hits.pop(mturk_id, None)
+                else:
+                    stats.pages += 1
+                    with transaction.commit_on_success():
+                        self.write(kind, mturk_id, page, hits, stats)
+        finally:
+            # Release the fetchers if the writer failed, and let the
+            # lister stop before returning
+            self.stopped.set()
+            lister.join()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Streaming export of assignments and their answers
+
+Assignments are read a chunk at a time with values() queries, paginated
+by primary key (rather than with OFFSET, which gets slower as the
+export goes on), along with their HIT's ID and type and their answers,
+however they are stored. No model instance is made, and only one chunk
+is in memory at a time:
+
+    assignments = Assignment.objects.filter(status=Assignment.APPROVED)
+    with open('results.csv', 'wb') as output:
+        write_csv(iter_results(assignments), output,
+                  answer_keys(assignments))
+
+Each result is a dictionary of the COLUMNS, with the answers in an
+'answers' dictionary. The CSV and Parquet writers pivot the answers
+into one column per answer key (named 'answer.' + key); JSON lines keep
+them as an object.
+"""
+
+import csv
+import datetime
+import json
+
+from djurk.models import Assignment, KeyValue, unpack_answers
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    # Parquet output is optional
+    pyarrow = None
+
+DEFAULT_CHUNK_SIZE = 500
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+ANSWER_PREFIX = 'answer.'
+
+# Columns of the results, and the values() fields they are read from
+COLUMNS = (
+    ('assignment_id', 'mturk_id'),
+    ('hit_id', 'hit__mturk_id'),
+    ('hit_type_id', 'hit__hit_type_id'),
+    ('worker_id', 'worker_id'),
+    ('status', 'status'),
+    ('accept_time', 'accept_time'),
+    ('submit_time', 'submit_time'),
+    ('auto_approval_time', 'auto_approval_time'),
+    ('approval_time', 'approval_time'),
+    ('rejection_time', 'rejection_time'),
+)
+TIME_COLUMNS = ('accept_time', 'submit_time', 'auto_approval_time',
+                'approval_time', 'rejection_time')
+
+
+def _chunks(assignments, chunk_size, *fields):
+    """Yield lists of values() rows of assignments, in primary key order"""
+    assignments = assignments.order_by('pk')
+    last = None
+    while True:
+        chunk = assignments
+        if last is not None:
+            chunk = chunk.filter(pk__gt=last)
+        rows = list(chunk.values('pk', *fields)[:chunk_size])
+        if not rows:
+            return
+        yield rows
+        last = rows[-1]['pk']
+
+
+def answer_keys(assignments, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Return the sorted answer keys of assignments (a queryset)
+
+    Keys stored as Key-Value Pairs are found by the database; packed
+    answers have to be read.
+    """
+    keys = set(KeyValue.objects.filter(
+            assignment__in=assignments.filter(packed_answers__isnull=True)
+            ).values_list('key', flat=True).distinct())
+    for rows in _chunks(assignments.filter(packed_answers__isnull=False),
+                        chunk_size, 'packed_answers'):
+        for row in rows:
+            keys.update(unpack_answers(row['packed_answers']))
+    return sorted(keys)
+
+
+def iter_results(assignments, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield a dictionary for each of assignments (a queryset)
+
+    The last result yielded has the highest primary key, which is also
+    its 'pk'.
+    """
+    statuses = dict(Assignment.STATUS_CHOICES)
+    fields = [field for column, field in COLUMNS] + ['packed_answers']
+    for rows in _chunks(assignments, chunk_size, *fields):
+        answers = dict((row['pk'], {}) for row in rows
+                       if row['packed_answers'] is None)
+        if answers:
+            for assignment_id, key, value in KeyValue.objects.filter(
+                    assignment__in=answers.keys()).values_list(
+                            'assignment', 'key', 'value'):
+                answers[assignment_id][key] = value
+        for row in rows:
+            result = dict((column, row[field]) for column, field in COLUMNS)
+            result['pk'] = row['pk']
+            result['status'] = statuses.get(row['status'], row['status'])
+            if row['packed_answers'] is None:
+                result['answers'] = answers[row['pk']]
+            else:
+                result['answers'] = unpack_answers(row['packed_answers'])
+            yield result
+
+
+def _format(value):
+    if isinstance(value, datetime.datetime):
+        return value.strftime(DATETIME_FORMAT)
+    return value
+
+
+def _columns(keys):
+    return ([column for column, field in COLUMNS] +
+            [ANSWER_PREFIX + key for key in keys])
+
+
+def _flatten(result, keys):
+    values = [_format(result[column]) for column, field in COLUMNS]
+    values.extend(result['answers'].get(key) for key in keys)
+    return values
+
+
+def write_csv(results, output, keys):
+    """Write results to a file as CSV, with a column per answer key
+
+    Answers with other keys are left out. Returns the last result.
+    """
+    writer = csv.writer(output)
+    writer.writerow(_columns(keys))
+    result = None
+    for result in results:
+        writer.writerow([
+                value.encode('utf-8') if isinstance(value, unicode)
+                else value
+                for value in _flatten(result, keys)])
+    return result
+
+
+def write_jsonl(results, output):
+    """Write results to a file as JSON, one object per line
+
+    Returns the last result.
+    """
+    result = None
+    for result in results:
+        record = dict((column, _format(result[column]))
+                      for column, field in COLUMNS)
+        record['answers'] = result['answers']
+        output.write(json.dumps(record, sort_keys=True) + '\n')
+    return result
+
+
+def write_parquet(results, path, keys, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Write results to a Parquet file, a row group per chunk
+
+    The times are stored as timestamps, and the other columns (including
+    a column per answer key) as strings. This needs pyarrow. Returns
+    the last result.
+    """
+    if pyarrow is None:
+        raise ImportError("Writing Parquet files needs pyarrow")
+    columns = _columns(keys)
+    schema = pyarrow.schema([
+            pyarrow.field(column, pyarrow.timestamp('s')
+                          if column in TIME_COLUMNS else pyarrow.string())
+            for column in columns])
+    writer = pyarrow.parquet.ParquetWriter(path, schema)
+
+    def write(rows):
+        arrays = [pyarrow.array([row[i] for row in rows],
+                                type=schema.field(i).type)
+                  for i in range(len(columns))]
+        writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+
+    result = None
+    rows = []
+    try:
+        for result in results:
+            values = [result[column] for column, field in COLUMNS]
+            values.extend(result['answers'].get(key) for key in keys)
+            rows.append(values)
+            if len(rows) == chunk_size:
+                write(rows)
+                rows = []
+        if rows:
+            write(rows)
+    finally:
+        writer.close()
+    return result
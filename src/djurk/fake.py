@@ -0,0 +1,765 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""An in-process stand-in for the Mechanical Turk API
+
+FakeMTurk answers the requests Djurk makes (GetHIT, SearchHITs,
+GetReviewableHITs, GetAssignmentsForHIT, CreateHIT, the HIT and
+assignment mutations...) with the same XML Mechanical Turk would send,
+and FakeMTurkConnection hands them to Boto, so everything above
+make_request() -- rate limiting, retries, caching, parsing -- runs as it
+does against the real service. Setting the host to 'fake' makes
+get_connection() return such connections, which allows measuring sync
+throughput offline.
+
+Seeded HITs and assignments are not stored: they are computed from
+their position when asked for, so millions of them cost nothing until
+they are changed. Latency, throttling (a server side rate limit, or a
+fraction of requests answered with 503 Service Unavailable) and errors
+can be injected.
+"""
+
+import bisect
+import collections
+import datetime
+import hashlib
+import random
+import threading
+import time
+from xml.sax.saxutils import escape
+
+from djurk.cache import CachedMTurkConnection
+
+SEEDED_HIT_PREFIX = 'SEEDEDHIT'
+CREATED_HIT_PREFIX = 'FAKEHIT'
+SEEDED_HIT_TYPE_ID = 'SEEDEDHITTYPE'
+DEFAULT_ASSIGNMENTS_PER_HIT = 1
+DEFAULT_ANSWER_FIELDS = 2
+DEFAULT_REVIEWABLE = 0.1  # Fraction of the seeded HITs that are Reviewable
+DEFAULT_BALANCE = '10000.00'
+
+_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+_COLORS = ('red', 'green', 'blue', 'yellow', 'purple', 'orange')
+_SEEDED_LIFETIME = datetime.timedelta(days=7)
+_SEEDED_APPROVAL_DELAY = 3 * 24 * 60 * 60
+_VALID = u'<Request><IsValid>True</IsValid></Request>'
+_QUESTION_FORM_ANSWERS = ('<QuestionFormAnswers xmlns="http://mechanicalturk'
+                          '.amazonaws.com/AWSMechanicalTurkDataSchemas/'
+                          '2005-10-01/QuestionFormAnswers.xsd">%s'
+                          '</QuestionFormAnswers>')
+
+# The HITs a listing holds, by HIT status
+_LISTED = {
+    'search': lambda status: status != 'Disposed',
+    'Reviewable': lambda status: status == 'Reviewable',
+    'Reviewing': lambda status: status == 'Reviewing',
+}
+
+
+class RequestError(Exception):
+    """A request Mechanical Turk would have refused"""
+
+    def __init__(self, code, message):
+        Exception.__init__(self, code, message)
+        self.code = code
+        self.message = message
+
+
+def _element(name, value):
+    if isinstance(value, datetime.datetime):
+        value = value.strftime(_TIME_FORMAT)
+    elif not isinstance(value, basestring):
+        value = unicode(value)
+    return u'<%s>%s</%s>' % (name, escape(value), name)
+
+
+def _errors_xml(code, message):
+    return (u'<Errors><Error>%s%s</Error></Errors>' %
+            (_element('Code', code), _element('Message', message)))
+
+
+class _Listing(object):
+    """An ordered set of HIT IDs, made of seeded HITs and added ones
+
+    It starts as the seeded HITs whose index is below size. Seeded HITs
+    removed from that range are kept in a sorted list, so that finding
+    the HIT at a position stays cheap however many there are.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.removed = []
+        self.added = []
+        self._added = set()
+
+    def __len__(self):
+        return self.size - len(self.removed) + len(self.added)
+
+    def _is_removed(self, index):
+        position = bisect.bisect_left(self.removed, index)
+        return (position < len(self.removed) and
+                self.removed[position] == index)
+
+    def _index_at(self, position):
+        """Return the index of the seeded HIT at position in the listing"""
+        low, high = position, self.size - 1
+        while low < high:
+            middle = (low + high) // 2
+            if middle + 1 - bisect.bisect_right(self.removed,
+                                                middle) > position:
+                high = middle
+            else:
+                low = middle + 1
+        return low
+
+    def add(self, hit_id, index):
+        if index is not None and index < self.size:
+            if self._is_removed(index):
+                self.removed.remove(index)
+        elif hit_id not in self._added:
+            self.added.append(hit_id)
+            self._added.add(hit_id)
+
+    def remove(self, hit_id, index):
+        if index is not None and index < self.size:
+            if not self._is_removed(index):
+                bisect.insort(self.removed, index)
+        elif hit_id in self._added:
+            self.added.remove(hit_id)
+            self._added.discard(hit_id)
+
+    def page(self, start, count):
+        """Return count HIT IDs starting at position start"""
+        ids = []
+        seeded = self.size - len(self.removed)
+        if start < seeded:
+            index = self._index_at(start)
+            while len(ids) < count and index < self.size:
+                if not self._is_removed(index):
+                    ids.append(seeded_hit_id(index))
+                index += 1
+        start = max(start - seeded, 0)
+        ids.extend(self.added[start:start + count - len(ids)])
+        return ids
+
+
+def seeded_hit_id(index):
+    return '%s%011d' % (SEEDED_HIT_PREFIX, index)
+
+
+class FakeMTurk(object):
+    """In-memory Mechanical Turk requester account
+
+    hits seeded HITs are there from the start, the first reviewable
+    fraction of them Reviewable (with assignments_per_hit Submitted
+    assignments) and the others Assignable (with one more assignment
+    to go), with answer_fields answers each. Each request takes latency
+    seconds. Requests beyond rate_limit per second, and a throttle_rate
+    fraction of all requests, are refused with 503 Service Unavailable;
+    an error_rate fraction fail with 500 Internal Server Error. seed
+    makes the injected failures repeatable.
+
+    The counts of requests by operation are kept in requests, and the
+    bonuses granted in bonuses.
+    """
+
+    def __init__(self, hits=0, assignments_per_hit=DEFAULT_ASSIGNMENTS_PER_HIT,
+                 answer_fields=DEFAULT_ANSWER_FIELDS,
+                 reviewable=DEFAULT_REVIEWABLE, latency=0.0, rate_limit=None,
+                 throttle_rate=0.0, error_rate=0.0, seed=None,
+                 clock=time.time, sleep=time.sleep):
+        self.seeded_hits = hits
+        self.assignments_per_hit = assignments_per_hit
+        self.answer_fields = answer_fields
+        self.seeded_reviewable = int(hits * reviewable)
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.clock = clock
+        self.sleep = sleep
+        self.requests = collections.Counter()
+        self.bonuses = []
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._epoch = self.now() - datetime.timedelta(hours=1)
+        self._tokens = rate_limit
+        self._filled_at = clock()
+        self._hits = {}
+        self._assignments = {}
+        self._hit_types = {}
+        self._request_tokens = {}
+        self._bonus_tokens = set()
+        self._extend_tokens = set()
+        self._created = 0
+        self._listings = {
+            'search': _Listing(hits),
+            'Reviewable': _Listing(self.seeded_reviewable),
+            'Reviewing': _Listing(0),
+        }
+
+    def now(self):
+        return datetime.datetime.utcfromtimestamp(int(self.clock()))
+
+    # Seeded data
+
+    def _seeded_index(self, hit_id):
+        if not hit_id.startswith(SEEDED_HIT_PREFIX):
+            return None
+        try:
+            index = int(hit_id[len(SEEDED_HIT_PREFIX):])
+        except ValueError:
+            return None
+        if 0 <= index < self.seeded_hits:
+            return index
+        return None
+
+    def _seeded_hit(self, index):
+        reviewable = index < self.seeded_reviewable
+        max_assignments = self.assignments_per_hit
+        if not reviewable:
+            max_assignments += 1
+        return {
+            'HITId': seeded_hit_id(index),
+            'HITTypeId': SEEDED_HIT_TYPE_ID,
+            'CreationTime': self._epoch,
+            'Title': u'Seeded HIT %d' % index,
+            'Description': u'A HIT seeded by djurk.fake',
+            'Question': u'',
+            'Keywords': u'seeded',
+            'HITStatus': reviewable and 'Reviewable' or 'Assignable',
+            'MaxAssignments': max_assignments,
+            'Amount': '0.05',
+            'AutoApprovalDelayInSeconds': _SEEDED_APPROVAL_DELAY,
+            'Expiration': self._epoch + _SEEDED_LIFETIME,
+            'AssignmentDurationInSeconds': 900,
+            'HITReviewStatus': 'NotReviewed',
+            'RequesterAnnotation': None,
+        }
+
+    def _seeded_assignments(self, index):
+        hit_id = seeded_hit_id(index)
+        assignments = []
+        for number in range(self.assignments_per_hit):
+            submit_time = self._epoch + datetime.timedelta(seconds=120 +
+                                                           number)
+            assignments.append({
+                'AssignmentId': '%s-%d' % (hit_id, number),
+                'WorkerId': 'WORKER%d' % ((index + number) % 1000),
+                'HITId': hit_id,
+                'AssignmentStatus': 'Submitted',
+                'AcceptTime': self._epoch + datetime.timedelta(seconds=60),
+                'SubmitTime': submit_time,
+                'AutoApprovalTime': submit_time + datetime.timedelta(
+                        seconds=_SEEDED_APPROVAL_DELAY),
+                'answers': self._seeded_answers(index, number),
+            })
+        return assignments
+
+    def _seeded_answers(self, index, number):
+        answers = [
+            ('favorite_color', _COLORS[(index + number) % len(_COLORS)]),
+            ('comments', u'Comment %d' % number),
+        ]
+        answers.extend((u'question_%d' % field, u'Answer %d' % field)
+                       for field in range(len(answers), self.answer_fields))
+        return answers[:self.answer_fields]
+
+    # Lookups
+
+    def _hit(self, hit_id):
+        """Return the HIT, which must not be changed"""
+        try:
+            return self._hits[hit_id]
+        except KeyError:
+            pass
+        index = self._seeded_index(hit_id)
+        if index is None:
+            raise RequestError('AWS.MechanicalTurk.HITDoesNotExist',
+                               'Hit with id %s does not exist.' % hit_id)
+        return self._seeded_hit(index)
+
+    def _assignments_of(self, hit_id):
+        """Return the HIT's assignments, which must not be changed"""
+        try:
+            return self._assignments[hit_id]
+        except KeyError:
+            pass
+        index = self._seeded_index(hit_id)
+        if index is None:
+            return []
+        return self._seeded_assignments(index)
+
+    def _changeable_hit(self, hit_id):
+        """Return the HIT and its assignments, stored so they can change"""
+        hit = self._hit(hit_id)
+        if hit_id not in self._hits:
+            self._hits[hit_id] = hit
+            self._assignments[hit_id] = self._assignments_of(hit_id)
+        return hit, self._assignments[hit_id]
+
+    def _changeable_assignment(self, assignment_id):
+        hit_id, _, number = assignment_id.rpartition('-')
+        try:
+            hit, assignments = self._changeable_hit(hit_id)
+            return hit, assignments[int(number)]
+        except (RequestError, ValueError, IndexError):
+            raise RequestError(
+                    'AWS.MechanicalTurk.AssignmentDoesNotExist',
+                    'Assignment %s does not exist.' % assignment_id)
+
+    def _set_status(self, hit, status):
+        hit['HITStatus'] = status
+        index = self._seeded_index(hit['HITId'])
+        for name, listed in _LISTED.items():
+            if listed(status):
+                self._listings[name].add(hit['HITId'], index)
+            else:
+                self._listings[name].remove(hit['HITId'], index)
+
+    def _counts(self, hit):
+        assignments = self._assignments_of(hit['HITId'])
+        available = 0
+        if hit['HITStatus'] == 'Assignable':
+            available = hit['MaxAssignments'] - len(assignments)
+        return {
+            'NumberOfAssignmentsPending': 0,
+            'NumberOfAssignmentsAvailable': available,
+            'NumberOfAssignmentsCompleted': len(assignments),
+        }
+
+    # XML
+
+    def _hit_xml(self, hit, detail=True):
+        parts = [u'<HIT>' + _VALID,
+                 _element('HITId', hit['HITId'])]
+        if detail:
+            for name in ('HITTypeId', 'CreationTime', 'Title', 'Description',
+                         'Question', 'Keywords', 'HITStatus',
+                         'MaxAssignments'):
+                parts.append(_element(name, hit[name]))
+            parts.append(u'<Reward>%s<CurrencyCode>USD</CurrencyCode>%s'
+                         u'</Reward>' % (
+                             _element('Amount', hit['Amount']),
+                             _element('FormattedPrice',
+                                      '$%s' % hit['Amount'])))
+            for name in ('AutoApprovalDelayInSeconds', 'Expiration',
+                         'AssignmentDurationInSeconds'):
+                parts.append(_element(name, hit[name]))
+            parts.append(u'<NumberOfSimilarHITs>0</NumberOfSimilarHITs>')
+            parts.append(_element('HITReviewStatus', hit['HITReviewStatus']))
+            if hit['RequesterAnnotation'] is not None:
+                parts.append(_element('RequesterAnnotation',
+                                      hit['RequesterAnnotation']))
+            for name, value in sorted(self._counts(hit).items()):
+                parts.append(_element(name, value))
+        parts.append(u'</HIT>')
+        return u''.join(parts)
+
+    def _assignment_xml(self, assignment):
+        parts = [u'<Assignment>']
+        for name in ('AssignmentId', 'WorkerId', 'HITId', 'AssignmentStatus',
+                     'AutoApprovalTime', 'AcceptTime', 'SubmitTime',
+                     'ApprovalTime', 'RejectionTime', 'RequesterFeedback'):
+            if assignment.get(name) is not None:
+                parts.append(_element(name, assignment[name]))
+        answers = u''.join(
+                u'<Answer>%s%s</Answer>' % (
+                        _element('QuestionIdentifier', key),
+                        _element('FreeText', value))
+                for key, value in assignment['answers'])
+        parts.append(_element('Answer', _QUESTION_FORM_ANSWERS % answers))
+        parts.append(u'</Assignment>')
+        return u''.join(parts)
+
+    def _page_xml(self, params, total, items):
+        return (_VALID + u'%s%s%s%s' % (
+                _element('NumResults', len(items)),
+                _element('TotalNumResults', total),
+                _element('PageNumber', params.get('PageNumber', 1)),
+                u''.join(items)))
+
+    # Operations, each returning the XML inside the response element
+
+    def _page_bounds(self, params):
+        page_size = int(params.get('PageSize', 10))
+        page_number = int(params.get('PageNumber', 1))
+        if not 1 <= page_size <= 100 or page_number < 1:
+            raise RequestError('AWS.ParameterOutOfRange',
+                               'PageSize must be 1 to 100 and PageNumber '
+                               'positive.')
+        return (page_number - 1) * page_size, page_size
+
+    def _result(self, operation, xml):
+        return u'<%sResult>%s</%sResult>' % (operation, xml, operation)
+
+    def get_account_balance(self, params):
+        return self._result('GetAccountBalance', _VALID + (
+                u'<AvailableBalance><Amount>%s</Amount>'
+                u'<CurrencyCode>USD</CurrencyCode>'
+                u'<FormattedPrice>$%s</FormattedPrice></AvailableBalance>' %
+                (DEFAULT_BALANCE, DEFAULT_BALANCE)))
+
+    def _hit_type(self, params):
+        hit_type = {
+            'Title': params['Title'],
+            'Description': params['Description'],
+            'Keywords': params.get('Keywords', u''),
+            'Amount': params['Reward.1.Amount'],
+            'AssignmentDurationInSeconds': int(
+                    params['AssignmentDurationInSeconds']),
+            'AutoApprovalDelayInSeconds': int(params.get(
+                    'AutoApprovalDelayInSeconds', 30 * 24 * 60 * 60)),
+        }
+        key = repr(sorted(hit_type.items())).encode('utf-8')
+        hit_type_id = 'FAKETYPE' + hashlib.sha1(key).hexdigest()[:22].upper()
+        self._hit_types[hit_type_id] = hit_type
+        return hit_type_id
+
+    def register_hit_type(self, params):
+        return self._result('RegisterHITType',
+                            _VALID + _element('HITTypeId',
+                                              self._hit_type(params)))
+
+    def create_hit(self, params):
+        token = params.get('UniqueRequestToken')
+        if token in self._request_tokens:
+            raise RequestError(
+                    'AWS.MechanicalTurk.DuplicateRequest',
+                    'There is already a HIT with this unique request token '
+                    '(%s).' % self._request_tokens[token])
+        hit_type_id = params.get('HITTypeId')
+        if hit_type_id is None:
+            hit_type_id = self._hit_type(params)
+        elif hit_type_id not in self._hit_types:
+            raise RequestError('AWS.MechanicalTurk.HITTypeDoesNotExist',
+                               'Hit type %s does not exist.' % hit_type_id)
+
+        self._created += 1
+        hit_id = '%s%011d' % (CREATED_HIT_PREFIX, self._created)
+        now = self.now()
+        hit = dict(self._hit_types[hit_type_id])
+        hit.update({
+            'HITId': hit_id,
+            'HITTypeId': hit_type_id,
+            'CreationTime': now,
+            'Question': params['Question'],
+            'MaxAssignments': int(params.get('MaxAssignments', 1)),
+            'Expiration': now + datetime.timedelta(
+                    seconds=int(params['LifetimeInSeconds'])),
+            'HITReviewStatus': 'NotReviewed',
+            'RequesterAnnotation': params.get('RequesterAnnotation'),
+        })
+        self._hits[hit_id] = hit
+        self._assignments[hit_id] = []
+        self._set_status(hit, 'Assignable')
+        if token is not None:
+            self._request_tokens[token] = hit_id
+        detail = 'HITDetail' in [value for name, value in params.items()
+                                 if name.startswith('ResponseGroup.')]
+        return self._hit_xml(hit, detail=detail)
+
+    def get_hit(self, params):
+        return self._hit_xml(self._hit(params['HITId']))
+
+    def search_hits(self, params):
+        start, count = self._page_bounds(params)
+        listing = self._listings['search']
+        items = [self._hit_xml(self._hit(hit_id))
+                 for hit_id in listing.page(start, count)]
+        return self._result('SearchHITs',
+                            self._page_xml(params, len(listing), items))
+
+    def get_reviewable_hits(self, params):
+        """Only Status is supported; HITTypeId and sorting are ignored"""
+        start, count = self._page_bounds(params)
+        status = params.get('Status', 'Reviewable')
+        if status not in ('Reviewable', 'Reviewing'):
+            raise RequestError('AWS.ParameterOutOfRange',
+                               'Status must be Reviewable or Reviewing.')
+        listing = self._listings[status]
+        items = [self._hit_xml(self._hit(hit_id), detail=False)
+                 for hit_id in listing.page(start, count)]
+        return self._result('GetReviewableHITs',
+                            self._page_xml(params, len(listing), items))
+
+    def get_assignments_for_hit(self, params):
+        start, count = self._page_bounds(params)
+        self._hit(params['HITId'])
+        assignments = self._assignments_of(params['HITId'])
+        if 'AssignmentStatus' in params:
+            statuses = params['AssignmentStatus'].split(',')
+            assignments = [assignment for assignment in assignments
+                           if assignment['AssignmentStatus'] in statuses]
+        items = [self._assignment_xml(assignment)
+                 for assignment in assignments[start:start + count]]
+        return self._result('GetAssignmentsForHIT',
+                            self._page_xml(params, len(assignments), items))
+
+    def _review(self, params, status, time_name):
+        hit, assignment = self._changeable_assignment(params['AssignmentId'])
+        if assignment['AssignmentStatus'] != 'Submitted':
+            raise RequestError(
+                    'AWS.MechanicalTurk.InvalidAssignmentState',
+                    'This operation can be called with a status of: '
+                    'Submitted')
+        assignment['AssignmentStatus'] = status
+        assignment[time_name] = self.now()
+        assignment['RequesterFeedback'] = params.get('RequesterFeedback')
+        return u''
+
+    def approve_assignment(self, params):
+        return self._review(params, 'Approved', 'ApprovalTime')
+
+    def reject_assignment(self, params):
+        return self._review(params, 'Rejected', 'RejectionTime')
+
+    def grant_bonus(self, params):
+        token = params.get('UniqueRequestToken')
+        if token in self._bonus_tokens:
+            raise RequestError(
+                    'AWS.MechanicalTurk.DuplicateRequest',
+                    'There is already a bonus with this unique request '
+                    'token.')
+        hit, assignment = self._changeable_assignment(params['AssignmentId'])
+        if assignment['WorkerId'] != params['WorkerId']:
+            raise RequestError('AWS.MechanicalTurk.InvalidParameterValue',
+                               'The assignment was not done by worker %s.' %
+                               params['WorkerId'])
+        self.bonuses.append((params['WorkerId'], params['AssignmentId'],
+                             params['BonusAmount.1.Amount'],
+                             params.get('Reason')))
+        if token is not None:
+            self._bonus_tokens.add(token)
+        return u''
+
+    def get_bonus_payments(self, params):
+        """Only the bonuses of an AssignmentId are listed"""
+        start, count = self._page_bounds(params)
+        payments = [(worker_id, amount, reason) for
+                    worker_id, assignment_id, amount, reason in self.bonuses
+                    if assignment_id == params['AssignmentId']]
+        items = [u'<BonusPayment>%s<BonusAmount>%s%s</BonusAmount>%s%s'
+                 u'</BonusPayment>' % (
+                     _element('WorkerId', worker_id),
+                     _element('Amount', amount),
+                     _element('CurrencyCode', 'USD'),
+                     _element('AssignmentId', params['AssignmentId']),
+                     _element('Reason', reason or u''))
+                 for worker_id, amount, reason in
+                 payments[start:start + count]]
+        return self._result('GetBonusPayments',
+                            self._page_xml(params, len(payments), items))
+
+    def force_expire_hit(self, params):
+        hit, assignments = self._changeable_hit(params['HITId'])
+        hit['Expiration'] = min(hit['Expiration'], self.now())
+        if hit['HITStatus'] in ('Assignable', 'Unassignable'):
+            self._set_status(hit, 'Reviewable')
+        return u''
+
+    def extend_hit(self, params):
+        token = params.get('UniqueRequestToken')
+        if token in self._extend_tokens:
+            raise RequestError(
+                    'AWS.MechanicalTurk.DuplicateRequest',
+                    'The HIT was already extended with this unique request '
+                    'token.')
+        hit, assignments = self._changeable_hit(params['HITId'])
+        if hit['HITStatus'] == 'Disposed':
+            raise RequestError('AWS.MechanicalTurk.InvalidHITState',
+                               'Disposed HITs cannot be extended.')
+        hit['MaxAssignments'] += int(params.get('MaxAssignmentsIncrement', 0))
+        hit['Expiration'] = max(hit['Expiration'], self.now()) + (
+                datetime.timedelta(seconds=int(params.get(
+                        'ExpirationIncrementInSeconds', 0))))
+        if (hit['HITStatus'] == 'Reviewable' and
+                len(assignments) < hit['MaxAssignments']):
+            self._set_status(hit, 'Assignable')
+        if token is not None:
+            self._extend_tokens.add(token)
+        return u''
+
+    def set_hit_as_reviewing(self, params):
+        hit, assignments = self._changeable_hit(params['HITId'])
+        revert = params.get('Revert', 'false').lower() == 'true'
+        current, new = ('Reviewing', 'Reviewable') if revert else (
+                'Reviewable', 'Reviewing')
+        if hit['HITStatus'] != current:
+            raise RequestError('AWS.MechanicalTurk.InvalidHITState',
+                               'This operation can be called with a status '
+                               'of: %s' % current)
+        self._set_status(hit, new)
+        return u''
+
+    def dispose_hit(self, params):
+        hit, assignments = self._changeable_hit(params['HITId'])
+        if hit['HITStatus'] not in ('Reviewable', 'Reviewing'):
+            raise RequestError('AWS.MechanicalTurk.InvalidHITState',
+                               'This operation can be called with a status '
+                               'of: Reviewable, Reviewing')
+        if any(assignment['AssignmentStatus'] == 'Submitted'
+               for assignment in assignments):
+            raise RequestError('AWS.MechanicalTurk.InvalidHITState',
+                               'All assignments must be approved or '
+                               'rejected first.')
+        self._set_status(hit, 'Disposed')
+        return u''
+
+    def disable_hit(self, params):
+        hit, assignments = self._changeable_hit(params['HITId'])
+        if hit['HITStatus'] == 'Disposed':
+            raise RequestError('AWS.MechanicalTurk.InvalidHITState',
+                               'The HIT is already disposed.')
+        for assignment in assignments:
+            if assignment['AssignmentStatus'] == 'Submitted':
+                assignment['AssignmentStatus'] = 'Approved'
+                assignment['ApprovalTime'] = self.now()
+        self._set_status(hit, 'Disposed')
+        return u''
+
+    operations = {
+        'GetAccountBalance': get_account_balance,
+        'RegisterHITType': register_hit_type,
+        'CreateHIT': create_hit,
+        'GetHIT': get_hit,
+        'SearchHITs': search_hits,
+        'GetReviewableHITs': get_reviewable_hits,
+        'GetAssignmentsForHIT': get_assignments_for_hit,
+        'ApproveAssignment': approve_assignment,
+        'RejectAssignment': reject_assignment,
+        'GrantBonus': grant_bonus,
+        'GetBonusPayments': get_bonus_payments,
+        'ForceExpireHIT': force_expire_hit,
+        'ExtendHIT': extend_hit,
+        'SetHITAsReviewing': set_hit_as_reviewing,
+        'DisposeHIT': dispose_hit,
+        'DisableHIT': disable_hit,
+    }
+
+    # Requests
+
+    def submit_assignment(self, hit_id, answers, worker_id='WORKER1'):
+        """Submit an assignment of the HIT, as a worker would
+
+        answers is a dictionary of question identifiers and free text
+        answers. The HIT becomes Reviewable once all of its assignments
+        are submitted. Returns the assignment ID.
+        """
+        with self._lock:
+            hit, assignments = self._changeable_hit(hit_id)
+            if self._counts(hit)['NumberOfAssignmentsAvailable'] < 1:
+                raise RequestError('AWS.MechanicalTurk.InvalidHITState',
+                                   'The HIT has no assignment available.')
+            now = self.now()
+            assignment_id = '%s-%d' % (hit_id, len(assignments))
+            assignments.append({
+                'AssignmentId': assignment_id,
+                'WorkerId': worker_id,
+                'HITId': hit_id,
+                'AssignmentStatus': 'Submitted',
+                'AcceptTime': now,
+                'SubmitTime': now,
+                'AutoApprovalTime': now + datetime.timedelta(
+                        seconds=hit['AutoApprovalDelayInSeconds']),
+                'answers': sorted(answers.items()),
+            })
+            if len(assignments) >= hit['MaxAssignments']:
+                self._set_status(hit, 'Reviewable')
+            return assignment_id
+
+    def _throttled(self):
+        if self.throttle_rate and self._random.random() < self.throttle_rate:
+            return True
+        if self.rate_limit is None:
+            return False
+        now = self.clock()
+        self._tokens = min(self.rate_limit, self._tokens +
+                           (now - self._filled_at) * self.rate_limit)
+        self._filled_at = now
+        if self._tokens < 1:
+            return True
+        self._tokens -= 1
+        return False
+
+    def request(self, operation, params):
+        """Answer a request, returning the HTTP status, reason and body"""
+        if self.latency:
+            self.sleep(self.latency)
+        with self._lock:
+            request_id = u'%032x' % self._random.getrandbits(128)
+            self.requests[operation] += 1
+            if self._throttled():
+                return 503, 'Service Unavailable', self._error_body(
+                        request_id, 'ServiceUnavailable',
+                        'Request rate limit exceeded.')
+            if self.error_rate and self._random.random() < self.error_rate:
+                return 500, 'Internal Server Error', self._error_body(
+                        request_id, 'AWS.ServiceUnavailable',
+                        'Internal error injected by djurk.fake.')
+            if operation not in self.operations:
+                return 400, 'Bad Request', self._error_body(
+                        request_id, 'AWS.InvalidAction',
+                        'The action %s is not valid.' % operation)
+            try:
+                xml = self.operations[operation](self, params)
+                if not xml:
+                    xml = self._result(operation, _VALID)
+            except RequestError as error:
+                # Mechanical Turk reports invalid requests with a 200
+                xml = self._result(operation, (
+                        u'<Request><IsValid>False</IsValid>%s</Request>' %
+                        _errors_xml(error.code, error.message)))
+            except KeyError as error:
+                xml = self._result(operation, (
+                        u'<Request><IsValid>False</IsValid>%s</Request>' %
+                        _errors_xml('AWS.MissingParameters',
+                                    'No value for %s.' % error.args[0])))
+        body = (u'<?xml version="1.0"?>\n<%sResponse><OperationRequest>'
+                u'<RequestId>%s</RequestId></OperationRequest>%s'
+                u'</%sResponse>' % (operation, request_id, xml, operation))
+        return 200, 'OK', body.encode('utf-8')
+
+    def _error_body(self, request_id, code, message):
+        body = (u'<?xml version="1.0"?>\n<Response>%s<RequestID>%s'
+                u'</RequestID></Response>' % (_errors_xml(code, message),
+                                              request_id))
+        return body.encode('utf-8')
+
+
+class FakeResponse(object):
+    """Just enough of an httplib.HTTPResponse for Boto"""
+
+    def __init__(self, status, reason, body):
+        self.status = status
+        self.reason = reason
+        self.body = body
+
+    def read(self):
+        return self.body
+
+    def getheader(self, name, default=None):
+        return default
+
+
+class FakeMTurkConnection(CachedMTurkConnection):
+    """A CachedMTurkConnection whose requests are answered by a FakeMTurk
+
+    Nothing is sent over the network, so no credentials are needed.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.service = kwargs.pop('service')
+        kwargs.setdefault('aws_access_key_id', 'fake')
+        kwargs.setdefault('aws_secret_access_key', 'fake')
+        CachedMTurkConnection.__init__(self, *args, **kwargs)
+
+    def make_request(self, action, params=None, path='/', verb='GET'):
+        params = dict((name, value if isinstance(value, basestring)
+                       else unicode(value))
+                      for name, value in (params or {}).items())
+        return FakeResponse(*self.service.request(action, params))
+
+    def close(self):
+        """There is no HTTP connection to close"""
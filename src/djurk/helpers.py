@@ -1,26 +1,220 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from djurk.common import get_connection
+import functools
+import itertools
+import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+from django import db
+from django.db import transaction
+
+from djurk import common
+from djurk.common import MAX_PAGE_SIZE, iter_pages, pooled_connection
 from djurk.models import HIT
+from djurk.signals import sync_finished
+from djurk.stats import SyncStats
+
+# Sources of remote HITs
+ALL_HITS, REVIEWABLE_HITS = 'all', 'reviewable'
+
+# Kinds of worker pools for parallel updates
+THREAD, PROCESS = 'thread', 'process'
+
+logger = logging.getLogger(__name__)
+
+# Whether this is a worker process of a parallel update, whose requests
+# are not seen by the coordinator's statistics
+_in_worker_process = False
+
+
+def _chunks(iterable, size):
+    """Yield lists of up to size items from iterable"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _fetch_hit_page(source, page_number, page_size=MAX_PAGE_SIZE):
+    """Return one page of the requester's HITs from source"""
+    with pooled_connection() as connection:
+        if source == REVIEWABLE_HITS:
+            return connection.get_reviewable_hits(page_size=page_size,
+                                                  page_number=page_number)
+        return connection.search_hits(page_size=page_size,
+                                      page_number=page_number)
+
+
+def _update_hits(iterable, do_update_assignments=False, batch_size=None,
+                 stats=None):
+    """Update local HITs from an iterable of Boto HIT objects
+
+    By default, each HIT is updated (and saved) on its own. If
+    batch_size is given, the HITs are synchronized batch_size at a time
+    with HIT.objects.sync_from_mturk(), committing once per batch.
+
+    The counts are added to stats, which is returned (a new SyncStats
+    is used if none is given).
+    """
+    if stats is None:
+        stats = SyncStats()
+
+    if batch_size is None:
+        for mturk_hit in iterable:
+            djurk_hit, created = HIT.objects.get_or_create(
+                    mturk_id=mturk_hit.HITId)
+            written = djurk_hit.update(mturk_hit=mturk_hit)
+            if created:
+                stats.count('hits', {'inserted': 1})
+            else:
+                stats.count('hits', {written and 'updated' or 'unchanged': 1})
+            if do_update_assignments:
+                stats.count('assignments', djurk_hit.update_assignments())
+        return stats
+
+    for chunk in _chunks(iterable, batch_size):
+        with transaction.commit_on_success():
+            stats.count('hits', HIT.objects.sync_from_mturk(chunk))
+        if do_update_assignments:
+            mturk_ids = [mturk_hit.HITId for mturk_hit in chunk]
+            for djurk_hit in HIT.objects.filter(mturk_id__in=mturk_ids):
+                stats.count('assignments', djurk_hit.update_assignments())
+    return stats
+
+
+def _sync_hit_page(task, stats=None):
+    """Fetch and synchronize one page of HITs
+
+    task is a (source, page_number, do_update_assignments) tuple. A
+    failure is logged and counted rather than raised, so that one bad
+    page does not abort a parallel update. Returns the SyncStats of the
+    page and the TotalNumResults reported with it (None on failure).
+    """
+    source, page_number, do_update_assignments = task
+    if stats is None:
+        stats = SyncStats()
+    total = None
+    try:
+        page = _fetch_hit_page(source, page_number)
+        total = int(page.TotalNumResults)
+        _update_hits(page, do_update_assignments=do_update_assignments,
+                     batch_size=MAX_PAGE_SIZE, stats=stats)
+        stats.pages += 1
+    except Exception:
+        logger.exception("Updating page %d of %s HITs failed",
+                         page_number, source)
+        stats.errors += 1
+    stats.finish()
+    return stats, total
+
+
+def _sync_hit_page_in_worker(task):
+    """Run _sync_hit_page() in a pool worker
+
+    Each worker thread or process has its own database connection,
+    which is closed when the page is done. The queries of the worker
+    are counted in the page's statistics, and so are its requests in a
+    worker process.
+    """
+    stats = SyncStats()
+    try:
+        with stats.instrument(requests=_in_worker_process):
+            return _sync_hit_page(task, stats)
+    finally:
+        db.close_connection()
+
+
+def _init_worker_process():
+    global _in_worker_process
+    _in_worker_process = True
+    # Connections inherited from the parent process must not be shared
+    common.connection_pool.clear()
+
+
+def _update_hits_in_parallel(source, do_update_assignments, workers, mode,
+                             stats):
+    """Update HITs from source with a pool of workers
+
+    This process acts as the coordinator: it updates the first page
+    itself to learn how many pages there are, hands the remaining
+    pages out to workers threads or processes (depending upon mode)
+    and merges the statistics they report into stats.
+    """
+    page_stats, total = _sync_hit_page((source, 1, do_update_assignments))
+    stats.merge(page_stats)
+
+    if total is not None:
+        page_count = (total + MAX_PAGE_SIZE - 1) // MAX_PAGE_SIZE
+        tasks = [(source, page_number, do_update_assignments)
+                 for page_number in xrange(2, page_count + 1)]
+    else:
+        tasks = []
+
+    if tasks:
+        if mode == PROCESS:
+            # Don't let the worker processes inherit an open connection
+            db.close_connection()
+            pool = multiprocessing.Pool(workers,
+                                        initializer=_init_worker_process)
+        else:
+            pool = ThreadPool(workers)
+        try:
+            for page_stats, total in pool.imap_unordered(
+                    _sync_hit_page_in_worker, tasks):
+                stats.merge(page_stats)
+        finally:
+            pool.close()
+            pool.join()
+
+
+def _update_hits_from(source, do_update_assignments, batch_size, workers,
+                      mode):
+    stats = SyncStats()
+
+    def hits():
+        fetch_page = functools.partial(_fetch_hit_page, source)
+        for page in iter_pages(fetch_page, page_size=MAX_PAGE_SIZE):
+            stats.pages += 1
+            for mturk_hit in page:
+                yield mturk_hit
+
+    with stats.instrument():
+        if workers:
+            _update_hits_in_parallel(source, do_update_assignments, workers,
+                                     mode, stats)
+        else:
+            _update_hits(hits(), do_update_assignments=do_update_assignments,
+                         batch_size=batch_size, stats=stats)
+    stats.finish()
+    sync_finished.send(sender=HIT, source=source, stats=stats)
+    return stats
+
 
+def update_all_hits(do_update_assignments=False, batch_size=None,
+                    workers=None, mode=THREAD):
+    """Get All HITS from Amazon
 
-def _update_hits(iterable, do_update_assignments=False):
-    for mturk_hit in iterable:
-        djurk_hit = HIT.objects.get_or_create(mturk_id=mturk_hit.HITId)[0]
-        djurk_hit.update(mturk_hit=mturk_hit,
-                         do_update_assignments=do_update_assignments)
+    If workers is given, pages of HITs are updated concurrently by that
+    many threads or processes (mode is THREAD or PROCESS). Otherwise
+    HITs are updated in this thread, one at a time or batch_size at a
+    time. A SyncStats object describing the update, including the
+    requests made and queries run, is returned, and sent with the
+    djurk.signals.sync_finished signal.
+    """
+    return _update_hits_from(ALL_HITS, do_update_assignments, batch_size,
+                             workers, mode)
 
-def update_all_hits(do_update_assignments=False):
-    """Get All HITS from Amazon"""
-    connection = get_connection()
-    _update_hits(connection.get_all_hits(),
-                 do_update_assignments=do_update_assignments)
 
+def update_reviewable_hits(do_update_assignments=False, batch_size=None,
+                           workers=None, mode=THREAD):
 
-def update_reviewable_hits(do_update_assignments=False):
+    """Get only reviewable HITS from Amazon
 
-    """Get only reviewable HITS from Amazon"""
-    connection = get_connection()
-    _update_hits(connection.get_reviewable_hits(),
-                 do_update_assignments=do_update_assignments)
+    Accepts the same options as update_all_hits().
+    """
+    return _update_hits_from(REVIEWABLE_HITS, do_update_assignments,
+                             batch_size, workers, mode)
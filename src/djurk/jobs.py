@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Running queued Jobs outside of web requests
+
+The admin actions that talk to Mechanical Turk for a long time queue a
+Job (see JobManager.enqueue) instead of running inside the request.
+The djurk_worker command runs a Worker, which claims pending jobs one
+at a time and runs them, on as many threads as its concurrency:
+
+    Job.objects.enqueue(Job.POLL_ALL_HITS)
+    Worker(concurrency=2, once=True).run()
+
+A job is claimed with a conditional UPDATE of its status, so several
+workers (threads or processes) can share the queue without running a
+job twice. While it runs, its progress (the number of requests made
+since it started, which includes those of the jobs running alongside
+it in the same process) and its heartbeat are written every
+PROGRESS_INTERVAL seconds. A running job whose heartbeat is older than
+the workers' lease was left by a worker that stopped, and is failed;
+should that worker finish it after all, its outcome is not stored.
+When a job is done, its result is stored as JSON, or its traceback if
+it failed.
+"""
+
+import datetime
+import json
+import logging
+import threading
+import time
+import traceback
+
+from django.db import connection
+
+from djurk.helpers import update_all_hits, update_reviewable_hits
+from djurk.models import Job
+from djurk.outbox import Dispatcher
+from djurk.stats import SyncStats
+
+logger = logging.getLogger(__name__)
+
+# Seconds a worker waits before looking for jobs again when none are pending
+DEFAULT_INTERVAL = 5
+# Seconds between writes of a running job's progress and heartbeat
+PROGRESS_INTERVAL = 5
+# Seconds without a heartbeat after which a running job is failed
+DEFAULT_LEASE = 2 * 60
+
+
+def _poll_all_hits(job):
+    return update_all_hits().as_dict()
+
+
+def _poll_reviewable_hits(job):
+    return update_reviewable_hits().as_dict()
+
+
+def _update_hit(job):
+    job.hit.update(do_update_assignments=True)
+    return {'status': job.hit.get_status_display()}
+
+
+def _dispose_hit(job):
+    job.hit.dispose()
+    return {'status': job.hit.get_status_display()}
+
+
+def _dispatch_mutations(job):
+    totals = {'confirmed': 0, 'retried': 0, 'failed': 0, 'done': 0}
+
+    def add(counts):
+        for name, value in counts.items():
+            totals[name] += value
+    Dispatcher().run(once=True, callback=add)
+    return totals
+
+
+RUNNERS = {
+    Job.POLL_ALL_HITS: _poll_all_hits,
+    Job.POLL_REVIEWABLE_HITS: _poll_reviewable_hits,
+    Job.UPDATE_HIT: _update_hit,
+    Job.DISPOSE_HIT: _dispose_hit,
+    Job.DISPATCH_MUTATIONS: _dispatch_mutations,
+}
+
+
+def claim_job():
+    """Mark the oldest pending job as running and return it
+
+    Returns None if there are no pending jobs. Its dedup_key is
+    cleared, so the same job can be queued again while it runs.
+    """
+    pending = Job.objects.filter(status=Job.PENDING)
+    while True:
+        pks = list(pending.order_by('pk').values_list('pk', flat=True)[:10])
+        if not pks:
+            return None
+        for pk in pks:
+            now = datetime.datetime.utcnow()
+            # Another worker may have claimed it since it was read
+            if pending.filter(pk=pk).update(
+                    status=Job.RUNNING, dedup_key=None, started=now,
+                    heartbeat=now, progress=u"Started"):
+                return Job.objects.get(pk=pk)
+
+
+def fail_stale_jobs(lease=DEFAULT_LEASE):
+    """Fail the running jobs without a heartbeat for lease seconds
+
+    Their worker was stopped or lost its database connection; the
+    actions can queue them again. Returns the number of jobs failed.
+    """
+    now = datetime.datetime.utcnow()
+    return Job.objects.filter(
+            status=Job.RUNNING,
+            heartbeat__lt=now - datetime.timedelta(seconds=lease)).update(
+                    status=Job.FAILED, finished=now,
+                    error=u"The worker running the job stopped")
+
+
+class _Heartbeat(threading.Thread):
+    """Write a running job's progress and heartbeat periodically"""
+
+    def __init__(self, job, stats, interval=PROGRESS_INTERVAL):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.job = job
+        self.stats = stats
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        try:
+            while not self.stopped.wait(self.interval):
+                # Not if the job was failed as stale meanwhile
+                Job.objects.filter(pk=self.job.pk, status=Job.RUNNING).update(
+                        heartbeat=datetime.datetime.utcnow(),
+                        progress=self.message())
+        except Exception:
+            logger.exception("Writing the progress of %s failed" % self.job)
+        finally:
+            # This thread has its own database connection
+            connection.close()
+
+    def message(self):
+        return u"%d requests made" % self.stats.api_requests
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def run_job(job, interval=PROGRESS_INTERVAL):
+    """Run a claimed job and store its result (or error)
+
+    Its progress and heartbeat are written every interval seconds.
+    Returns True if the job succeeded.
+    """
+    stats = SyncStats()
+    heartbeat = _Heartbeat(job, stats, interval)
+    heartbeat.start()
+    try:
+        with stats.instrument(queries=False):
+            result = RUNNERS[job.kind](job)
+    except Exception:
+        logger.exception("%s failed" % job)
+        heartbeat.stop()
+        _finish(job, status=Job.FAILED, progress=heartbeat.message(),
+                error=traceback.format_exc())
+        return False
+    heartbeat.stop()
+    _finish(job, status=Job.DONE, progress=heartbeat.message(),
+            result=json.dumps(result))
+    return True
+
+
+def _finish(job, **fields):
+    # Not if the job was failed as stale meanwhile
+    if not Job.objects.filter(pk=job.pk, status=Job.RUNNING).update(
+            finished=datetime.datetime.utcnow(), **fields):
+        logger.warning("%s was no longer running when it finished; its "
+                       "outcome (%s) was not stored" % (
+                               job, dict(Job.STATUS_CHOICES)[
+                                       fields['status']]))
+
+
+class Worker(object):
+    """Claim and run jobs on concurrency threads
+
+    With once, each thread stops when there are no pending jobs left;
+    otherwise it looks for new jobs every interval seconds. Before
+    looking, the running jobs without a heartbeat for lease seconds are
+    failed.
+    """
+
+    def __init__(self, concurrency=1, interval=DEFAULT_INTERVAL, once=False,
+                 lease=DEFAULT_LEASE):
+        self.concurrency = concurrency
+        self.interval = interval
+        self.once = once
+        self.lease = lease
+        self.succeeded = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+
+    def work(self):
+        """Run jobs until there are none left (with once)"""
+        while True:
+            failed = fail_stale_jobs(self.lease)
+            if failed:
+                logger.warning("Failed %d jobs left by stopped workers" %
+                               failed)
+            job = claim_job()
+            if job is None:
+                if self.once:
+                    return
+                time.sleep(self.interval)
+                continue
+            logger.info("Running %s" % job)
+            succeeded = run_job(job)
+            with self.lock:
+                if succeeded:
+                    self.succeeded += 1
+                else:
+                    self.failed += 1
+
+    def _work_in_thread(self):
+        try:
+            self.work()
+        finally:
+            # Each thread has its own database connection
+            connection.close()
+
+    def run(self):
+        if self.concurrency == 1:
+            self.work()
+            return
+        threads = [threading.Thread(target=self._work_in_thread)
+                   for _ in range(self.concurrency)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        # Joined with a timeout so that KeyboardInterrupt stops the worker
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(1)
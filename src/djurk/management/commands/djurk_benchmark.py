@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmark Djurk against a seeded fake Mechanical Turk"""
+
+import datetime
+import itertools
+import json
+import platform
+from optparse import make_option
+
+import django
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from djurk.benchmark import SCENARIOS, Benchmark
+from djurk.fake import DEFAULT_REVIEWABLE
+
+
+def _integers(value):
+    return [int(item) for item in value.split(',')]
+
+
+class Command(BaseCommand):
+    help = ('Run the benchmark scenarios (%s) at each combination of the '
+            'given scales, in a test database, and write the results as '
+            'JSON.' % ', '.join(SCENARIOS))
+    option_list = BaseCommand.option_list + (
+        make_option('--hits', dest='hits', default='1000',
+                    help='Comma separated numbers of HITs (default: 1000)'),
+        make_option('--assignments', dest='assignments', default='1',
+                    help='Comma separated numbers of assignments per HIT '
+                         '(default: 1)'),
+        make_option('--answer-fields', dest='answer_fields', default='5',
+                    help='Comma separated numbers of answers per assignment '
+                         '(default: 5)'),
+        make_option('--scenarios', dest='scenarios',
+                    default=','.join(SCENARIOS),
+                    help='Comma separated scenarios to run (default: all)'),
+        make_option('--sample', dest='sample', type='int', default=None,
+                    help='Reviewable HITs the per-HIT scenarios work on '
+                         '(default: all)'),
+        make_option('--reviewable', dest='reviewable', type='float',
+                    default=DEFAULT_REVIEWABLE,
+                    help='Fraction of the HITs that are Reviewable '
+                         '(default: %s)' % DEFAULT_REVIEWABLE),
+        make_option('--latency', dest='latency', type='float', default=0.0,
+                    help='Seconds each Mechanical Turk request takes '
+                         '(default: 0)'),
+        make_option('--output', dest='output', default=None,
+                    help='File to write the JSON results to (default: '
+                         'standard output)'),
+        make_option('--noinput', action='store_false', dest='interactive',
+                    default=True,
+                    help='Delete an existing test database without asking'),
+    )
+
+    def report(self, result):
+        self.stderr.write("%s %s: %.2fs, %d API calls, %d queries, "
+                          "%d rows written\n" % (
+                              result['scenario'],
+                              ' '.join('%s=%s' % item for item in
+                                       sorted(result['scale'].items())),
+                              result['wall_time'], result['api_calls'],
+                              result['queries'], result['rows_written']))
+
+    def handle(self, *args, **options):
+        scenarios = options['scenarios'].split(',')
+        for name in scenarios:
+            if name not in SCENARIOS:
+                raise CommandError("Unknown scenario %s" % name)
+        scales = list(itertools.product(_integers(options['hits']),
+                                        _integers(options['assignments']),
+                                        _integers(options['answer_fields'])))
+
+        connection = connections['default']
+        database_name = connection.settings_dict['NAME']
+        report = {
+            'started': datetime.datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.settings_dict['ENGINE'],
+            'results': [],
+        }
+        connection.creation.create_test_db(
+                verbosity=0, autoclobber=not options['interactive'])
+        try:
+            for hits, assignments, answer_fields in scales:
+                benchmark = Benchmark(hits,
+                                      assignments_per_hit=assignments,
+                                      answer_fields=answer_fields,
+                                      reviewable=options['reviewable'],
+                                      latency=options['latency'],
+                                      sample=options['sample'])
+                report['results'].extend(benchmark.run(
+                        scenarios, callback=self.report))
+                call_command('flush', interactive=False, verbosity=0)
+        finally:
+            connection.creation.destroy_test_db(database_name, verbosity=0)
+
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if options['output'] is None:
+            self.stdout.write(output + '\n')
+        else:
+            with open(options['output'], 'w') as output_file:
+                output_file.write(output + '\n')
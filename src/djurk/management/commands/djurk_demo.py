@@ -11,6 +11,7 @@ from boto.mturk.question import (AnswerSpecification, Overview, Question,
         QuestionContent, QuestionForm, FreeTextAnswer, FormattedContent)
 
 from djurk.common import get_connection, get_worker_url
+from djurk.models import HIT
 
 
 def demo_create_favorite_color_hit():
@@ -70,6 +71,9 @@ def demo_create_favorite_color_hit():
                          duration=DURATION,
                          reward=REWARD_PER_ASSIGNMENT)
 
+    # Keep a local copy of the new HIT
+    HIT(mturk_id=hit[0].HITId).update()
+
     #---------- SHOW A LINK TO THE HIT GROUP -----------
     base = get_worker_url()
 
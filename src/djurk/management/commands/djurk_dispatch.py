@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Send the mutations recorded in the outbox to Mechanical Turk"""
+
+import logging
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from djurk.management.commands.poll_mturk import NullHandler
+from djurk.outbox import (DEFAULT_BATCH_SIZE, DEFAULT_DISPATCH_WORKERS,
+        DEFAULT_INTERVAL, DEFAULT_MAX_ATTEMPTS, Dispatcher)
+
+logging.getLogger("djurk").addHandler(NullHandler())
+
+
+class Command(BaseCommand):
+    help = ('Send the approvals, rejections, bonuses and HIT changes '
+            'recorded in the outbox, retrying the ones that fail with '
+            'backoff. Several dispatchers can run at once.')
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', dest='workers', type='int',
+                    default=DEFAULT_DISPATCH_WORKERS,
+                    help=('Send this many requests at a time (default: %d)'
+                          % DEFAULT_DISPATCH_WORKERS)),
+        make_option('--batch-size', dest='batch_size', type='int',
+                    default=DEFAULT_BATCH_SIZE,
+                    help=('Mutations claimed at a time (default: %d)' %
+                          DEFAULT_BATCH_SIZE)),
+        make_option('--max-attempts', dest='max_attempts', type='int',
+                    default=DEFAULT_MAX_ATTEMPTS,
+                    help=('Give up on a mutation after this many failed '
+                          'attempts (default: %d)' % DEFAULT_MAX_ATTEMPTS)),
+        make_option('--interval', dest='interval', type='float',
+                    default=DEFAULT_INTERVAL,
+                    help=('Seconds to wait before looking for mutations '
+                          'again when none are due (default: %d)' %
+                          DEFAULT_INTERVAL)),
+        make_option('--once', action='store_true', dest='once',
+                    default=False,
+                    help='Stop when no mutations are due'),
+    )
+
+    def handle(self, *args, **options):
+        totals = {'confirmed': 0, 'retried': 0, 'failed': 0, 'done': 0}
+
+        def add(counts):
+            for name, count in counts.items():
+                totals[name] += count
+
+        dispatcher = Dispatcher(workers=options['workers'],
+                                batch_size=options['batch_size'],
+                                max_attempts=options['max_attempts'])
+        dispatcher.run(once=options['once'], interval=options['interval'],
+                       callback=add)
+        self.stdout.write(("%(confirmed)d mutations confirmed, %(retried)d "
+                           "to retry, %(failed)d failed\n") % totals)
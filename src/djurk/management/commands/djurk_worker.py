@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Run the jobs queued by the admin actions"""
+
+import logging
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from djurk.jobs import DEFAULT_INTERVAL, Worker
+from djurk.management.commands.poll_mturk import NullHandler
+
+logging.getLogger("djurk").addHandler(NullHandler())
+
+
+class Command(BaseCommand):
+    help = ('Run the jobs queued by the Djurk admin actions (polling HITs, '
+            'updating and disposing of HITs). Several workers can run at '
+            'once; each job is run by only one.')
+    option_list = BaseCommand.option_list + (
+        make_option('--concurrency', dest='concurrency', type='int',
+                    default=1,
+                    help='Run this many jobs at a time (default: 1)'),
+        make_option('--interval', dest='interval', type='float',
+                    default=DEFAULT_INTERVAL,
+                    help=('Seconds to wait before looking for jobs again '
+                          'when none are pending (default: %d)' %
+                          DEFAULT_INTERVAL)),
+        make_option('--once', action='store_true', dest='once',
+                    default=False,
+                    help='Stop when there are no pending jobs'),
+    )
+
+    def handle(self, *args, **options):
+        worker = Worker(concurrency=options['concurrency'],
+                        interval=options['interval'], once=options['once'])
+        worker.run()
+        if options['once']:
+            self.stdout.write("%d jobs done, %d failed\n" % (
+                    worker.succeeded, worker.failed))
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Export assignments and their answers as CSV, JSON lines or Parquet"""
+
+import datetime
+import json
+import os
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+
+from djurk.export import (DATETIME_FORMAT, DEFAULT_CHUNK_SIZE, answer_keys,
+        iter_results, pyarrow, write_csv, write_jsonl, write_parquet)
+from djurk.models import Assignment
+
+CSV, JSONL, PARQUET = 'csv', 'jsonl', 'parquet'
+WATERMARK_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+# Seconds an assignment written by a synchronization may take to be
+# committed: more recent changes are left for the next export
+DEFAULT_WATERMARK_LAG = 60
+
+
+def _datetime(value):
+    for format in (DATETIME_FORMAT, '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(value, format)
+        except ValueError:
+            pass
+    raise CommandError("Invalid time %s (expected YYYY-MM-DD or "
+                       "YYYY-MM-DDTHH:MM:SS, in UTC)" % value)
+
+
+def read_watermark(path):
+    """Return the time up to which assignments were exported, or None"""
+    if not os.path.exists(path):
+        return None
+    with open(path) as watermark_file:
+        watermark = json.load(watermark_file)
+    if 'synced' not in watermark:
+        raise CommandError("%s keeps the primary key of the last assignment "
+                           "exported, as earlier versions did: remove it to "
+                           "export every assignment again" % path)
+    return datetime.datetime.strptime(watermark['synced'], WATERMARK_FORMAT)
+
+
+def write_watermark(path, synced):
+    """Store the time up to which assignments were exported"""
+    temporary = path + '.tmp'
+    with open(temporary, 'w') as watermark_file:
+        json.dump({
+            'synced': synced.strftime(WATERMARK_FORMAT),
+            'exported': datetime.datetime.utcnow().strftime(DATETIME_FORMAT),
+        }, watermark_file)
+    os.rename(temporary, path)
+
+
+class Command(BaseCommand):
+    help = ('Export assignments, with their HIT and answers, a chunk at a '
+            'time. CSV and Parquet have a column per answer key; JSON lines '
+            'have an "answers" object.')
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', type='choice',
+                    choices=[CSV, JSONL, PARQUET], default=CSV,
+                    help='csv, jsonl or parquet (needs pyarrow) '
+                         '(default: csv)'),
+        make_option('--output', dest='output', default=None,
+                    help='File to write (default: standard output, except '
+                         'for Parquet)'),
+        make_option('--hit-type', dest='hit_types', action='append',
+                    default=[],
+                    help='Only export the assignments of HITs of this type '
+                         '(may be repeated)'),
+        make_option('--status', dest='statuses', action='append',
+                    default=[],
+                    help='Only export Submitted, Approved or Rejected '
+                         'assignments (may be repeated)'),
+        make_option('--submitted-after', dest='submitted_after',
+                    default=None,
+                    help='Only export assignments submitted at or after '
+                         'this UTC time'),
+        make_option('--submitted-before', dest='submitted_before',
+                    default=None,
+                    help='Only export assignments submitted before this '
+                         'UTC time'),
+        make_option('--watermark', dest='watermark', default=None,
+                    help='File keeping track of the exports: only the '
+                         'assignments inserted or changed (by a '
+                         'synchronization, or an approval or rejection '
+                         'sent from the outbox) since the previous export '
+                         'with this file are exported, and the file is '
+                         'updated afterwards'),
+        make_option('--watermark-lag', dest='watermark_lag', type='int',
+                    default=DEFAULT_WATERMARK_LAG,
+                    help='With --watermark, leave the assignments changed '
+                         'less than this many seconds ago, which may not be '
+                         'committed yet, to the next export (default: %d)'
+                         % DEFAULT_WATERMARK_LAG),
+        make_option('--answer-keys', dest='answer_keys', default=None,
+                    help='Comma separated answer keys to make columns of '
+                         '(default: all keys, found with an extra pass)'),
+        make_option('--chunk-size', dest='chunk_size', type='int',
+                    default=DEFAULT_CHUNK_SIZE,
+                    help='Assignments read per query (default: %d)' %
+                         DEFAULT_CHUNK_SIZE),
+    )
+
+    def assignments(self, options, last, until):
+        assignments = Assignment.objects.all()
+        if options['hit_types']:
+            assignments = assignments.filter(
+                    hit__hit_type_id__in=options['hit_types'])
+        if options['statuses']:
+            try:
+                statuses = [Assignment.reverse_status_lookup[status]
+                            for status in options['statuses']]
+            except KeyError as error:
+                raise CommandError("Unknown status %s" % error)
+            assignments = assignments.filter(status__in=statuses)
+        if options['submitted_after']:
+            assignments = assignments.filter(
+                    submit_time__gte=_datetime(options['submitted_after']))
+        if options['submitted_before']:
+            assignments = assignments.filter(
+                    submit_time__lt=_datetime(options['submitted_before']))
+        if options['watermark']:
+            if last is None:
+                # Including the assignments stored before the
+                # synchronization times were
+                assignments = assignments.filter(
+                        Q(synced__lt=until) | Q(synced__isnull=True))
+            else:
+                assignments = assignments.filter(
+                        synced__gte=last, synced__lt=until)
+        return assignments
+
+    def handle(self, *args, **options):
+        format = options['format']
+        if format == PARQUET:
+            if pyarrow is None:
+                raise CommandError("Parquet output needs pyarrow")
+            if options['output'] is None:
+                raise CommandError("Parquet output needs --output")
+
+        last = until = None
+        if options['watermark']:
+            last = read_watermark(options['watermark'])
+            until = datetime.datetime.utcnow() - datetime.timedelta(
+                    seconds=options['watermark_lag'])
+            if last is not None:
+                # A longer lag than last time doesn't move the watermark back
+                until = max(last, until)
+        assignments = self.assignments(options, last, until)
+        chunk_size = options['chunk_size']
+        if options['answer_keys'] is not None:
+            keys = options['answer_keys'].split(',')
+        elif format != JSONL:
+            keys = answer_keys(assignments, chunk_size)
+        results = iter_results(assignments, chunk_size)
+
+        if format == PARQUET:
+            write_parquet(results, options['output'], keys, chunk_size)
+        else:
+            if options['output'] is None:
+                output = sys.stdout
+            else:
+                output = open(options['output'], 'wb')
+            try:
+                if format == CSV:
+                    write_csv(results, output, keys)
+                else:
+                    write_jsonl(results, output)
+            finally:
+                if output is not sys.stdout:
+                    output.close()
+
+        if options['watermark']:
+            write_watermark(options['watermark'], until)
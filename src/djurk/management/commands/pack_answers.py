@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Convert stored answers between KeyValue rows and packed answers"""
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from djurk.common import PACKED_ANSWERS, get_answer_storage
+from djurk.models import Assignment
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+class Command(BaseCommand):
+    help = ('Pack the answers of the assignments stored as Key-Value Pairs '
+            'into one column of each assignment (or, with --unpack, the '
+            'other way around), a batch of assignments per transaction. '
+            'The command can be interrupted and run again.')
+    option_list = BaseCommand.option_list + (
+        make_option('--unpack', action='store_true', dest='unpack',
+                    default=False,
+                    help='Store packed answers as Key-Value Pairs again'),
+        make_option('--batch-size', dest='batch_size', type='int',
+                    default=DEFAULT_BATCH_SIZE,
+                    help=('Assignments converted per transaction '
+                          '(default: %d)' % DEFAULT_BATCH_SIZE)),
+    )
+
+    def handle(self, *args, **options):
+        unpack = options['unpack']
+        storage = get_answer_storage()
+        if (storage == PACKED_ANSWERS) == unpack:
+            self.stderr.write("Warning: DJURK_ANSWER_STORAGE is %s, so "
+                              "changed assignments will be stored as "
+                              "before the conversion when they are next "
+                              "synchronized\n" % storage)
+
+        assignments = Assignment.objects.filter(
+                packed_answers__isnull=not unpack).order_by('pk')
+        converted = 0
+        last = None
+        while True:
+            batch = assignments
+            if last is not None:
+                batch = batch.filter(pk__gt=last)
+            pks = list(batch.values_list('pk', flat=True)[
+                    :options['batch_size']])
+            if not pks:
+                break
+            with transaction.commit_on_success():
+                if unpack:
+                    Assignment.objects.unpack_answers(pks)
+                else:
+                    Assignment.objects.pack_answers(pks)
+            converted += len(pks)
+            last = pks[-1]
+            if int(options['verbosity']) > 1:
+                self.stdout.write("%d assignments converted\n" % converted)
+        self.stdout.write("%d assignments %s\n" % (
+                converted, unpack and "unpacked" or "packed"))
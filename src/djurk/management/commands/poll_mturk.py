@@ -3,16 +3,22 @@
 
 """Cron job to constantly poll Amazon Mechanical Turk"""
 
+import functools
+import json
 import logging
 import time
 from optparse import make_option
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
-from djurk.common import get_connection
-from djurk.helpers import update_all_hits, update_reviewable_hits
+from djurk.common import get_rate_limiter, get_response_cache
+from djurk.engine import DEFAULT_CONCURRENCY, PipelinedSync
+from djurk.helpers import (ALL_HITS, PROCESS, REVIEWABLE_HITS, THREAD,
+        update_all_hits, update_reviewable_hits)
+from djurk.scheduler import PollScheduler
 
 SLEEP_TIME = 5 * 60  # 5 minutes
+HELPERS_ENGINE, PIPELINED_ENGINE = 'helpers', 'pipelined'
 
 
 class NullHandler(logging.Handler):
@@ -29,7 +35,32 @@ class NullHandler(logging.Handler):
     def emit(self, record):
         pass
 
-logger = logging.getLogger("djurk").addHandler(NullHandler())
+logging.getLogger("djurk").addHandler(NullHandler())
+logger = logging.getLogger(__name__)
+
+
+def log_cycle(stats, stats_file=None):
+    """Log a summary of a cycle, and append its statistics to stats_file
+
+    stats_file, if given, is the name of a file to which the statistics
+    are appended as one line of JSON.
+    """
+    logger.info("Cycle finished: %s" % stats)
+    if stats.api_calls:
+        logger.info("Requests: %s" % stats.requests_summary())
+    logger.info(("Rate limit: %(rate).1f of %(max_rate).1f requests/s, "
+                 "%(throttles)d throttled, %(average_wait).3fs average "
+                 "wait") % get_rate_limiter().status())
+    response_cache = get_response_cache()
+    if response_cache is not None:
+        logger.info(("Response cache: %(size)d entries, %(hits)d hits, "
+                     "%(misses)d misses, %(coalesced)d coalesced") %
+                    response_cache.status())
+    if stats_file is not None:
+        record = stats.as_dict()
+        record['finished'] = time.time()
+        with open(stats_file, 'a') as output:
+            output.write(json.dumps(record, sort_keys=True) + '\n')
 
 
 class Command(BaseCommand):
@@ -53,24 +84,110 @@ class Command(BaseCommand):
             dest='loop',
             default=False,
             help='Use Amazon Mechanical Turk Sandbox (instead of production)'),
+        make_option(
+            '--batch-size',
+            action='store',
+            type='int',
+            dest='batch_size',
+            default=None,
+            help=('Synchronize HITs this many at a time with bulk database '
+                  'writes (default: one HIT at a time)')),
+        make_option(
+            '--workers',
+            action='store',
+            type='int',
+            dest='workers',
+            default=None,
+            help=('Update pages of HITs concurrently with this many workers '
+                  '(default: update serially)')),
+        make_option(
+            '--mode',
+            action='store',
+            type='choice',
+            choices=[THREAD, PROCESS],
+            dest='mode',
+            default=THREAD,
+            help='Run --workers as threads or processes (default: thread)'),
+        make_option(
+            '--engine',
+            action='store',
+            type='choice',
+            choices=[HELPERS_ENGINE, PIPELINED_ENGINE],
+            dest='engine',
+            default=HELPERS_ENGINE,
+            help=('Synchronize with the djurk.helpers functions or with the '
+                  'pipelined engine, which overlaps requests and database '
+                  'writes (--workers sets its concurrency)')),
+        make_option(
+            '--adaptive',
+            action='store_true',
+            dest='adaptive',
+            default=False,
+            help=('Poll each HIT when it is due, based upon its status and '
+                  'deadlines, instead of polling everything every %d '
+                  'seconds (implies --loop)' % SLEEP_TIME)),
+        make_option(
+            '--stats-file',
+            action='store',
+            dest='stats_file',
+            default=None,
+            help=('Append the statistics of each cycle (requests by '
+                  'operation and their latency, queries, rows written) '
+                  'to this file, as one line of JSON')),
     )
 
     def handle(self, *args, **options):
-        mtc = get_connection()
         do_update_assignments = options['do_update_assignments']
+        sync_options = {
+            'do_update_assignments': do_update_assignments,
+            'batch_size': options['batch_size'],
+            'workers': options['workers'],
+            'mode': options['mode'],
+        }
+        callback = functools.partial(log_cycle,
+                                     stats_file=options['stats_file'])
+
+        if options['adaptive']:
+            ignored = [name for name, option in (
+                    ('--reviewable', 'reviewable'),
+                    ('--batch-size', 'batch_size'),
+                    ('--workers', 'workers'),
+                    ) if options[option]]
+            if options['engine'] != HELPERS_ENGINE:
+                ignored.append('--engine')
+            if options['mode'] != THREAD:
+                ignored.append('--mode')
+            if ignored:
+                raise CommandError("--adaptive can't be used with %s" %
+                                   ", ".join(ignored))
+            logger.info(("Polling HITs as they become due with "
+                         "Assignments: %s") % do_update_assignments)
+            scheduler = PollScheduler(
+                    do_update_assignments=do_update_assignments)
+            scheduler.run_forever(callback=callback)
+            return
 
         while True:
-            if options['reviewable']:
-                logging.info(("Updating Reviewable HITs with "
-                              "Assignments: %s") % do_update_assignments)
-                update_reviewable_hits(
-                        do_update_assignments=do_update_assignments)
+            if options['engine'] == PIPELINED_ENGINE:
+                source = REVIEWABLE_HITS if options['reviewable'] else ALL_HITS
+                logger.info(("Updating %s HITs (pipelined) with "
+                             "Assignments: %s") % (source,
+                                                   do_update_assignments))
+                engine = PipelinedSync(
+                        source=source,
+                        do_update_assignments=do_update_assignments,
+                        concurrency=options['workers'] or DEFAULT_CONCURRENCY)
+                stats = engine.run()
+            elif options['reviewable']:
+                logger.info(("Updating Reviewable HITs with "
+                             "Assignments: %s") % do_update_assignments)
+                stats = update_reviewable_hits(**sync_options)
             else:
-                logging.info(("Updating All HITs with "
-                              "Assignments: %s") % do_update_assignments)
-                update_all_hits(
-                        do_update_assignments=do_update_assignments)
-            logging.info("Sleeping")
+                logger.info(("Updating All HITs with "
+                             "Assignments: %s") % do_update_assignments)
+                stats = update_all_hits(**sync_options)
+            callback(stats)
+            logger.info("Sleeping")
             if not options['loop']:
                 break
             time.sleep(SLEEP_TIME)
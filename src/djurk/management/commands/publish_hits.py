@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Publish a HIT for each row of a CSV file"""
+
+import csv
+import datetime
+import logging
+import os
+import urllib
+from optparse import make_option
+from xml.sax.saxutils import escape
+
+from boto.mturk.question import ExternalQuestion
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+
+from djurk.models import HIT
+from djurk.publish import DEFAULT_PUBLISH_WORKERS, HITTemplate
+from djurk.question import QuestionTemplate
+
+
+def read_rows(filename, encoding='utf-8'):
+    """Yield the rows of a CSV file (with a header line) as dictionaries"""
+    with open(filename, 'rb') as csv_file:
+        for row in csv.DictReader(csv_file):
+            yield dict((key.decode(encoding), value.decode(encoding))
+                       for key, value in row.items())
+
+
+def external_question(url, frame_height):
+    """Return a question function for HITTemplate
+
+    {column} fields in url are replaced with the row's (URL quoted)
+    values.
+    """
+    def question(row):
+        values = dict((key, urllib.quote(unicode(value).encode('utf-8')))
+                      for key, value in row.items()
+                      if key != 'attached_object')
+        return ExternalQuestion(escape(url.format(**values)), frame_height)
+    return question
+
+
+class Command(BaseCommand):
+    args = '<csv file>'
+    help = ('Create a HIT for each row of a CSV file. Running the command '
+            'again with the same file and --batch resumes publishing '
+            'without creating any HIT twice.')
+    option_list = BaseCommand.option_list + (
+        make_option('--title', dest='title', help='HIT title (required)'),
+        make_option('--description', dest='description',
+                    help='HIT description (required)'),
+        make_option('--reward', dest='reward', type='float',
+                    help='Reward per assignment, in USD (required)'),
+        make_option('--keywords', dest='keywords', default=None,
+                    help='Comma separated keywords'),
+        make_option('--external-url', dest='external_url',
+                    help=('URL of the question, in which {column} is '
+                          'replaced with the value of column')),
+        make_option('--question-file', dest='question_file',
+                    help=('File with the QuestionForm XML, in which '
+                          '${column} is replaced with the value of column '
+                          '(one of --external-url or --question-file is '
+                          'required)')),
+        make_option('--frame-height', dest='frame_height', type='int',
+                    default=600,
+                    help='Height of the question frame (default: 600)'),
+        make_option('--duration', dest='duration', type='int',
+                    default=60 * 60,
+                    help='Seconds to complete an assignment (default: 3600)'),
+        make_option('--lifetime', dest='lifetime', type='int',
+                    default=7 * 24 * 60 * 60,
+                    help='Seconds the HITs are available (default: 7 days)'),
+        make_option('--max-assignments', dest='max_assignments', type='int',
+                    default=1, help='Assignments per HIT (default: 1)'),
+        make_option('--approval-delay', dest='approval_delay', type='int',
+                    default=None,
+                    help='Seconds before submitted work is auto-approved'),
+        make_option('--batch', dest='batch', default=None,
+                    help='Name of the batch (default: the CSV file name)'),
+        make_option('--content-type', dest='content_type', default=None,
+                    help=('app_label.model of the objects to attach to the '
+                          'HITs, whose primary keys are in the '
+                          '--content-id-column column')),
+        make_option('--content-id-column', dest='content_id_column',
+                    default='id',
+                    help='Column of the attached objects (default: id)'),
+        make_option('--workers', dest='workers', type='int',
+                    default=DEFAULT_PUBLISH_WORKERS,
+                    help=('Concurrent CreateHIT requests (default: %d)' %
+                          DEFAULT_PUBLISH_WORKERS)),
+    )
+
+    def rows(self, filename, options):
+        if options['content_type'] is None:
+            return read_rows(filename)
+
+        app_label, model = options['content_type'].split('.')
+        model_class = ContentType.objects.get(
+                app_label=app_label, model=model.lower()).model_class()
+        column = options['content_id_column']
+
+        def rows_with_objects():
+            for row in read_rows(filename):
+                row['attached_object'] = model_class.objects.get(
+                        pk=row[column])
+                yield row
+        return rows_with_objects()
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give the name of one CSV file")
+        for option in ('title', 'description', 'reward'):
+            if options[option] is None:
+                raise CommandError("--%s is required" % option)
+        filename = args[0]
+        approval_delay = options['approval_delay']
+
+        if options['question_file'] is not None:
+            with open(options['question_file']) as question_file:
+                question = QuestionTemplate.from_xml(question_file.read())
+        elif options['external_url'] is not None:
+            question = external_question(options['external_url'],
+                                         options['frame_height'])
+        else:
+            raise CommandError("Either --external-url or --question-file "
+                               "is required")
+
+        template = HITTemplate(
+                title=options['title'],
+                description=options['description'],
+                reward=options['reward'],
+                question=question,
+                batch=options['batch'] or os.path.basename(filename),
+                keywords=options['keywords'],
+                duration=datetime.timedelta(seconds=options['duration']),
+                lifetime=datetime.timedelta(seconds=options['lifetime']),
+                max_assignments=options['max_assignments'],
+                approval_delay=approval_delay and datetime.timedelta(
+                        seconds=approval_delay))
+        counts = HIT.objects.publish_batch(template,
+                                           self.rows(filename, options),
+                                           workers=options['workers'])
+        logging.info("Published HITs of type %s: %s" % (template.hit_type_id,
+                                                         counts))
+        self.stdout.write("%(created)d HITs created, %(recovered)d "
+                          "recovered, %(skipped)d already published, "
+                          "%(failed)d failed\n" % counts)
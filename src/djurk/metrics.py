@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Metrics of Djurk's synchronization, for monitoring systems
+
+Each process that synchronizes with Mechanical Turk (poll_mturk,
+djurk_worker...) collects the requests it makes and the syncs it
+finishes, through djurk.signals, into its process-wide SyncMetrics.
+The receivers are connected by connect_receivers(), which
+djurk.common.ConnectionPool calls when it makes a connection, so only
+the processes that talk to Mechanical Turk collect metrics. After each
+sync a snapshot of them is stored in Django's cache, under a key of its
+own (by host and process ID). The djurk.views.metrics view adds up the
+snapshots of all the processes and serves them along with aggregates
+of the database, in the Prometheus text exposition format.
+
+The processes and the web server only share the snapshots if they
+share a cache backend (memcached, the database or files, but not the
+default local memory cache).
+"""
+
+import calendar
+import os
+import socket
+import threading
+import time
+
+from django.core.cache import cache
+
+from djurk.signals import mturk_request, sync_finished
+from djurk.stats import SyncStats
+from djurk.throttle import is_throttling_error
+
+SNAPSHOT_CACHE_KEY = 'djurk.metrics.snapshot'
+# The keys of the snapshots of the processes
+SNAPSHOT_INDEX_CACHE_KEY = 'djurk.metrics.snapshots'
+AGGREGATES_CACHE_KEY = 'djurk.metrics.aggregates'
+# Seconds a snapshot is kept once its process stops updating it
+SNAPSHOT_TIMEOUT = 24 * 60 * 60
+# Seconds the database aggregates are reused for
+DEFAULT_AGGREGATES_TIMEOUT = 60
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def timestamp(value):
+    """Return the Unix time of a naive UTC datetime, or None"""
+    if value is None:
+        return None
+    return calendar.timegm(value.utctimetuple())
+
+
+class SyncMetrics(object):
+    """Cumulative request and sync statistics of this process"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Requests by operation, with their latency histograms
+        self.requests = SyncStats()
+        self.throttled = {}
+        # By source of the syncs
+        self.syncs = {}
+        self.last_sync = {}
+        self.last_success = {}
+        self.last_duration = {}
+        self.last_errors = {}
+
+    def record_request(self, operation, duration, error=None):
+        self.requests.record_request(operation, duration, error)
+        if error is not None and is_throttling_error(error):
+            with self.lock:
+                self.throttled[operation] = self.throttled.get(
+                        operation, 0) + 1
+
+    def record_sync(self, source, stats, finished=None):
+        if finished is None:
+            finished = time.time()
+        with self.lock:
+            self.syncs[source] = self.syncs.get(source, 0) + 1
+            self.last_sync[source] = finished
+            self.last_duration[source] = stats.duration
+            self.last_errors[source] = stats.errors
+            if not stats.errors:
+                self.last_success[source] = finished
+
+    def snapshot(self):
+        """Return the metrics as a dictionary of plain values"""
+        with self.lock:
+            snapshot = {
+                'host': socket.gethostname(),
+                'pid': os.getpid(),
+                'updated': time.time(),
+                'throttled': dict(self.throttled),
+                'syncs': dict(self.syncs),
+                'last_sync': dict(self.last_sync),
+                'last_success': dict(self.last_success),
+                'last_duration': dict(self.last_duration),
+                'last_errors': dict(self.last_errors),
+            }
+        requests = self.requests.as_dict()
+        for name in ('api_calls', 'api_errors', 'api_time', 'api_latency'):
+            snapshot[name] = requests[name]
+        return snapshot
+
+
+sync_metrics = SyncMetrics()
+
+
+def _record_request(sender, operation, duration, error, **kwargs):
+    sync_metrics.record_request(operation, duration, error)
+
+
+def snapshot_key(host=None, pid=None):
+    """Return the cache key of the snapshot of a process (this one)"""
+    return '%s.%s.%d' % (SNAPSHOT_CACHE_KEY, host or socket.gethostname(),
+                         pid or os.getpid())
+
+
+def store_snapshot(snapshot):
+    """Store the snapshot of a process and list it in the index"""
+    key = snapshot_key(snapshot['host'], snapshot['pid'])
+    cache.set(key, snapshot, SNAPSHOT_TIMEOUT)
+    # Another process may be adding itself at the same time, and be
+    # lost from the index; each adds itself back after every sync
+    keys = cache.get(SNAPSHOT_INDEX_CACHE_KEY) or []
+    if key not in keys:
+        cache.set(SNAPSHOT_INDEX_CACHE_KEY, keys + [key], SNAPSHOT_TIMEOUT)
+
+
+def read_snapshots():
+    """Return the stored snapshots of the processes"""
+    keys = cache.get(SNAPSHOT_INDEX_CACHE_KEY) or []
+    snapshots = cache.get_many(keys)
+    if len(snapshots) < len(keys):
+        # Drop the processes whose snapshots expired
+        cache.set(SNAPSHOT_INDEX_CACHE_KEY, [key for key in keys
+                                             if key in snapshots],
+                  SNAPSHOT_TIMEOUT)
+    return [snapshots[key] for key in keys if key in snapshots]
+
+
+def _add(total, values):
+    for key, value in values.items():
+        total[key] = total.get(key, 0) + value
+
+
+def merge_snapshots(snapshots):
+    """Return one snapshot adding up those of several processes
+
+    The counters and histograms are summed. The last sync of a source
+    is the latest of the processes, along with its duration and errors.
+    Returns None if there are no snapshots.
+    """
+    if not snapshots:
+        return None
+    merged = {
+        'processes': len(snapshots),
+        'updated': max(snapshot['updated'] for snapshot in snapshots),
+        'last_sync': {},
+        'last_success': {},
+        'last_duration': {},
+        'last_errors': {},
+        'api_latency': {},
+    }
+    for name in ('api_calls', 'api_errors', 'api_time', 'throttled',
+                 'syncs'):
+        merged[name] = {}
+        for snapshot in snapshots:
+            _add(merged[name], snapshot[name])
+    for snapshot in snapshots:
+        for operation, histogram in snapshot['api_latency'].items():
+            total = merged['api_latency'].setdefault(operation, {
+                'buckets': histogram['buckets'],
+                'counts': [0] * len(histogram['counts']),
+            })
+            for bucket, count in enumerate(histogram['counts']):
+                total['counts'][bucket] += count
+        for source, finished in snapshot['last_sync'].items():
+            if finished > merged['last_sync'].get(source, 0):
+                merged['last_sync'][source] = finished
+                merged['last_duration'][source] = snapshot[
+                        'last_duration'][source]
+                merged['last_errors'][source] = snapshot[
+                        'last_errors'][source]
+        for source, finished in snapshot['last_success'].items():
+            merged['last_success'][source] = max(
+                    finished, merged['last_success'].get(source, 0))
+    return merged
+
+
+def _record_sync(sender, source, stats, **kwargs):
+    sync_metrics.record_sync(source, stats)
+    store_snapshot(sync_metrics.snapshot())
+
+
+def connect_receivers():
+    """Collect the requests and syncs of this process into sync_metrics
+
+    Connecting them again does nothing.
+    """
+    mturk_request.connect(_record_request, dispatch_uid='djurk.metrics')
+    sync_finished.connect(_record_sync, dispatch_uid='djurk.metrics')
+
+
+def _escape(value):
+    return unicode(value).replace(u'\\', u'\\\\').replace(
+            u'"', u'\\"').replace(u'\n', u'\\n')
+
+
+class _Exposition(object):
+    """Lines of the text exposition format"""
+
+    def __init__(self):
+        self.lines = []
+
+    def family(self, name, kind, help_text):
+        self.lines.append(u'# HELP %s %s' % (name, help_text))
+        self.lines.append(u'# TYPE %s %s' % (name, kind))
+
+    def sample(self, name, value, **labels):
+        if value is None:
+            return
+        if labels:
+            name = u'%s{%s}' % (name, u','.join(
+                    u'%s="%s"' % (key, _escape(labels[key]))
+                    for key in sorted(labels)))
+        self.lines.append(u'%s %s' % (name, repr(float(value))))
+
+    def by_label(self, name, kind, help_text, label, values):
+        self.family(name, kind, help_text)
+        for key in sorted(values):
+            self.sample(name, values[key], **{label: key})
+
+    def render(self):
+        return u'\n'.join(self.lines) + u'\n'
+
+
+def render_metrics(aggregates, snapshot=None, now=None):
+    """Return the metrics in the text exposition format
+
+    aggregates is the dictionary made by djurk.views.database_aggregates()
+    and snapshot one made by merge_snapshots() (None if no sync was
+    reported). The ages are computed as of now.
+    """
+    if now is None:
+        now = time.time()
+    output = _Exposition()
+
+    output.family('djurk_hits', 'gauge',
+                  'HITs by status and review status.')
+    for (status, review_status), count in sorted(
+            aggregates['hits'].items()):
+        output.sample('djurk_hits', count, status=status,
+                      review_status=review_status)
+    output.by_label('djurk_assignments', 'gauge',
+                    'Assignments by status.', 'status',
+                    aggregates['assignments'])
+    output.family('djurk_oldest_submitted_assignment_age_seconds', 'gauge',
+                  'Age of the oldest assignment waiting for review.')
+    oldest = aggregates['oldest_submit_time']
+    if oldest is not None:
+        output.sample('djurk_oldest_submitted_assignment_age_seconds',
+                      now - oldest)
+    output.family('djurk_next_auto_approval_seconds', 'gauge',
+                  'Time until a submitted assignment is approved '
+                  'automatically (negative when overdue).')
+    next_approval = aggregates['next_auto_approval_time']
+    if next_approval is not None:
+        output.sample('djurk_next_auto_approval_seconds',
+                      next_approval - now)
+    output.family('djurk_aggregates_age_seconds', 'gauge',
+                  'Age of the database aggregates.')
+    output.sample('djurk_aggregates_age_seconds',
+                  now - aggregates['computed'])
+
+    if snapshot is None:
+        return output.render()
+
+    output.by_label('djurk_mturk_requests_total', 'counter',
+                    'Mechanical Turk requests, by operation.', 'operation',
+                    snapshot['api_calls'])
+    output.by_label('djurk_mturk_request_errors_total', 'counter',
+                    'Failed Mechanical Turk requests, by operation.',
+                    'operation', snapshot['api_errors'])
+    output.by_label('djurk_mturk_throttled_total', 'counter',
+                    'Mechanical Turk requests refused for exceeding the '
+                    'rate limit, by operation.', 'operation',
+                    snapshot['throttled'])
+    name = 'djurk_mturk_request_duration_seconds'
+    output.family(name, 'histogram',
+                  'Duration of Mechanical Turk requests, by operation.')
+    for operation, histogram in sorted(snapshot['api_latency'].items()):
+        total = 0
+        bounds = [repr(bound) for bound in histogram['buckets']] + ['+Inf']
+        for bound, count in zip(bounds, histogram['counts']):
+            total += count
+            output.sample(name + '_bucket', total, operation=operation,
+                          le=bound)
+        output.sample(name + '_sum', snapshot['api_time'][operation],
+                      operation=operation)
+        output.sample(name + '_count', total, operation=operation)
+
+    output.by_label('djurk_syncs_total', 'counter',
+                    'Finished synchronizations, by source.', 'source',
+                    snapshot['syncs'])
+    output.by_label('djurk_last_sync_timestamp_seconds', 'gauge',
+                    'When the last synchronization finished.', 'source',
+                    snapshot['last_sync'])
+    output.by_label('djurk_last_successful_sync_timestamp_seconds', 'gauge',
+                    'When the last synchronization without errors '
+                    'finished.', 'source', snapshot['last_success'])
+    output.by_label('djurk_last_sync_duration_seconds', 'gauge',
+                    'Duration of the last synchronization.', 'source',
+                    snapshot['last_duration'])
+    output.by_label('djurk_last_sync_errors', 'gauge',
+                    'Errors during the last synchronization.', 'source',
+                    snapshot['last_errors'])
+    output.family('djurk_metrics_snapshot_age_seconds', 'gauge',
+                  'Age of the synchronization metrics.')
+    output.sample('djurk_metrics_snapshot_age_seconds',
+                  now - snapshot['updated'])
+    output.family('djurk_metrics_processes', 'gauge',
+                  'Processes whose synchronization metrics are added up.')
+    output.sample('djurk_metrics_processes', snapshot['processes'])
+    return output.render()
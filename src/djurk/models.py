@@ -22,25 +22,287 @@ empty string are redundant. As the API does return nullable data types,
 we broke with Django convention on that point.
 """
 
+import datetime
+import decimal
+import hashlib
+import itertools
+import json
+import logging
+import uuid
+from multiprocessing.pool import ThreadPool
+
 import boto
 from django.contrib.contenttypes import generic
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
-from django.db.models.signals import pre_init
+from django.db import models, transaction
+
+from djurk.common import (DEFAULT_FETCH_WORKERS, MAX_PAGE_SIZE,
+        PACKED_ANSWERS, amazon_string_to_datetime, get_answer_storage,
+        iter_pages, pooled_connection)
+from djurk.publish import DEFAULT_PUBLISH_WORKERS, is_duplicate_request
+
+logger = logging.getLogger(__name__)
+
+# How long Mechanical Turk remembers a UniqueRequestToken: a bonus or
+# extension sent again after that may be made twice
+TOKEN_LIFETIME = datetime.timedelta(hours=24)
+
+
+def _hit_fields(mturk_hit):
+    """Return HIT model field values from a Boto HIT object"""
+
+    fields = {
+        'status': HIT.reverse_status_lookup[mturk_hit.HITStatus],
+        'reward': mturk_hit.Amount,
+        'assignment_duration_in_seconds':
+                mturk_hit.AssignmentDurationInSeconds,
+        'auto_approval_delay_in_seconds':
+                mturk_hit.AutoApprovalDelayInSeconds,
+        'max_assignments': mturk_hit.MaxAssignments,
+        'creation_time': amazon_string_to_datetime(mturk_hit.CreationTime),
+        'description': mturk_hit.Description,
+        'title': mturk_hit.Title,
+        'hit_type_id': mturk_hit.HITTypeId,
+        'keywords': mturk_hit.Keywords,
+    }
+    if hasattr(mturk_hit, 'NumberOfAssignmentsCompleted'):
+        fields['number_of_assignments_completed'] =\
+                mturk_hit.NumberOfAssignmentsCompleted
+    if hasattr(mturk_hit, 'NumberOfAssignmentsAvailable'):
+        fields['number_of_assignments_available'] =\
+                mturk_hit.NumberOfAssignmentsAvailable
+    if hasattr(mturk_hit, 'NumberOfAssignmentsPending'):
+        fields['number_of_assignments_pending'] =\
+                mturk_hit.NumberOfAssignmentsPending
+    if hasattr(mturk_hit, 'RequesterAnnotation'):
+        fields['requester_annotation'] = mturk_hit.RequesterAnnotation
+    if hasattr(mturk_hit, 'Expiration'):
+        # Keep the expiration as the lifetime the HIT was created with
+        lifetime = (amazon_string_to_datetime(mturk_hit.Expiration) -
+                    fields['creation_time'])
+        fields['lifetime_in_seconds'] = max(
+                lifetime.days * 86400 + lifetime.seconds, 0)
+    #'CurrencyCode', 'Reward', 'expired']
+
+    # Boto returns strings. Convert them so they compare equal to the
+    # values loaded from the database.
+    return dict((name, HIT._meta.get_field(name).to_python(value))
+                for name, value in fields.items())
+
+
+def _fingerprint(*values):
+    """Return a digest of remote data, to tell whether it has changed
+
+    The values are field dictionaries as returned by _hit_fields(),
+    _assignment_fields() and _answer_fields().
+    """
+    return hashlib.sha1(repr([sorted(value.items()) for value in values])
+                        ).hexdigest()
+
 
-from djurk.common import amazon_string_to_datetime, get_connection
+def _changed_fields(row, fields):
+    """Return the items of fields that differ from the stored row"""
+    return dict((name, value) for name, value in fields.items()
+                if row[name] != value)
 
 
-def init_connection_callback(sender, **signal_args):
-    """Mechanical Turk connection signal callback
+def _save_remote_fields(instance, fields, fingerprint):
+    """Copy remote field values onto a HIT or Assignment and store them
 
-    By using Django pre-init signals, class level connections can be
-    made available to Django models that configure this pre-init
-    signal.
+    Nothing is written if the instance was last updated from the same
+    remote data, as told by its fingerprint. Otherwise only the changed
+    columns of an existing row are written. Returns True if anything was
+    written.
     """
-    sender.args = sender
-    object_args = signal_args['kwargs']
-    sender.connection = get_connection()
+    if instance.pk is not None and instance.mturk_fingerprint == fingerprint:
+        return False
+
+    changed = dict((name, value) for name, value in fields.items()
+                   if getattr(instance, name) != value)
+    for name, value in changed.items():
+        setattr(instance, name, value)
+    instance.mturk_fingerprint = fingerprint
+    if instance.pk is None:
+        instance.save()
+    else:
+        type(instance).objects.filter(pk=instance.pk).update(
+                mturk_fingerprint=fingerprint, **changed)
+    return True
+
+
+class HITManager(models.Manager):
+    def sync_from_mturk(self, mturk_hits):
+        """Insert or update HITs from a list of Boto HIT objects
+
+        Existing HITs are looked up with a single query that only reads
+        their fingerprints, a digest of the remote data they were last
+        updated from. HITs whose fingerprint matches are left alone;
+        the others are loaded and only their changed columns are
+        written. New HITs are inserted with bulk_create(). Boto HIT
+        objects without HIT details (such as the ones returned by
+        GetReviewableHITs) are fetched first.
+
+        The caller controls the transaction; the helpers commit once per
+        batch. A dictionary counting the 'inserted', 'updated' and
+        'unchanged' HITs, and the 'columns_written' to update them, is
+        returned.
+        """
+        remote = {}
+        missing_details = []
+        for mturk_hit in mturk_hits:
+            if hasattr(mturk_hit, 'HITStatus'):
+                remote[mturk_hit.HITId] = _hit_fields(mturk_hit)
+            else:
+                missing_details.append(mturk_hit.HITId)
+        if missing_details:
+            with pooled_connection() as connection:
+                for mturk_id in missing_details:
+                    mturk_hit = connection.get_hit(mturk_id)[0]
+                    remote[mturk_id] = _hit_fields(mturk_hit)
+
+        counts = {'inserted': 0, 'updated': 0, 'unchanged': 0,
+                  'columns_written': 0}
+        if not remote:
+            return counts
+        fingerprints = dict((mturk_id, _fingerprint(fields))
+                            for mturk_id, fields in remote.items())
+        stored = dict(self.filter(mturk_id__in=remote.keys()).values_list(
+                'mturk_id', 'mturk_fingerprint'))
+        changed_ids = [mturk_id for mturk_id, fingerprint in stored.items()
+                       if fingerprint != fingerprints[mturk_id]]
+        counts['unchanged'] = len(stored) - len(changed_ids)
+
+        if changed_ids:
+            rows = self.filter(mturk_id__in=changed_ids).values(
+                    'pk', 'mturk_id', *HIT_SYNCED_FIELDS)
+            for row in rows:
+                changed = _changed_fields(row, remote[row['mturk_id']])
+                counts['columns_written'] += len(changed)
+                self.filter(pk=row['pk']).update(
+                        mturk_fingerprint=fingerprints[row['mturk_id']],
+                        **changed)
+                counts['updated'] += 1
+
+        new = [HIT(mturk_id=mturk_id, mturk_fingerprint=fingerprints[mturk_id],
+                   **fields)
+               for mturk_id, fields in remote.items()
+               if mturk_id not in stored]
+        self.bulk_create(new)
+        counts['inserted'] = len(new)
+        return counts
+
+    def _store_published(self, token, mturk_hit):
+        fields = {'mturk_id': mturk_hit.HITId}
+        if hasattr(mturk_hit, 'HITStatus'):
+            fields.update(_hit_fields(mturk_hit))
+            fields['mturk_fingerprint'] = _fingerprint(_hit_fields(mturk_hit))
+        else:
+            fields['creation_time'] = datetime.datetime.utcnow()
+        self.filter(publish_token=token).update(**fields)
+
+    def _recover_published(self, tokens):
+        """Find HITs published before a crash by their annotation
+
+        Returns the number of tokens whose HIT was found.
+        """
+        tokens = set(tokens)
+        found = 0
+
+        def fetch_page(page_number, page_size):
+            with pooled_connection() as connection:
+                return connection.search_hits(page_size=page_size,
+                                              page_number=page_number)
+
+        for page in iter_pages(fetch_page):
+            with transaction.commit_on_success():
+                for mturk_hit in page:
+                    token = getattr(mturk_hit, 'RequesterAnnotation', None)
+                    if token in tokens:
+                        self._store_published(token, mturk_hit)
+                        tokens.discard(token)
+                        found += 1
+            if not tokens:
+                break
+        return found
+
+    def publish_batch(self, template, rows, workers=DEFAULT_PUBLISH_WORKERS,
+                      chunk_size=MAX_PAGE_SIZE):
+        """Create a HIT on Mechanical Turk for each of rows
+
+        template is a djurk.publish.HITTemplate. Its HIT type is
+        registered once. Then, chunk_size rows at a time, the HIT rows
+        are inserted with bulk_create(), the HITs are created by up to
+        workers concurrent (rate limited) requests, and the rows are
+        updated from the results in one transaction.
+
+        Publishing is idempotent: rows whose HIT was already published
+        (found by their indexed publish_token) are skipped, and the
+        token is also sent as the requester annotation and the
+        UniqueRequestToken. If Mechanical Turk reports that a HIT was
+        created but the process stopped before storing it, the HIT is
+        found again by searching the HITs for its annotation.
+
+        A dictionary counting the HITs 'created', 'recovered', 'skipped'
+        (already published) and 'failed' is returned.
+        """
+        with pooled_connection() as connection:
+            template.register(connection)
+        hit_fields = template.hit_fields()
+        counts = {'created': 0, 'recovered': 0, 'skipped': 0, 'failed': 0}
+        duplicates = []
+
+        def create(item):
+            token, row = item
+            try:
+                with pooled_connection() as connection:
+                    return token, template.create_hit(connection, row, token)
+            except Exception as error:
+                return token, error
+
+        pool = ThreadPool(workers)
+        try:
+            rows = iter(rows)
+            while True:
+                chunk = dict((template.token(row), row)
+                             for row in itertools.islice(rows, chunk_size))
+                if not chunk:
+                    break
+                stored = dict(self.filter(
+                        publish_token__in=chunk.keys()).values_list(
+                        'publish_token', 'mturk_id'))
+                new = []
+                for token, row in chunk.items():
+                    if token in stored:
+                        continue
+                    hit = HIT(publish_token=token,
+                              requester_annotation=token, **hit_fields)
+                    hit.attached_object = template.attached_object(row)
+                    new.append(hit)
+                self.bulk_create(new)
+
+                pending = [(token, row) for token, row in chunk.items()
+                           if stored.get(token) is None]
+                counts['skipped'] += len(chunk) - len(pending)
+                with transaction.commit_on_success():
+                    for token, result in pool.imap_unordered(create,
+                                                             pending):
+                        if not isinstance(result, Exception):
+                            self._store_published(token, result)
+                            counts['created'] += 1
+                        elif is_duplicate_request(result):
+                            duplicates.append(token)
+                        else:
+                            logger.error("Publishing HIT %s failed: %s",
+                                         token, result)
+                            counts['failed'] += 1
+        finally:
+            pool.close()
+            pool.join()
+
+        if duplicates:
+            counts['recovered'] = self._recover_published(duplicates)
+            counts['failed'] += len(duplicates) - counts['recovered']
+        return counts
 
 
 class DisposeException(Exception):
@@ -205,6 +467,31 @@ class HIT(models.Model):
             help_text=("The number of assignments for this HIT that "
                        "have been approved or rejected.")
     )
+    mturk_fingerprint = models.CharField(
+            max_length=40,
+            null=True,
+            blank=True,
+            editable=False,
+            help_text=("A digest of the Mechanical Turk data this HIT was "
+                       "last updated from")
+    )
+    next_poll_time = models.DateTimeField(
+            null=True,
+            blank=True,
+            db_index=True,
+            editable=False,
+            help_text=("The UTC date and time the poll scheduler will next "
+                       "update this HIT (never, if empty and disposed)")
+    )
+    publish_token = models.CharField(
+            max_length=64,
+            null=True,
+            blank=True,
+            db_index=True,
+            editable=False,
+            help_text=("The token HIT.objects.publish_batch() published "
+                       "this HIT with (also its requester annotation)")
+    )
 
     # To allow attachment of Generic Django instances
     content_type = models.ForeignKey(
@@ -228,6 +515,8 @@ class HIT(models.Model):
             fk_field="content_id",
             )
 
+    objects = HITManager()
+
     def disable(self):
         """Disable/Destroy HIT that is no longer needed
 
@@ -256,7 +545,8 @@ class HIT(models.Model):
         """
         # Check for new results and cache a copy in Django model
         self.update(do_update_assignments=True)
-        self.connection.dispose_hit(self.mturk_id)
+        with pooled_connection() as connection:
+            connection.dispose_hit(self.mturk_id)
 
     def dispose(self):
         """Dispose of a HIT that is no longer needed.
@@ -294,7 +584,8 @@ class HIT(models.Model):
                             self.mturk_id, assignment.mturk_id))
 
         # Checks pass. Dispose of HIT and update status
-        self.connection.dispose_hit(self.mturk_id)
+        with pooled_connection() as connection:
+            connection.dispose_hit(self.mturk_id)
         self.update()
 
     def expire(self):
@@ -312,7 +603,8 @@ class HIT(models.Model):
         documentation:
         http://boto.cloudhackers.com/en/latest/ref/mturk.html
         """
-        self.connection.expire_hit(self.mturk_id)
+        with pooled_connection() as connection:
+            connection.expire_hit(self.mturk_id)
         self.update()
 
     def extend(self, assignments_increment=None, expiration_increment=None):
@@ -334,9 +626,10 @@ class HIT(models.Model):
         documentation:
         http://boto.cloudhackers.com/en/latest/ref/mturk.html
         """
-        self.connection.extend_hit(self.mturk_id,
-                                   assignments_increment=assignments_increment,
-                                   expiration_increment=expiration_increment)
+        with pooled_connection() as connection:
+            connection.extend_hit(self.mturk_id,
+                                  assignments_increment=assignments_increment,
+                                  expiration_increment=expiration_increment)
         self.update()
 
     def set_reviewing(self, revert=None):
@@ -354,7 +647,8 @@ class HIT(models.Model):
         documentation:
         http://boto.cloudhackers.com/en/latest/ref/mturk.html
         """
-        self.connection.set_reviewing(self.mturk_id, revert=revert)
+        with pooled_connection() as connection:
+            connection.set_reviewing(self.mturk_id, revert=revert)
         self.update()
 
     def update(self, mturk_hit=None, do_update_assignments=False):
@@ -365,52 +659,59 @@ class HIT(models.Model):
         Otherwise, Amazon Mechanical Turk is contacted to get additional
         information.
 
-        This instance's attributes are updated.
+        This instance's attributes are updated. Only the columns that
+        changed are written to the database, and nothing is written if
+        the remote data is the same as last time. Returns True if the
+        HIT was written.
         """
         if mturk_hit is None or not hasattr(mturk_hit, "HITStatus"):
-            hit = self.connection.get_hit(self.mturk_id)[0]
+            with pooled_connection() as connection:
+                hit = connection.get_hit(self.mturk_id)[0]
         else:
             assert isinstance(mturk_hit, boto.mturk.connection.HIT)
             hit = mturk_hit
 
-        self.status = HIT.reverse_status_lookup[hit.HITStatus]
-        self.reward = hit.Amount
-        self.assignment_duration_in_seconds = hit.AssignmentDurationInSeconds
-        self.auto_approval_delay_in_seconds = hit.AutoApprovalDelayInSeconds
-        self.max_assignments = hit.MaxAssignments
-        self.creation_time = amazon_string_to_datetime(hit.CreationTime)
-        self.description = hit.Description
-        self.title = hit.Title
-        self.hit_type_id = hit.HITTypeId
-        self.keywords = hit.Keywords
-        if hasattr(self, 'NumberOfAssignmentsCompleted'):
-            self.number_of_assignments_completed =\
-                    hit.NumberOfAssignmentsCompleted
-        if hasattr(self, 'NumberOfAssignmentsAvailable'):
-            self.number_of_assignments_available =\
-                    hit.NumberOfAssignmentsAvailable
-        if hasattr(self, 'NumberOfAssignmentsPending'):
-            self.number_of_assignments_pending =\
-                    hit.NumberOfAssignmentsPending
-        #'CurrencyCode', 'Reward', 'Expiration', 'expired']
-
-        self.save()
+        fields = _hit_fields(hit)
+        written = _save_remote_fields(self, fields, _fingerprint(fields))
 
         if do_update_assignments:
             self.update_assignments()
+        return written
+
+    def update_assignments(self, page_number=1, page_size=MAX_PAGE_SIZE,
+                           update_all=True, workers=DEFAULT_FETCH_WORKERS):
+        """Update the assignments of this HIT from Mechanical Turk
 
-    def update_assignments(self, page_number=1, page_size=10, update_all=True):
-        assignments = self.connection.get_assignments(self.mturk_id,
-                                                      page_size=page_size,
-                                                      page_number=page_number)
-        for mturk_assignment in assignments:
-            assert mturk_assignment.HITId == self.mturk_id
-            djurk_assignment = Assignment.objects.get_or_create(
-                    mturk_id=mturk_assignment.AssignmentId, hit=self)[0]
-            djurk_assignment.update(mturk_assignment, hit=self)
-        if update_all and int(assignments.PageNumber) *\
-                            page_size < int(assignments.TotalNumResults):
-            self.update_assignments(page_number + 1, page_size, update_all)
+        Assignments are requested page_size at a time (the largest page
+        Mechanical Turk allows, by default). If update_all is True, all
+        pages are retrieved, with the pages after the first fetched by
+        up to workers concurrent requests; otherwise only page_number
+        is. Each page is written with Assignment.objects.sync_from_mturk()
+        as soon as it arrives and committed on its own.
+
+        The counts returned by Assignment.objects.sync_from_mturk() are
+        added up and returned.
+        """
+        def fetch_page(page_number, page_size):
+            with pooled_connection() as connection:
+                return connection.get_assignments(self.mturk_id,
+                                                  page_size=page_size,
+                                                  page_number=page_number)
+
+        if update_all:
+            pages = iter_pages(fetch_page, page_size=page_size,
+                               workers=workers)
+        else:
+            pages = [fetch_page(page_number, page_size)]
+        counts = {'inserted': 0, 'updated': 0, 'unchanged': 0,
+                  'columns_written': 0}
+        for assignments in pages:
+            with transaction.commit_on_success():
+                page_counts = Assignment.objects.sync_from_mturk(self,
+                                                                 assignments)
+            for name, value in page_counts.items():
+                counts[name] += value
+        return counts
 
     class Meta:
         verbose_name = "HIT"
@@ -418,7 +719,242 @@ class HIT(models.Model):
 
     def __unicode__(self):
         return u"HIT: %s" % self.mturk_id
-pre_init.connect(init_connection_callback, sender=HIT)
+
+
+# The HIT fields that are copied from Mechanical Turk by _hit_fields()
+HIT_SYNCED_FIELDS = (
+    'status', 'reward', 'assignment_duration_in_seconds',
+    'auto_approval_delay_in_seconds', 'max_assignments', 'creation_time',
+    'description', 'title', 'hit_type_id', 'keywords',
+    'number_of_assignments_completed', 'number_of_assignments_available',
+    'number_of_assignments_pending', 'lifetime_in_seconds',
+    'requester_annotation',
+)
+
+
+# The Assignment fields that are copied from Mechanical Turk by
+# _assignment_fields()
+ASSIGNMENT_SYNCED_FIELDS = (
+    'status', 'worker_id', 'submit_time', 'accept_time',
+    'auto_approval_time', 'rejection_time', 'approval_time', 'deadline',
+)
+
+
+def _assignment_fields(mturk_assignment, hit):
+    """Return Assignment model field values from a Boto Assignment
+
+    Mechanical Turk doesn't return the deadline; it is worked out from
+    the accept time and the assignment duration of hit.
+    """
+
+    fields = {
+        'status': Assignment.reverse_status_lookup[
+                mturk_assignment.AssignmentStatus],
+        'worker_id': mturk_assignment.WorkerId,
+        'submit_time': amazon_string_to_datetime(mturk_assignment.SubmitTime),
+        'accept_time': amazon_string_to_datetime(mturk_assignment.AcceptTime),
+        'auto_approval_time': amazon_string_to_datetime(
+                mturk_assignment.AutoApprovalTime),
+    }
+
+    # Different response groups for query
+    if hasattr(mturk_assignment, 'RejectionTime'):
+        fields['rejection_time'] = amazon_string_to_datetime(
+                mturk_assignment.RejectionTime)
+    if hasattr(mturk_assignment, 'ApprovalTime'):
+        fields['approval_time'] = amazon_string_to_datetime(
+                mturk_assignment.ApprovalTime)
+
+    fields['deadline'] = None
+    if fields['accept_time'] and hit.assignment_duration_in_seconds:
+        fields['deadline'] = fields['accept_time'] + datetime.timedelta(
+                seconds=int(hit.assignment_duration_in_seconds))
+    return fields
+
+
+class AssignmentManager(models.Manager):
+    def sync_from_mturk(self, hit, mturk_assignments):
+        """Insert or update a HIT's assignments from Boto Assignments
+
+        This is the batched counterpart of Assignment.update(). Like
+        HIT.objects.sync_from_mturk(), it compares fingerprints, which
+        here also cover the answers, to skip unchanged assignments
+        entirely. Changed assignments get their changed columns written,
+        new ones are inserted with bulk_create() and the answers of
+        both are synchronized at once with KeyValue.objects.sync_answers(),
+        or written with the assignments when answers are packed (see
+        pack_answers()).
+
+        The caller controls the transaction. A dictionary counting the
+        'inserted', 'updated' and 'unchanged' assignments, and the
+        'columns_written' to update them, is returned.
+        """
+        remote = {}
+        answers = {}
+        for mturk_assignment in mturk_assignments:
+            assert mturk_assignment.HITId == hit.mturk_id
+            remote[mturk_assignment.AssignmentId] = _assignment_fields(
+                    mturk_assignment, hit)
+            answers[mturk_assignment.AssignmentId] = _answer_fields(
+                    mturk_assignment)
+
+        counts = {'inserted': 0, 'updated': 0, 'unchanged': 0,
+                  'columns_written': 0}
+        if not remote:
+            return counts
+        fingerprints = dict(
+                (mturk_id, _fingerprint(fields, answers[mturk_id]))
+                for mturk_id, fields in remote.items())
+        packing = get_answer_storage() == PACKED_ANSWERS
+        packed = dict((mturk_id, packing and pack_answers(values) or None)
+                      for mturk_id, values in answers.items())
+        stored = dict((mturk_id, (fingerprint, hit_id)) for
+                      mturk_id, fingerprint, hit_id in
+                      self.filter(mturk_id__in=remote.keys()).values_list(
+                          'mturk_id', 'mturk_fingerprint', 'hit'))
+        changed_ids = [mturk_id for mturk_id, (fingerprint, hit_id)
+                       in stored.items()
+                       if (fingerprint, hit_id) != (fingerprints[mturk_id],
+                                                    hit.pk)]
+        counts['unchanged'] = len(stored) - len(changed_ids)
+
+        # Primary keys of the assignments whose answers may have changed
+        pks = {}
+        now = datetime.datetime.utcnow()
+        if changed_ids:
+            rows = self.filter(mturk_id__in=changed_ids).values(
+                    'pk', 'mturk_id', 'hit', *ASSIGNMENT_SYNCED_FIELDS)
+            for row in rows:
+                pks[row['mturk_id']] = row['pk']
+                changed = _changed_fields(row, remote[row['mturk_id']])
+                if row['hit'] != hit.pk:
+                    changed['hit'] = hit
+                counts['columns_written'] += len(changed)
+                self.filter(pk=row['pk']).update(
+                        mturk_fingerprint=fingerprints[row['mturk_id']],
+                        packed_answers=packed[row['mturk_id']], synced=now,
+                        **changed)
+                counts['updated'] += 1
+        updated_pks = pks.values()
+
+        new = [Assignment(mturk_id=mturk_id, hit=hit,
+                          mturk_fingerprint=fingerprints[mturk_id],
+                          packed_answers=packed[mturk_id], synced=now,
+                          **fields)
+               for mturk_id, fields in remote.items()
+               if mturk_id not in stored]
+        if new:
+            self.bulk_create(new)
+            # bulk_create() doesn't set primary keys
+            pks.update(self.filter(
+                    mturk_id__in=[assignment.mturk_id for assignment in new]
+                    ).values_list('mturk_id', 'pk'))
+            counts['inserted'] = len(new)
+
+        if packing:
+            # Drop the rows of answers stored before packing was turned on
+            if updated_pks:
+                KeyValue.objects.filter(assignment__in=updated_pks).delete()
+        else:
+            KeyValue.objects.sync_answers(dict(
+                    (pk, answers[mturk_id]) for mturk_id, pk in pks.items()))
+        return counts
+
+    def pack_answers(self, pks):
+        """Move the KeyValue answers of assignments into packed_answers
+
+        pks are the primary keys of the assignments, which get packed
+        answers even if they have none. The caller controls the
+        transaction.
+        """
+        answers = dict((pk, {}) for pk in pks)
+        for assignment_id, key, value in KeyValue.objects.filter(
+                assignment__in=pks).values_list('assignment', 'key', 'value'):
+            answers[assignment_id][key] = value
+        for pk, values in answers.items():
+            self.filter(pk=pk).update(packed_answers=pack_answers(values))
+        KeyValue.objects.filter(assignment__in=pks).delete()
+
+    def unpack_answers(self, pks):
+        """Move the packed answers of assignments into KeyValue rows"""
+        answers = dict((pk, unpack_answers(packed)) for pk, packed in
+                       self.filter(pk__in=pks, packed_answers__isnull=False
+                                   ).values_list('pk', 'packed_answers'))
+        KeyValue.objects.sync_answers(answers)
+        self.filter(pk__in=answers.keys()).update(packed_answers=None)
+
+    def _change_on_mturk(self, assignments, change,
+                         workers=DEFAULT_FETCH_WORKERS):
+        """Call change(connection, assignment) for each of assignments
+
+        The calls are made concurrently, by up to workers threads. Then
+        the assignments of every HIT involved are refreshed, once per
+        HIT, with HIT.update_assignments(). Returns the list of
+        assignments that were changed and the list of (assignment,
+        exception) pairs for those that could not be.
+        """
+        assignments = list(assignments)
+
+        def make_change(assignment):
+            try:
+                with pooled_connection() as connection:
+                    change(connection, assignment)
+            except Exception as error:
+                return assignment, error
+            return assignment, None
+
+        if len(assignments) > 1 and workers > 1:
+            pool = ThreadPool(min(workers, len(assignments)))
+            try:
+                results = pool.map(make_change, assignments)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(make_change, assignments)
+
+        changed = [assignment for assignment, error in results
+                   if error is None]
+        failed = [(assignment, error) for assignment, error in results
+                  if error is not None]
+        # A failed call may still have changed something, so its HIT is
+        # refreshed too
+        hit_ids = set(assignment.hit_id for assignment in assignments
+                      if assignment.hit_id is not None)
+        for hit in HIT.objects.filter(pk__in=hit_ids):
+            hit.update_assignments()
+        return changed, failed
+
+    def approve(self, assignments, feedback=None, **kwargs):
+        """Approve assignments (a queryset or list) and pay the workers
+
+        See _change_on_mturk() for the other arguments and the return
+        value.
+        """
+        return self._change_on_mturk(
+                assignments,
+                lambda connection, assignment: connection.approve_assignment(
+                        assignment.mturk_id, feedback=feedback),
+                **kwargs)
+
+    def reject(self, assignments, feedback=None, **kwargs):
+        """Reject assignments (a queryset or list) without payment"""
+        return self._change_on_mturk(
+                assignments,
+                lambda connection, assignment: connection.reject_assignment(
+                        assignment.mturk_id, feedback=feedback),
+                **kwargs)
+
+    def bonus(self, assignments, value=0.0, feedback=None, **kwargs):
+        """Grant each worker of assignments a bonus of value"""
+        return self._change_on_mturk(
+                assignments,
+                lambda connection, assignment: connection.grant_bonus(
+                        assignment.worker_id,
+                        assignment.mturk_id,
+                        bonus_price=boto.mturk.price.Price(amount=value),
+                        reason=feedback),
+                **kwargs)
 
 
 class Assignment(models.Model):
@@ -506,25 +1042,72 @@ class Assignment(models.Model):
             help_text=("The optional text included with the call to either "
                        "approve or reject the assignment.")
     )
+    mturk_fingerprint = models.CharField(
+            max_length=40,
+            null=True,
+            blank=True,
+            editable=False,
+            help_text=("A digest of the Mechanical Turk data (including the "
+                       "answers) this assignment was last updated from")
+    )
+    packed_answers = models.TextField(
+            null=True,
+            blank=True,
+            editable=False,
+            help_text=("The answers, as a JSON object, if they are packed "
+                       "rather than stored as Key-Value Pairs")
+    )
+    synced = models.DateTimeField(
+            null=True,
+            blank=True,
+            editable=False,
+            db_index=True,
+            default=datetime.datetime.utcnow,
+            help_text=("The date and time, in UTC, this assignment was last "
+                       "inserted or changed by a synchronization or a "
+                       "confirmed mutation")
+    )
+
+    objects = AssignmentManager()
+
+    def get_answers(self):
+        """Return the answers as a dictionary, however they are stored"""
+        if self.packed_answers is not None:
+            return unpack_answers(self.packed_answers)
+        return dict(self.answers.values_list('key', 'value'))
+
+    def answer_pairs(self):
+        """Return the answers as KeyValue objects, ordered by key
+
+        Packed answers are returned as unsaved KeyValue objects, so that
+        code displaying Key-Value Pairs works with either storage.
+        """
+        if self.packed_answers is None:
+            return list(self.answers.order_by('key'))
+        return [KeyValue(assignment=self, key=key, value=value)
+                for key, value in sorted(self.get_answers().items())]
 
     def approve(self, feedback=None):
         """Thin wrapper around Boto approve function."""
-        self.connection.approve_assignment(self.mturk_id, feedback=feedback)
+        with pooled_connection() as connection:
+            connection.approve_assignment(self.mturk_id, feedback=feedback)
         self.update()
 
     def reject(self, feedback=None):
         """Thin wrapper around Boto reject function."""
-        self.connection.reject_assignment(self.mturk_id, feedback=feedback)
+        with pooled_connection() as connection:
+            connection.reject_assignment(self.mturk_id, feedback=feedback)
         self.update()
 
     def bonus(self, value=0.0, feedback=None):
         """Thin wrapper around Boto bonus function."""
 
-        self.connection.grant_bonus(
-                self.worker_id,
-                self.mturk_id,
-                bonus_price=boto.mturk.price.Price(amount=value),
-                reason=feedback)
+        with pooled_connection() as connection:
+            connection.grant_bonus(
+                    self.worker_id,
+                    self.mturk_id,
+                    bonus_price=boto.mturk.price.Price(amount=value),
+                    reason=feedback)
         self.update()
 
     def update(self, mturk_assignment=None, hit=None):
@@ -533,53 +1116,43 @@ class Assignment(models.Model):
         If mturk_assignment is given to this function, it should be
         a Boto assignment object that represents a Mechanical Turk
         Assignment instance.  Otherwise, Amazon Mechanical Turk is
-        contacted.
+        contacted and all of the HIT's assignments are refreshed with
+        HIT.update_assignments().
 
         This instance's attributes are updated.
         """
         if mturk_assignment is None:
-            hit = self.connection.get_hit(self.hit.mturk_id)[0]
-            for a in self.connection.get_assignments(hit.HITId):
-                # While we have the query, we may as well update
-                if a.AssignmentId == self.mturk_id:
-                    # That's this record. Hold onto so we can update below
-                    assignment = a
-                else:
-                    other_assignment = Assignment.objects.get(
-                            mturk_id=a.AssignmentId)
-                    other_assignment.update(a)
-        else:
-            assert isinstance(mturk_assignment,
-                              boto.mturk.connection.Assignment)
-            assignment = mturk_assignment
-
-        self.status = self.reverse_status_lookup[assignment.AssignmentStatus]
-        self.worker_id = assignment.WorkerId
-        self.submit_time = amazon_string_to_datetime(assignment.SubmitTime)
-        self.accept_time = amazon_string_to_datetime(assignment.AcceptTime)
-        self.auto_approval_time = amazon_string_to_datetime(
-                assignment.AutoApprovalTime)
-        self.submit_time = amazon_string_to_datetime(assignment.SubmitTime)
-
-        # Different response groups for query
-        if hasattr(assignment, 'RejectionTime'):
-            self.rejection_time = amazon_string_to_datetime(
-                    assignment.RejectionTime)
-        if hasattr(assignment, 'ApprovalTime'):
-            self.approval_time = amazon_string_to_datetime(
-                    assignment.ApprovalTime)
-        self.save()
-
-        # Update any Key-Value Pairs that were associated with this
-        # assignment
-        for result_set in assignment.answers:
-            for question in result_set:
-                for key, value in question.fields:
-                    kv = KeyValue.objects.get_or_create(key=key,
-                                                        assignment=self)[0]
-                    if kv.value != value:
-                        kv.value = value
-                        kv.save()
+            # While we have the query, we may as well update all of the
+            # HIT's assignments. They are written in bulk, including the
+            # ones that haven't been synchronized locally yet.
+            self.hit.update_assignments()
+            stored = Assignment.objects.filter(
+                    mturk_id=self.mturk_id).values('pk', 'hit',
+                                                   *ASSIGNMENT_SYNCED_FIELDS)
+            for row in stored:
+                self.pk = row['pk']
+                self.hit_id = row['hit']
+                for name in ASSIGNMENT_SYNCED_FIELDS:
+                    setattr(self, name, row[name])
+            return
+
+        assert isinstance(mturk_assignment, boto.mturk.connection.Assignment)
+        assignment = mturk_assignment
+
+        fields = _assignment_fields(assignment, self.hit)
+        answers = _answer_fields(assignment)
+        fingerprint = _fingerprint(fields, answers)
+        packing = get_answer_storage() == PACKED_ANSWERS
+        fields['packed_answers'] = packing and pack_answers(answers) or None
+        # Only written along with the fields that changed
+        fields['synced'] = datetime.datetime.utcnow()
+        if _save_remote_fields(self, fields, fingerprint):
+            # Update any Key-Value Pairs that were associated with this
+            # assignment
+            if packing:
+                KeyValue.objects.filter(assignment=self).delete()
+            else:
+                KeyValue.objects.sync_answers({self.pk: answers})
 
     def __unicode__(self):
         return self.mturk_id
@@ -587,7 +1160,83 @@ class Assignment(models.Model):
     def __repr__(self):
         return u"Assignment: %s" % self.mturk_id
     __str__ = __unicode__
-pre_init.connect(init_connection_callback, sender=Assignment)
+
+
+def _answer_fields(mturk_assignment):
+    """Return the answers of a Boto Assignment object as a dictionary"""
+
+    answers = {}
+    for result_set in mturk_assignment.answers:
+        for question in result_set:
+            for key, value in question.fields:
+                answers[key] = value
+    return answers
+
+
+def pack_answers(answers):
+    """Return a dictionary of answers packed for Assignment.packed_answers
+
+    Answers are packed (rather than stored one KeyValue row each) when
+    the DJURK_ANSWER_STORAGE setting is 'packed'. Reading back all of an
+    assignment's answers then costs no query, and writing them one
+    column.
+    """
+    return json.dumps(answers, sort_keys=True, separators=(',', ':'))
+
+
+def unpack_answers(packed):
+    return json.loads(packed)
+
+
+class KeyValueManager(models.Manager):
+    def sync_answers(self, answers_by_assignment):
+        """Make the stored answers match the given answers
+
+        answers_by_assignment maps Assignment primary keys to
+        dictionaries of answer keys and values. The stored answers of
+        all of those assignments are loaded with one query and compared
+        to the given ones: missing keys are inserted with bulk_create(),
+        changed values are updated (one query per distinct value) and
+        keys that are no longer part of the answers are deleted.
+
+        A dictionary counting the 'inserted', 'updated', 'deleted' and
+        'unchanged' answers is returned.
+        """
+        counts = {'inserted': 0, 'updated': 0, 'deleted': 0, 'unchanged': 0}
+        if not answers_by_assignment:
+            return counts
+
+        stale = []
+        changed = {}
+        stored = set()
+        existing = self.filter(
+                assignment__in=answers_by_assignment.keys()).values_list(
+                'pk', 'assignment', 'key', 'value')
+        for pk, assignment_id, key, value in existing:
+            answers = answers_by_assignment[assignment_id]
+            stored.add((assignment_id, key))
+            if key not in answers:
+                stale.append(pk)
+            elif answers[key] != value:
+                changed.setdefault(answers[key], []).append(pk)
+            else:
+                counts['unchanged'] += 1
+
+        new = [KeyValue(assignment_id=assignment_id, key=key, value=value)
+               for assignment_id, answers in answers_by_assignment.items()
+               for key, value in answers.items()
+               if (assignment_id, key) not in stored]
+
+        if stale:
+            self.filter(pk__in=stale).delete()
+        for value, pks in changed.items():
+            self.filter(pk__in=pks).update(value=value)
+        self.bulk_create(new)
+
+        counts['deleted'] = len(stale)
+        counts['updated'] = sum(len(pks) for pks in changed.values())
+        counts['inserted'] = len(new)
+        return counts
 
 
 class KeyValue(models.Model):
@@ -611,6 +1260,8 @@ class KeyValue(models.Model):
             related_name="answers",
     )
 
+    objects = KeyValueManager()
+
     def short_value(self):
         if len(self.value) > self.MAX_DISPLAY_LENGTH:
             return u'%s...' % self.value[:self.MAX_DISPLAY_LENGTH]
@@ -621,6 +1272,369 @@ class KeyValue(models.Model):
     class Meta:
         verbose_name = "Key-Value Pair"
         verbose_name_plural = "Key-Value Pairs"
+        unique_together = (('assignment', 'key'),)
 
     def __unicode__(self):
         return u"%s=%s" % (self.key, self.short_value())
+
+
+class JobManager(models.Manager):
+
+    def enqueue(self, kind, hit=None, requested_by=None):
+        """Queue a job, unless the same job is already waiting
+
+        Returns the job and whether it was created. Only one job of a
+        kind (and HIT) is pending at a time: queueing it again returns
+        the pending one, which will do the same work.
+        """
+        key = kind if hit is None else u'%s:%s' % (kind, hit.pk)
+        return self.get_or_create(dedup_key=key, defaults={
+                'kind': kind,
+                'hit': hit,
+                'requested_by': requested_by,
+        })
+
+
+class Job(models.Model):
+    """A long-running Mechanical Turk operation, run by djurk_worker"""
+
+    (POLL_ALL_HITS, POLL_REVIEWABLE_HITS, UPDATE_HIT, DISPOSE_HIT,
+     DISPATCH_MUTATIONS) = (
+          'poll_all_hits', 'poll_reviewable_hits', 'update_hit',
+          'dispose_hit', 'dispatch_mutations')
+    KIND_CHOICES = (
+            (POLL_ALL_HITS, "Poll all HITs"),
+            (POLL_REVIEWABLE_HITS, "Poll reviewable HITs"),
+            (UPDATE_HIT, "Update HIT"),
+            (DISPOSE_HIT, "Dispose of HIT"),
+            (DISPATCH_MUTATIONS, "Send the outbox"),
+    )
+
+    (PENDING, RUNNING, DONE, FAILED) = ('P', 'R', 'D', 'F')
+    STATUS_CHOICES = (
+            (PENDING, "Pending"),
+            (RUNNING, "Running"),
+            (DONE, "Done"),
+            (FAILED, "Failed"),
+    )
+
+    kind = models.CharField(
+            max_length=32,
+            choices=KIND_CHOICES,
+    )
+    hit = models.ForeignKey(
+            HIT,
+            null=True,
+            blank=True,
+            related_name='jobs',
+            help_text="The HIT the job is about, if any",
+    )
+    status = models.CharField(
+            max_length=1,
+            choices=STATUS_CHOICES,
+            default=PENDING,
+            db_index=True,
+    )
+    dedup_key = models.CharField(
+            max_length=255,
+            unique=True,
+            null=True,
+            editable=False,
+            help_text=("Set while the job is pending, so that the same job "
+                       "isn't queued twice"),
+    )
+    requested_by = models.CharField(
+            max_length=255,
+            null=True,
+            blank=True,
+    )
+    # In UTC, like the times from Mechanical Turk
+    created = models.DateTimeField(
+            default=datetime.datetime.utcnow,
+            editable=False,
+    )
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    heartbeat = models.DateTimeField(
+            null=True,
+            blank=True,
+            editable=False,
+            help_text=("Last written by the worker running the job; a "
+                       "running job whose worker stopped writing it is "
+                       "failed"),
+    )
+    progress = models.CharField(
+            max_length=255,
+            null=True,
+            blank=True,
+    )
+    result = models.TextField(
+            null=True,
+            blank=True,
+            help_text="What the job did, as JSON",
+    )
+    error = models.TextField(
+            null=True,
+            blank=True,
+            help_text="The traceback of a failed job",
+    )
+
+    objects = JobManager()
+
+    class Meta:
+        ordering = ('-pk',)
+
+    def __unicode__(self):
+        if self.hit_id is None:
+            return u"%s #%s" % (self.get_kind_display(), self.pk)
+        return u"%s #%s (HIT %s)" % (self.get_kind_display(), self.pk,
+                                     self.hit_id)
+
+
+class MutationManager(models.Manager):
+    """Records changes to make on Mechanical Turk in the outbox
+
+    The changes are sent by djurk.outbox.Dispatcher (the djurk_dispatch
+    command). Each mutation has an idempotency key: recording a change
+    whose key is already in the outbox does nothing, unless it failed,
+    in which case it is sent again (see retry()). Approvals,
+    rejections, expirations and reviewing status changes are keyed by
+    what they do, so they are only recorded once. Bonuses and
+    extensions can rightly be made twice, so they get a new key unless
+    one is given: give the same key when the same intent may be
+    recorded again (a resubmitted form, a rerun script...).
+    """
+
+    def _record(self, operation, targets, key=None, **parameters):
+        """Record operation on each of targets (HITs or assignments)
+
+        Returns the mutations recorded, leaving out the ones already
+        in the outbox that haven't failed; failed ones are retried.
+        """
+        parameters = json.dumps(parameters, sort_keys=True)
+        if operation in Mutation.ASSIGNMENT_OPERATIONS:
+            target_field = 'assignment'
+        else:
+            target_field = 'hit'
+        mutations = {}
+        for target in targets:
+            if key is None and operation in Mutation.REPEATABLE_OPERATIONS:
+                target_key = uuid.uuid4().hex
+            else:
+                target_key = key
+            idempotency_key = hashlib.sha1(u'\n'.join([
+                    operation, target.mturk_id, parameters,
+                    target_key or u'']).encode('utf-8')).hexdigest()
+            mutations[idempotency_key] = Mutation(
+                    operation=operation, parameters=parameters,
+                    idempotency_key=idempotency_key, **{target_field: target})
+
+        keys = mutations.keys()
+        failed = []
+        for start in range(0, len(keys), MAX_PAGE_SIZE):
+            for recorded, status in self.filter(
+                    idempotency_key__in=keys[start:start + MAX_PAGE_SIZE]
+                    ).values_list('idempotency_key', 'status'):
+                del mutations[recorded]
+                if status == Mutation.FAILED:
+                    failed.append(recorded)
+        self.bulk_create(mutations.values())
+        for start in range(0, len(failed), MAX_PAGE_SIZE):
+            self.retry(self.filter(
+                    idempotency_key__in=failed[start:start + MAX_PAGE_SIZE]))
+        # Read back, as bulk_create() doesn't set the primary keys,
+        # leaving out the failed mutations that couldn't be retried
+        keys = mutations.keys() + failed
+        return list(itertools.chain.from_iterable(
+                self.filter(idempotency_key__in=keys[
+                        start:start + MAX_PAGE_SIZE]).exclude(
+                                status=Mutation.FAILED).order_by('pk')
+                for start in range(0, len(keys), MAX_PAGE_SIZE)))
+
+    def approve(self, assignments, feedback=None):
+        """Record the approval of assignments (a queryset or list)"""
+        return self._record(Mutation.APPROVE, assignments, feedback=feedback)
+
+    def reject(self, assignments, feedback=None):
+        return self._record(Mutation.REJECT, assignments, feedback=feedback)
+
+    def bonus(self, assignments, value, feedback=None, key=None):
+        """Record a bonus of value for the worker of each of assignments
+
+        The bonus is sent with the mutation's idempotency key as its
+        UniqueRequestToken, so it is paid once however many times it is
+        sent.
+        """
+        return self._record(Mutation.BONUS, assignments, key=key,
+                            value=str(value), feedback=feedback)
+
+    def expire(self, hits):
+        return self._record(Mutation.EXPIRE, hits)
+
+    def extend(self, hits, assignments_increment=None,
+               expiration_increment=None, key=None):
+        return self._record(Mutation.EXTEND, hits, key=key,
+                            assignments_increment=assignments_increment,
+                            expiration_increment=expiration_increment)
+
+    def set_reviewing(self, hits, revert=False):
+        return self._record(Mutation.SET_REVIEWING, hits, revert=revert)
+
+    def retry(self, mutations):
+        """Make the failed ones of mutations (a queryset) pending again
+
+        They are sent as soon as a dispatcher looks for due mutations,
+        with as many attempts as new ones. Bonuses and extensions first
+        sent more than TOKEN_LIFETIME ago stay failed, as Mechanical
+        Turk may have made them already and no longer knows their
+        token; bonuses are retried if GetBonusPayments shows that none
+        of their amount was paid for the assignment. Returns how many
+        mutations were retried.
+        """
+        now = datetime.datetime.utcnow()
+        failed = mutations.filter(status=Mutation.FAILED)
+        expired = failed.filter(
+                operation__in=Mutation.REPEATABLE_OPERATIONS,
+                first_attempt__lt=now - TOKEN_LIFETIME).select_related(
+                        'assignment')
+        kept = [mutation.pk for mutation in expired
+                if mutation.operation != Mutation.BONUS or
+                _may_have_been_paid(mutation)]
+        if kept:
+            logger.warning("Not retrying %d bonuses or extensions whose "
+                           "tokens Mechanical Turk has forgotten" %
+                           len(kept))
+        return failed.exclude(pk__in=kept).update(
+                status=Mutation.PENDING, attempts=0, next_attempt=now,
+                first_attempt=None)
+
+
+def _may_have_been_paid(mutation):
+    """Return False if a bonus mutation was certainly not paid"""
+    amount = decimal.Decimal(mutation.get_parameters()['value'])
+
+    def fetch_page(page_number, page_size):
+        with pooled_connection() as connection:
+            return connection._process_request(
+                    'GetBonusPayments', {
+                        'AssignmentId': mutation.assignment.mturk_id,
+                        'PageSize': page_size,
+                        'PageNumber': page_number,
+                    }, [('BonusPayment',
+                         boto.mturk.connection.BaseAutoResultElement)])
+    try:
+        return any(decimal.Decimal(payment.Amount) == amount
+                   for page in iter_pages(fetch_page, workers=1)
+                   for payment in page)
+    except Exception:
+        logger.exception("Listing the bonuses of %s failed" % mutation)
+        return True
+
+
+class Mutation(models.Model):
+    """A change to make on Mechanical Turk, kept in the outbox
+
+    A mutation is pending until a dispatcher claims it (sending). Once
+    Mechanical Turk has confirmed it, it is confirmed, and done when
+    the local HIT or assignment has been updated to match. A mutation
+    that can't be made, or still fails after the dispatcher's last
+    attempt, is failed.
+    """
+
+    (APPROVE, REJECT, BONUS, EXPIRE, EXTEND, SET_REVIEWING) = (
+          'approve', 'reject', 'bonus', 'expire', 'extend', 'set_reviewing')
+    OPERATION_CHOICES = (
+            (APPROVE, "Approve assignment"),
+            (REJECT, "Reject assignment"),
+            (BONUS, "Grant bonus"),
+            (EXPIRE, "Expire HIT"),
+            (EXTEND, "Extend HIT"),
+            (SET_REVIEWING, "Set HIT reviewing status"),
+    )
+    ASSIGNMENT_OPERATIONS = (APPROVE, REJECT, BONUS)
+    # Operations that can rightly be made twice
+    REPEATABLE_OPERATIONS = (BONUS, EXTEND)
+
+    (PENDING, SENDING, CONFIRMED, DONE, FAILED) = ('P', 'S', 'C', 'D', 'F')
+    STATUS_CHOICES = (
+            (PENDING, "Pending"),
+            (SENDING, "Sending"),
+            (CONFIRMED, "Confirmed"),
+            (DONE, "Done"),
+            (FAILED, "Failed"),
+    )
+
+    operation = models.CharField(
+            max_length=32,
+            choices=OPERATION_CHOICES,
+    )
+    hit = models.ForeignKey(
+            HIT,
+            null=True,
+            blank=True,
+            related_name='mutations',
+    )
+    assignment = models.ForeignKey(
+            Assignment,
+            null=True,
+            blank=True,
+            related_name='mutations',
+    )
+    parameters = models.TextField(
+            help_text="The arguments of the operation, as JSON",
+    )
+    idempotency_key = models.CharField(
+            max_length=40,
+            unique=True,
+            editable=False,
+            help_text=("Identifies the intent, so that it is only recorded, "
+                       "and a bonus only paid, once"),
+    )
+    status = models.CharField(
+            max_length=1,
+            choices=STATUS_CHOICES,
+            default=PENDING,
+            db_index=True,
+    )
+    attempts = models.PositiveIntegerField(default=0)
+    # In UTC, like the times from Mechanical Turk
+    next_attempt = models.DateTimeField(
+            default=datetime.datetime.utcnow,
+            db_index=True,
+            help_text="When a pending mutation may next be sent",
+    )
+    claim = models.CharField(
+            max_length=32,
+            null=True,
+            blank=True,
+            db_index=True,
+            editable=False,
+            help_text="Identifies the dispatcher batch sending the mutation",
+    )
+    claimed = models.DateTimeField(null=True, blank=True)
+    first_attempt = models.DateTimeField(
+            null=True,
+            blank=True,
+            editable=False,
+            help_text=("When the mutation was first sent, since it was "
+                       "recorded or retried"),
+    )
+    created = models.DateTimeField(
+            default=datetime.datetime.utcnow,
+            editable=False,
+    )
+    confirmed = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(null=True, blank=True)
+
+    objects = MutationManager()
+
+    class Meta:
+        ordering = ('-pk',)
+
+    def get_parameters(self):
+        return json.loads(self.parameters)
+
+    def __unicode__(self):
+        return u"%s %s" % (self.get_operation_display(),
+                           (self.assignment or self.hit).mturk_id)
+
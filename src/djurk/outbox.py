@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Sending the mutations recorded in the outbox
+
+Approvals, rejections, bonuses and HIT changes recorded with
+Mutation.objects (see MutationManager) are kept in the database until
+a Dispatcher has sent them, so they survive failed requests and
+crashes:
+
+    Mutation.objects.approve(assignments, feedback="Thanks!")
+    Dispatcher(workers=8).run(once=True)
+
+The dispatcher claims a batch of due mutations with one UPDATE, sends
+them on workers threads through the usual rate limited connections,
+then marks the confirmed ones in one UPDATE. Mutations that failed to
+reach Mechanical Turk (or were throttled, or hit a server error) are
+retried later with an exponential backoff, up to max_attempts times;
+the others are failed. Finally the local HITs and assignments are
+updated, one UPDATE per operation and arguments.
+
+Several dispatchers (threads or processes) can share the outbox. A
+dispatcher that dies while sending leaves its batch to be claimed
+again once the lease has run out; a dispatcher whose lease ran out
+leaves the outcome of the batch to the one that claimed it since.
+Bonuses and extensions are sent with their idempotency key as the
+UniqueRequestToken, so they are never made twice. Approving or
+rejecting an assignment, or changing a HIT's reviewing status, a
+second time is refused by Mechanical Turk: when a later attempt is
+refused so, the dispatcher checks whether an earlier attempt, whose
+response was lost, made the change, and if so counts it confirmed.
+Failed mutations are sent again if they are recorded again, or with
+MutationManager.retry(), except for bonuses and extensions whose token
+has expired (see TOKEN_LIFETIME).
+"""
+
+import collections
+import datetime
+import httplib
+import json
+import logging
+import socket
+import time
+import traceback
+import uuid
+from multiprocessing.pool import ThreadPool
+
+import boto
+from boto.exception import BotoServerError
+from django.db import transaction
+from django.db.models import F, Q
+
+from djurk.common import MAX_PAGE_SIZE, iter_pages, pooled_connection
+from djurk.models import Assignment, HIT, Mutation
+from djurk.publish import is_duplicate_request
+from djurk.throttle import backoff_delay, is_throttling_error
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DISPATCH_WORKERS = 4
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_MAX_ATTEMPTS = 8
+# Seconds before a failed mutation is retried: up to RETRY_BASE * 2 **
+# (attempts - 1), but no more than RETRY_CAP
+RETRY_BASE = 30.0
+RETRY_CAP = 60 * 60.0
+# Seconds after which a batch claimed by a dispatcher that didn't
+# finish it can be claimed again
+DEFAULT_LEASE = 10 * 60
+# Seconds to wait before looking for mutations again when none are due
+DEFAULT_INTERVAL = 5
+# Error codes of the requests refused in the current state of their
+# assignment or HIT, such as approving an approved assignment
+INVALID_STATE_ERRORS = (
+    'AWS.MechanicalTurk.InvalidAssignmentState',
+    'AWS.MechanicalTurk.InvalidHITState',
+)
+
+
+def _approve(connection, mutation, parameters):
+    connection.approve_assignment(mutation.assignment.mturk_id,
+                                  feedback=parameters['feedback'])
+
+
+def _reject(connection, mutation, parameters):
+    connection.reject_assignment(mutation.assignment.mturk_id,
+                                 feedback=parameters['feedback'])
+
+
+def _bonus(connection, mutation, parameters):
+    # Boto's grant_bonus() does not take a UniqueRequestToken
+    price = boto.mturk.price.Price(amount=parameters['value'])
+    params = price.get_as_params('BonusAmount', 1)
+    params.update({
+        'WorkerId': mutation.assignment.worker_id,
+        'AssignmentId': mutation.assignment.mturk_id,
+        'Reason': parameters['feedback'],
+        'UniqueRequestToken': mutation.idempotency_key,
+    })
+    connection._process_request('GrantBonus', params)
+
+
+def _expire(connection, mutation, parameters):
+    connection.expire_hit(mutation.hit.mturk_id)
+
+
+def _extend(connection, mutation, parameters):
+    # Nor does extend_hit()
+    params = {
+        'HITId': mutation.hit.mturk_id,
+        'UniqueRequestToken': mutation.idempotency_key,
+    }
+    if parameters['assignments_increment']:
+        params['MaxAssignmentsIncrement'] = parameters[
+                'assignments_increment']
+    if parameters['expiration_increment']:
+        params['ExpirationIncrementInSeconds'] = parameters[
+                'expiration_increment']
+    connection._process_request('ExtendHIT', params)
+
+
+def _set_reviewing(connection, mutation, parameters):
+    connection.set_reviewing(mutation.hit.mturk_id,
+                             revert=parameters['revert'])
+
+
+SENDERS = {
+    Mutation.APPROVE: _approve,
+    Mutation.REJECT: _reject,
+    Mutation.BONUS: _bonus,
+    Mutation.EXPIRE: _expire,
+    Mutation.EXTEND: _extend,
+    Mutation.SET_REVIEWING: _set_reviewing,
+}
+
+
+def _has_assignment_status(connection, mutation, status):
+    assignment = mutation.assignment
+
+    def fetch_page(page_number, page_size):
+        return connection.get_assignments(
+                assignment.hit.mturk_id, status=status, page_size=page_size,
+                page_number=page_number)
+    return any(mturk_assignment.AssignmentId == assignment.mturk_id
+               for page in iter_pages(fetch_page, page_size=MAX_PAGE_SIZE,
+                                      workers=1)
+               for mturk_assignment in page)
+
+
+def _is_approved(connection, mutation, parameters):
+    return _has_assignment_status(connection, mutation, 'Approved')
+
+
+def _is_rejected(connection, mutation, parameters):
+    return _has_assignment_status(connection, mutation, 'Rejected')
+
+
+def _is_expired(connection, mutation, parameters):
+    return connection.get_hit(mutation.hit.mturk_id)[0].expired
+
+
+def _is_reviewing(connection, mutation, parameters):
+    status = 'Reviewable' if parameters['revert'] else 'Reviewing'
+    return connection.get_hit(mutation.hit.mturk_id)[0].HITStatus == status
+
+
+# How to tell whether Mechanical Turk has made the mutations that it
+# refuses to make twice
+CHECKS = {
+    Mutation.APPROVE: _is_approved,
+    Mutation.REJECT: _is_rejected,
+    Mutation.EXPIRE: _is_expired,
+    Mutation.SET_REVIEWING: _is_reviewing,
+}
+
+
+def is_invalid_state_error(error):
+    """Return True if error refused a request in the current state"""
+    return getattr(error, 'error_code', None) in INVALID_STATE_ERRORS
+
+
+def is_retryable_error(error):
+    """Return True if the mutation may succeed if it is sent again"""
+    if isinstance(error, BotoServerError):
+        return is_throttling_error(error) or error.status >= 500
+    return isinstance(error, (socket.error, httplib.HTTPException))
+
+
+def _apply_approvals(pks, parameters, confirmed):
+    Assignment.objects.filter(pk__in=pks).update(
+            status=Assignment.APPROVED, approval_time=confirmed,
+            requester_feedback=parameters['feedback'],
+            synced=datetime.datetime.utcnow())
+
+
+def _apply_rejections(pks, parameters, confirmed):
+    Assignment.objects.filter(pk__in=pks).update(
+            status=Assignment.REJECTED, rejection_time=confirmed,
+            requester_feedback=parameters['feedback'],
+            synced=datetime.datetime.utcnow())
+
+
+def _apply_hit_changes(pks, parameters, confirmed):
+    # The new status depends upon the assignments, so the poll
+    # scheduler is asked to update the HITs now
+    HIT.objects.filter(pk__in=pks).update(next_poll_time=confirmed)
+
+
+def _apply_reviewing(pks, parameters, confirmed):
+    status = HIT.REVIEWABLE if parameters['revert'] else HIT.REVIEWING
+    HIT.objects.filter(pk__in=pks).update(status=status)
+
+
+# How confirmed mutations update the local HITs (or assignments) of
+# their primary keys; bonuses change nothing stored locally
+APPLIERS = {
+    Mutation.APPROVE: _apply_approvals,
+    Mutation.REJECT: _apply_rejections,
+    Mutation.EXPIRE: _apply_hit_changes,
+    Mutation.EXTEND: _apply_hit_changes,
+    Mutation.SET_REVIEWING: _apply_reviewing,
+}
+
+
+def apply_confirmed(limit=None):
+    """Update the local state of confirmed mutations, and mark them done
+
+    The changes are made with one UPDATE per operation and arguments,
+    in a transaction. Returns the number of mutations done.
+    """
+    confirmed = Mutation.objects.filter(status=Mutation.CONFIRMED).order_by(
+            'pk').values_list('pk', 'operation', 'parameters',
+                              'assignment', 'hit', 'confirmed')
+    if limit is not None:
+        confirmed = confirmed[:limit]
+    confirmed = list(confirmed)
+    if not confirmed:
+        return 0
+
+    groups = collections.defaultdict(list)
+    for pk, operation, parameters, assignment, hit, when in confirmed:
+        groups[(operation, parameters, when)].append(assignment or hit)
+    with transaction.commit_on_success():
+        for (operation, parameters, when), pks in groups.items():
+            if operation in APPLIERS:
+                APPLIERS[operation](pks, json.loads(parameters), when)
+        Mutation.objects.filter(pk__in=[row[0] for row in confirmed],
+                                status=Mutation.CONFIRMED).update(
+                                        status=Mutation.DONE)
+    return len(confirmed)
+
+
+class Dispatcher(object):
+    """Sends the mutations of the outbox, batch_size at a time
+
+    The requests of a batch are made by up to workers threads.
+    """
+
+    def __init__(self, workers=DEFAULT_DISPATCH_WORKERS,
+                 batch_size=DEFAULT_BATCH_SIZE,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS, lease=DEFAULT_LEASE,
+                 clock=datetime.datetime.utcnow):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.lease = datetime.timedelta(seconds=lease)
+        self.clock = clock
+
+    def claim(self):
+        """Claim a batch of due mutations and return them"""
+        now = self.clock()
+        due = (Q(status=Mutation.PENDING, next_attempt__lte=now) |
+               Q(status=Mutation.SENDING, claimed__lt=now - self.lease))
+        pks = list(Mutation.objects.filter(due).order_by(
+                'next_attempt', 'pk').values_list('pk', flat=True)[
+                        :self.batch_size])
+        if not pks:
+            return []
+        claim = uuid.uuid4().hex
+        # Mutations claimed by another dispatcher meanwhile are skipped
+        Mutation.objects.filter(due, pk__in=pks).update(
+                status=Mutation.SENDING, claim=claim, claimed=now,
+                attempts=F('attempts') + 1)
+        Mutation.objects.filter(claim=claim,
+                                first_attempt__isnull=True).update(
+                                        first_attempt=now)
+        return list(Mutation.objects.filter(claim=claim).select_related(
+                'assignment__hit', 'hit'))
+
+    def send(self, mutation):
+        """Make mutation on Mechanical Turk; return the error, if any"""
+        parameters = mutation.get_parameters()
+        try:
+            with pooled_connection() as connection:
+                SENDERS[mutation.operation](connection, mutation, parameters)
+        except Exception as error:
+            if (mutation.operation in Mutation.REPEATABLE_OPERATIONS and
+                    is_duplicate_request(error)):
+                # Made by an earlier attempt
+                return None
+            if (mutation.attempts > 1 and mutation.operation in CHECKS and
+                    is_invalid_state_error(error)):
+                # Maybe made by an earlier attempt whose response was lost
+                try:
+                    with pooled_connection() as connection:
+                        if CHECKS[mutation.operation](connection, mutation,
+                                                      parameters):
+                            return None
+                except Exception as check_error:
+                    return check_error
+            return error
+        return None
+
+    def dispatch(self):
+        """Send one batch and update the local state
+
+        Returns a dictionary of the numbers of mutations confirmed,
+        retried later and failed, and done (made locally).
+        """
+        counts = {'confirmed': 0, 'retried': 0, 'failed': 0}
+        mutations = self.claim()
+        claim = mutations[0].claim if mutations else None
+        if len(mutations) > 1 and self.workers > 1:
+            pool = ThreadPool(min(self.workers, len(mutations)))
+            try:
+                errors = pool.map(self.send, mutations)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            errors = map(self.send, mutations)
+
+        now = self.clock()
+        confirmed = [mutation.pk for mutation, error in zip(mutations, errors)
+                     if error is None]
+        # Mutations claimed by another dispatcher since (once the lease
+        # ran out) are left to it
+        counts['confirmed'] = Mutation.objects.filter(
+                pk__in=confirmed, claim=claim).update(
+                        status=Mutation.CONFIRMED, confirmed=now, claim=None,
+                        last_error=None)
+        for mutation, error in zip(mutations, errors):
+            if error is None:
+                continue
+            message = u''.join(traceback.format_exception_only(
+                    type(error), error))
+            if (is_retryable_error(error) and
+                    mutation.attempts < self.max_attempts):
+                delay = backoff_delay(mutation.attempts - 1, base=RETRY_BASE,
+                                      cap=RETRY_CAP)
+                counts['retried'] += Mutation.objects.filter(
+                        pk=mutation.pk, claim=claim).update(
+                                status=Mutation.PENDING, claim=None,
+                                next_attempt=now + datetime.timedelta(
+                                        seconds=delay),
+                                last_error=message)
+            else:
+                logger.error("%s failed: %s" % (mutation, message))
+                counts['failed'] += Mutation.objects.filter(
+                        pk=mutation.pk, claim=claim).update(
+                                status=Mutation.FAILED, claim=None,
+                                last_error=message)
+        # Including the mutations confirmed by a dispatcher that
+        # stopped before making them locally
+        counts['done'] = apply_confirmed(limit=self.batch_size)
+        return counts
+
+    def run(self, once=False, interval=DEFAULT_INTERVAL, callback=None):
+        """Dispatch batches until there are no due mutations (with once)
+
+        Otherwise, look for due mutations every interval seconds.
+        callback, if given, is called with the counts of each batch.
+        """
+        while True:
+            counts = self.dispatch()
+            if callback is not None:
+                callback(counts)
+            if sum(counts.values()):
+                continue
+            if once:
+                return
+            time.sleep(interval)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Templates for publishing many similar HITs
+
+A HITTemplate holds what a batch of HITs has in common: the HIT type
+(title, description, reward...), which is registered once, and a
+function making each HIT's question from a row of data. The HITs are
+published with HIT.objects.publish_batch(template, rows).
+
+Each row is identified by a token derived from the template's batch
+name and the row. The token is stored as the HIT's (indexed)
+publish_token, and sent as its RequesterAnnotation and
+UniqueRequestToken, so publishing the same rows again (after a crash,
+for example) never creates a HIT twice.
+"""
+
+import datetime
+import hashlib
+
+import boto
+from boto.mturk.connection import MTurkConnection
+
+DEFAULT_DURATION = datetime.timedelta(hours=1)
+DEFAULT_LIFETIME = datetime.timedelta(days=7)
+DEFAULT_PUBLISH_WORKERS = 8
+DUPLICATE_REQUEST = 'AWS.MechanicalTurk.DuplicateRequest'
+
+
+def _seconds(duration):
+    return MTurkConnection.duration_as_seconds(duration)
+
+
+def is_duplicate_request(error):
+    """Return True if error says a request with the token was made before
+
+    Only the DuplicateRequest error code counts: other errors may well
+    mention the UniqueRequestToken.
+    """
+    code = getattr(error, 'error_code', None)
+    if code is not None:
+        return code == DUPLICATE_REQUEST
+    return DUPLICATE_REQUEST in (getattr(error, 'body', None) or '')
+
+
+class HITTemplate(object):
+    """What the HITs of a batch have in common
+
+    question is a function of a row returning the question of its HIT,
+    as a Boto QuestionForm or ExternalQuestion. batch names the batch;
+    rows are only recognized as already published within the same
+    batch. Rows are dictionaries; a row's 'id' (if any) identifies it,
+    and its 'attached_object' (if any) is attached to its HIT.
+    """
+
+    def __init__(self, title, description, reward, question, batch='',
+                 keywords=None, duration=DEFAULT_DURATION,
+                 lifetime=DEFAULT_LIFETIME, max_assignments=1,
+                 approval_delay=None, qualifications=None):
+        self.title = title
+        self.description = description
+        self.reward = reward
+        self.question = question
+        self.batch = batch
+        self.keywords = keywords
+        self.duration = duration
+        self.lifetime = lifetime
+        self.max_assignments = max_assignments
+        self.approval_delay = approval_delay
+        self.qualifications = qualifications
+        self.hit_type_id = None
+
+    def register(self, connection):
+        """Register the HIT type, once, and return its ID"""
+        if self.hit_type_id is None:
+            result = connection.register_hit_type(
+                    self.title, self.description, self.reward, self.duration,
+                    keywords=self.keywords,
+                    approval_delay=self.approval_delay,
+                    qual_req=self.qualifications)
+            self.hit_type_id = result.HITTypeId
+        return self.hit_type_id
+
+    def row_key(self, row):
+        if 'id' in row:
+            return unicode(row['id'])
+        return repr(sorted((key, value) for key, value in row.items()
+                           if key != 'attached_object'))
+
+    def token(self, row):
+        """Return the token identifying row's HIT (at most 64 characters)"""
+        key = u'%s\n%s' % (self.batch, self.row_key(row))
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def attached_object(self, row):
+        return row.get('attached_object')
+
+    def hit_fields(self):
+        """Return the HIT model fields known before the HIT is created"""
+        reward = MTurkConnection.get_price_as_price(self.reward)
+        fields = {
+            'hit_type_id': self.hit_type_id,
+            'title': self.title,
+            'description': self.description,
+            'keywords': MTurkConnection.get_keywords_as_string(
+                    self.keywords),
+            'reward': str(reward.amount),
+            'assignment_duration_in_seconds': _seconds(self.duration),
+            'lifetime_in_seconds': _seconds(self.lifetime),
+            'max_assignments': self.max_assignments,
+        }
+        if self.approval_delay is not None:
+            fields['auto_approval_delay_in_seconds'] = _seconds(
+                    self.approval_delay)
+        return fields
+
+    def create_hit(self, connection, row, token):
+        """Create row's HIT of the registered type, returning the Boto HIT
+
+        Boto's create_hit() does not take a UniqueRequestToken, so the
+        request is made directly. The HIT details are asked for, to
+        store them without another request.
+        """
+        params = {
+            'HITTypeId': self.hit_type_id,
+            'Question': self.question(row).get_as_xml(),
+            'LifetimeInSeconds': _seconds(self.lifetime),
+            'MaxAssignments': self.max_assignments,
+            'RequesterAnnotation': token,
+            'UniqueRequestToken': token,
+            'ResponseGroup.1': 'Minimal',
+            'ResponseGroup.2': 'HITDetail',
+        }
+        return connection._process_request(
+                'CreateHIT', params, [('HIT', boto.mturk.connection.HIT)])[0]
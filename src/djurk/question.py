@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Question templates for creating many near-identical HITs
+
+Building a Boto QuestionForm and serializing it to XML for each HIT is
+wasted work when the HITs only differ in a few values. A
+QuestionTemplate builds the form once, with markers in place of those
+values, and keeps the serialized XML as a skeleton of literal text and
+fields. Rendering a HIT's question then only joins the skeleton with the
+escaped values:
+
+    def build(fields):
+        content = QuestionContent()
+        content.append(FormattedContent(
+                u"<p>What color is %s?</p>" % fields['thing']))
+        ...
+        return question_form
+
+    template = QuestionTemplate(build, ['thing'])
+    connection.create_hit(question=template.render(thing=u'the sky'), ...)
+
+Values are escaped for where they appear: inside CDATA sections (as in
+FormattedContent) only the end of the section has to be escaped, and
+elsewhere the XML special characters are. The skeletons are cached by
+template, so templates built from the same function (or XML) share one;
+only the MAX_SKELETONS most recently used are kept.
+"""
+
+import collections
+import hashlib
+import re
+import threading
+from xml.sax.saxutils import escape
+
+from boto.mturk.question import QuestionForm
+
+_FIELD_MARKER = u'@@djurk:%s@@'
+_FIELD_MARKER_PATTERN = re.compile(ur'@@djurk:([A-Za-z_]\w*)@@')
+# Placeholders of QuestionTemplate.from_xml()
+_PLACEHOLDER_PATTERN = re.compile(ur'\$\{([A-Za-z_]\w*)\}')
+
+_XML_ENTITIES = {'"': '&quot;', "'": '&apos;'}
+
+# Skeletons by template key, least recently used first
+MAX_SKELETONS = 128
+_skeletons = collections.OrderedDict()
+_skeletons_lock = threading.Lock()
+
+
+def escape_text(value):
+    """Escape value for XML character data or attribute values"""
+    return escape(value, _XML_ENTITIES)
+
+
+def escape_cdata(value):
+    """Escape value for the inside of a CDATA section"""
+    return value.replace(u']]>', u']]]]><![CDATA[>')
+
+
+def compile_skeleton(xml, pattern=_FIELD_MARKER_PATTERN):
+    """Split xml into literal text and the fields matched by pattern
+
+    Returns a list alternating literal strings and (field name, escape
+    function) pairs, starting and ending with a literal.
+    """
+    if isinstance(xml, str):
+        xml = xml.decode('utf-8')
+    skeleton = []
+    position = 0
+    for match in pattern.finditer(xml):
+        before = xml[:match.start()]
+        if before.rfind(u'<![CDATA[') > before.rfind(u']]>'):
+            escape_field = escape_cdata
+        else:
+            escape_field = escape_text
+        skeleton.append(xml[position:match.start()])
+        skeleton.append((match.group(1), escape_field))
+        position = match.end()
+    skeleton.append(xml[position:])
+    return skeleton
+
+
+class RenderedQuestion(QuestionForm):
+    """A question serialized by a QuestionTemplate
+
+    This is a QuestionForm so that Boto's create_hit() sends it as is.
+    """
+
+    def __init__(self, xml):
+        QuestionForm.__init__(self)
+        self.xml = xml
+
+    def get_as_xml(self):
+        return self.xml
+
+
+class QuestionTemplate(object):
+    """A question whose XML is built once and rendered with values
+
+    build is a function that takes a dictionary of markers (one for each
+    of fields) and returns a Boto QuestionForm, ExternalQuestion or any
+    object with a get_as_xml() method, with the markers wherever the
+    values should go. It is called once per process.
+
+    A QuestionTemplate is also a function of a row, as expected by
+    djurk.publish.HITTemplate: template(row) renders the row's values.
+    """
+
+    def __init__(self, build=None, fields=(), xml=None):
+        assert (build is None) != (xml is None)
+        self.build = build
+        self.fields = tuple(fields)
+        self.xml = xml
+        if xml is None:
+            self.key = (build, self.fields)
+        else:
+            if isinstance(xml, unicode):
+                xml = xml.encode('utf-8')
+            self.key = hashlib.sha1(xml).hexdigest()
+        self._skeleton = None
+
+    @classmethod
+    def from_xml(cls, xml):
+        """Make a template of question XML with ${field} placeholders"""
+        return cls(xml=xml)
+
+    def _compile(self):
+        if self.xml is not None:
+            return compile_skeleton(self.xml, _PLACEHOLDER_PATTERN)
+        markers = dict((field, _FIELD_MARKER % field)
+                       for field in self.fields)
+        return compile_skeleton(self.build(markers).get_as_xml())
+
+    @property
+    def skeleton(self):
+        if self._skeleton is None:
+            with _skeletons_lock:
+                skeleton = _skeletons.pop(self.key, None)
+                if skeleton is None:
+                    skeleton = self._compile()
+                _skeletons[self.key] = skeleton
+                while len(_skeletons) > MAX_SKELETONS:
+                    _skeletons.popitem(last=False)
+            self._skeleton = skeleton
+        return self._skeleton
+
+    def _substitute(self, values):
+        skeleton = self.skeleton
+        parts = list(skeleton)
+        for i in xrange(1, len(parts), 2):
+            name, escape_field = skeleton[i]
+            parts[i] = escape_field(unicode(values[name]))
+        return u''.join(parts)
+
+    def render_xml(self, **values):
+        """Return the question XML with values in place of the fields"""
+        return self._substitute(values)
+
+    def render(self, **values):
+        """Return the question, with values, for Boto's create_hit()"""
+        return RenderedQuestion(self._substitute(values))
+
+    def __call__(self, row):
+        return RenderedQuestion(self._substitute(row))
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Deadline-aware polling of HITs
+
+Rather than re-polling every HIT on a fixed interval, the PollScheduler
+keeps the time each HIT is next due in a priority queue. The due time
+depends upon what can still change remotely: disposed HITs are never
+polled, finished HITs rarely, and HITs are polled soon after they
+expire or after one of their assignments is automatically approved.
+
+The due times are stored in HIT.next_poll_time, so a restarted
+scheduler continues where it left off instead of resynchronizing
+everything.
+"""
+
+import datetime
+import heapq
+import logging
+import time
+
+from django.db.models import Min, Q
+
+from djurk.common import MAX_PAGE_SIZE
+from djurk.helpers import update_all_hits
+from djurk.models import HIT, Assignment
+from djurk.signals import sync_finished
+from djurk.stats import SyncStats
+
+# Polling intervals, in seconds
+ACTIVE_INTERVAL = 5 * 60  # HITs that workers may still be working on
+TERMINAL_INTERVAL = 6 * 60 * 60  # Reviewable HITs with nothing pending
+ERROR_INTERVAL = 60  # Retry delay after a failed poll
+MIN_INTERVAL = 30
+# Poll this long after an expiration or auto-approval, so that the
+# change has taken place on Mechanical Turk
+MILESTONE_DELAY = 30
+# How often the complete list of HITs is searched for new HITs
+DISCOVERY_INTERVAL = 60 * 60
+# Shortest sleep between cycles, so that a HIT due in a moment doesn't
+# make the scheduler query the database in a busy loop
+MIN_SLEEP = 0.1
+
+logger = logging.getLogger(__name__)
+
+
+def _seconds(seconds):
+    return datetime.timedelta(seconds=seconds)
+
+
+def earliest_milestones(hits, now):
+    """Return the earliest future assignment milestone of each HIT
+
+    The milestones are the auto_approval_time and the deadline (the
+    accept time plus the HIT's assignment duration, filled in by the
+    synchronization) of assignments that are not yet reviewed.
+    Returns a dictionary of HIT primary keys to datetimes; HITs without
+    a future milestone are left out.
+    """
+    milestones = {}
+    rows = Assignment.objects.filter(
+            Q(status=Assignment.SUBMITTED) | Q(status__isnull=True),
+            hit__in=[hit.pk for hit in hits]).values('hit').annotate(
+            Min('auto_approval_time'), Min('deadline'))
+    for row in rows:
+        times = [value for value in (row['auto_approval_time__min'],
+                                     row['deadline__min'])
+                 if value is not None and value > now]
+        if times:
+            milestones[row['hit']] = min(times)
+    return milestones
+
+
+def next_poll_time(hit, now, milestone=None):
+    """Return when hit should next be polled (None for never)
+
+    milestone is the earliest future auto_approval_time or deadline
+    among the HIT's assignments, as found by earliest_milestones().
+    """
+    if hit.status == HIT.DISPOSED:
+        return None
+    if hit.status is None:
+        # Never synchronized
+        return now
+
+    if hit.status in (HIT.REVIEWABLE, HIT.REVIEWING) and \
+            not hit.number_of_assignments_pending:
+        interval = TERMINAL_INTERVAL
+    else:
+        interval = ACTIVE_INTERVAL
+    due = now + _seconds(interval)
+
+    milestones = [milestone]
+    if hit.creation_time is not None and hit.lifetime_in_seconds:
+        milestones.append(hit.creation_time +
+                          _seconds(hit.lifetime_in_seconds))
+    for milestone in milestones:
+        if milestone is not None and now < milestone < due:
+            due = milestone + _seconds(MILESTONE_DELAY)
+    return max(due, now + _seconds(MIN_INTERVAL))
+
+
+class PollScheduler(object):
+    """Poll HITs when they are due
+
+    The queue is a heap of (due time, HIT primary key) entries. A HIT
+    that is rescheduled leaves its old entry behind; entries that no
+    longer match self.due are skipped when they are popped.
+
+    New HITs are found by searching all HITs every discovery_interval
+    seconds. clock and sleep can be replaced for testing.
+    """
+
+    def __init__(self, do_update_assignments=True,
+                 discovery_interval=DISCOVERY_INTERVAL,
+                 clock=datetime.datetime.utcnow, sleep=time.sleep):
+        self.do_update_assignments = do_update_assignments
+        self.discovery_interval = discovery_interval
+        self.clock = clock
+        self.sleep = sleep
+        self.queue = []
+        self.due = {}
+        self.next_discovery = None
+
+    def schedule(self, pk, due):
+        if due is None:
+            self.due.pop(pk, None)
+            return
+        self.due[pk] = due
+        heapq.heappush(self.queue, (due, pk))
+
+    def load(self):
+        """Fill the queue from the stored next_poll_time of each HIT
+
+        HITs that were never scheduled are due immediately. The first
+        discovery takes place at once only when there is nothing to
+        schedule, so a restart does not search every HIT again.
+        """
+        now = self.clock()
+        self.queue = []
+        self.due = {}
+        # HITs still being published have no HIT ID yet
+        rows = HIT.objects.exclude(status=HIT.DISPOSED).filter(
+                mturk_id__isnull=False).values_list('pk', 'next_poll_time')
+        for pk, due in rows:
+            self.due[pk] = due or now
+        self.queue = [(due, pk) for pk, due in self.due.items()]
+        heapq.heapify(self.queue)
+        if self.queue:
+            self.next_discovery = now + _seconds(self.discovery_interval)
+        else:
+            self.next_discovery = now
+
+    def discover(self, stats):
+        """Search all HITs and schedule the ones not yet in the queue"""
+        # update_all_hits() collects its own requests and queries
+        stats.merge(update_all_hits(batch_size=MAX_PAGE_SIZE))
+        now = self.clock()
+        with stats.instrument(requests=False):
+            for pk in HIT.objects.exclude(status=HIT.DISPOSED).filter(
+                    mturk_id__isnull=False, next_poll_time__isnull=True
+                    ).values_list('pk', flat=True):
+                if pk not in self.due:
+                    self.schedule(pk, now)
+        self.next_discovery = now + _seconds(self.discovery_interval)
+
+    def reschedule(self, hits, now):
+        """Store and queue the next poll time of each of hits"""
+        milestones = earliest_milestones(hits, now)
+        for hit in hits:
+            due = next_poll_time(hit, now, milestones.get(hit.pk))
+            HIT.objects.filter(pk=hit.pk).update(next_poll_time=due)
+            self.schedule(hit.pk, due)
+
+    def poll(self, hit, stats):
+        """Update one HIT (and its assignments) and reschedule it"""
+        try:
+            written = hit.update()
+            stats.count('hits', {written and 'updated' or 'unchanged': 1})
+            if self.do_update_assignments:
+                stats.count('assignments', hit.update_assignments())
+        except Exception:
+            logger.exception("Polling HIT %s failed", hit.mturk_id)
+            stats.errors += 1
+            due = self.clock() + _seconds(ERROR_INTERVAL)
+            HIT.objects.filter(pk=hit.pk).update(next_poll_time=due)
+            self.schedule(hit.pk, due)
+            return
+        self.reschedule([hit], self.clock())
+
+    def due_hits(self, now):
+        """Pop and return the primary keys of the HITs due by now"""
+        pks = []
+        while self.queue and self.queue[0][0] <= now:
+            due, pk = heapq.heappop(self.queue)
+            if self.due.get(pk) == due:
+                del self.due[pk]
+                pks.append(pk)
+        return pks
+
+    def run_once(self):
+        """Poll every HIT that is due, searching for new HITs if due
+
+        Returns a SyncStats object describing the work done, which is
+        also sent with the djurk.signals.sync_finished signal.
+        """
+        stats = SyncStats()
+        if self.next_discovery is None:
+            with stats.instrument():
+                self.load()
+        if self.next_discovery <= self.clock():
+            self.discover(stats)
+        with stats.instrument():
+            pks = self.due_hits(self.clock())
+            for hit in HIT.objects.filter(pk__in=pks):
+                self.poll(hit, stats)
+        stats.finish()
+        sync_finished.send(sender=self.__class__, source='scheduled',
+                           stats=stats)
+        return stats
+
+    def next_wakeup(self):
+        """Return the time the next HIT or discovery is due"""
+        wakeup = self.next_discovery
+        while self.queue and self.due.get(self.queue[0][1]) != \
+                self.queue[0][0]:
+            heapq.heappop(self.queue)
+        if self.queue:
+            wakeup = min(wakeup, self.queue[0][0])
+        return wakeup
+
+    def run_forever(self, callback=None):
+        """Poll HITs as they become due, forever
+
+        callback, if given, is called with the SyncStats of each cycle.
+        """
+        while True:
+            stats = self.run_once()
+            if callback is not None:
+                callback(stats)
+            delay = self.next_wakeup() - self.clock()
+            self.sleep(max(delay.total_seconds(), MIN_SLEEP))
@@ -0,0 +1,19 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Signals for instrumenting Djurk
+
+mturk_request is sent after each request made to Mechanical Turk (each
+attempt, when a request is retried), from the thread that made it, with
+the operation name, its duration in seconds and the exception raised
+(or None).
+
+sync_finished is sent when a synchronization cycle is done, with its
+source (djurk.helpers.ALL_HITS or REVIEWABLE_HITS, or 'scheduled') and
+the SyncStats describing it.
+"""
+
+from django.dispatch import Signal
+
+mturk_request = Signal(providing_args=['operation', 'duration', 'error'])
+sync_finished = Signal(providing_args=['source', 'stats'])
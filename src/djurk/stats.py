@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Statistics collected while synchronizing with Mechanical Turk"""
+
+import bisect
+import threading
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.backends.util import CursorWrapper
+
+from djurk.signals import mturk_request
+
+# Upper bounds, in seconds, of the buckets of the request latency
+# histograms; the last bucket counts the slower requests
+LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_WRITES = ('INSERT', 'UPDATE', 'DELETE')
+
+# Guards the request statistics, which are recorded by many threads
+_record_lock = threading.Lock()
+
+
+class _CountingCursor(CursorWrapper):
+    """A cursor reporting its queries to the connection's QueryCounters"""
+
+    def _count(self, sql, started):
+        duration = time.time() - started
+        written = 0
+        if sql.lstrip()[:6].upper() in _WRITES:
+            written = max(self.cursor.rowcount, 0)
+        for counter in self.db.djurk_query_counters:
+            counter.queries += 1
+            counter.time += duration
+            counter.rows_written += written
+
+    def execute(self, sql, params=()):
+        self.set_dirty()
+        started = time.time()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            self._count(sql, started)
+
+    def executemany(self, sql, param_list):
+        self.set_dirty()
+        started = time.time()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            self._count(sql, started)
+
+
+class QueryCounter(object):
+    """Counts the queries run on this thread's connection to a database
+
+    Use it as a context manager; the queries run inside the with block
+    are counted in queries, their total duration in time and the rows
+    they inserted, updated or deleted in rows_written. Counters can be
+    nested. Django's own query logging (with DEBUG) is kept.
+    """
+
+    def __init__(self, using=DEFAULT_DB_ALIAS):
+        self.using = using
+        self.queries = 0
+        self.time = 0.0
+        self.rows_written = 0
+
+    def __enter__(self):
+        connection = connections[self.using]
+        if not getattr(connection, 'djurk_query_counters', None):
+            connection.djurk_query_counters = []
+            debug = connection.use_debug_cursor
+            connection.djurk_saved_debug = debug
+            if debug or (debug is None and settings.DEBUG):
+                wrap = lambda cursor: type(connection).make_debug_cursor(
+                        connection, cursor)
+            else:
+                wrap = lambda cursor: cursor
+            connection.use_debug_cursor = True
+            connection.make_debug_cursor = lambda cursor: _CountingCursor(
+                    wrap(cursor), connection)
+        connection.djurk_query_counters.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        connection = connections[self.using]
+        connection.djurk_query_counters.remove(self)
+        if not connection.djurk_query_counters:
+            connection.use_debug_cursor = connection.djurk_saved_debug
+            del connection.make_debug_cursor
+
+
+class SyncStats(object):
+    """Counters describing one synchronization cycle
+
+    The counters are plain integers so that statistics collected in
+    worker threads or processes can be pickled and merged into the
+    coordinator's statistics with merge().
+    """
+
+    COUNTERS = (
+        'pages',
+        'errors',
+        'hits_inserted',
+        'hits_updated',
+        'hits_unchanged',
+        'hits_columns_written',
+        'assignments_inserted',
+        'assignments_updated',
+        'assignments_unchanged',
+        'assignments_columns_written',
+        'db_queries',
+        'db_time',
+    )
+
+    def __init__(self):
+        for counter in self.COUNTERS:
+            setattr(self, counter, 0)
+        # Mechanical Turk requests by operation: how many were made,
+        # how many failed, their total duration and a histogram of
+        # their durations (see LATENCY_BUCKETS)
+        self.api_calls = {}
+        self.api_errors = {}
+        self.api_time = {}
+        self.api_latency = {}
+        self.started = time.time()
+        self.duration = None
+
+    def count(self, kind, counts):
+        """Add the 'inserted', 'updated' and 'unchanged' counts of kind
+
+        kind is either 'hits' or 'assignments', and counts is a
+        dictionary as returned by the sync_from_mturk() manager methods
+        (which also counts the 'columns_written').
+        """
+        for name, value in counts.items():
+            counter = '%s_%s' % (kind, name)
+            setattr(self, counter, getattr(self, counter) + value)
+
+    def record_request(self, operation, duration, error=None):
+        """Count a Mechanical Turk request, which took duration seconds"""
+        with _record_lock:
+            self.api_calls[operation] = self.api_calls.get(operation, 0) + 1
+            if error is not None:
+                self.api_errors[operation] = self.api_errors.get(
+                        operation, 0) + 1
+            self.api_time[operation] = self.api_time.get(
+                    operation, 0.0) + duration
+            histogram = self.api_latency.setdefault(
+                    operation, [0] * (len(LATENCY_BUCKETS) + 1))
+            histogram[bisect.bisect_left(LATENCY_BUCKETS, duration)] += 1
+
+    def _on_request(self, sender, operation, duration, error, **kwargs):
+        self.record_request(operation, duration, error)
+
+    def instrument(self, requests=True, queries=True):
+        """Return a context manager recording into these statistics
+
+        While it is active, the Mechanical Turk requests made by any
+        thread of the process (if requests is true) and the database
+        queries made by the current thread (if queries is true) are
+        counted.
+        """
+        return _Instrumentation(self, requests, queries)
+
+    def merge(self, other):
+        """Add the counters of another SyncStats to this one"""
+        for counter in self.COUNTERS:
+            setattr(self, counter,
+                    getattr(self, counter) + getattr(other, counter))
+        for name in ('api_calls', 'api_errors', 'api_time'):
+            mine = getattr(self, name)
+            for operation, value in getattr(other, name).items():
+                mine[operation] = mine.get(operation, 0) + value
+        for operation, histogram in other.api_latency.items():
+            mine = self.api_latency.setdefault(operation,
+                                               [0] * len(histogram))
+            for bucket, count in enumerate(histogram):
+                mine[bucket] += count
+
+    def finish(self):
+        self.duration = time.time() - self.started
+
+    @property
+    def hits(self):
+        return self.hits_inserted + self.hits_updated + self.hits_unchanged
+
+    @property
+    def assignments(self):
+        return (self.assignments_inserted + self.assignments_updated +
+                self.assignments_unchanged)
+
+    @property
+    def rows_skipped(self):
+        """Rows that were left alone because their data was unchanged"""
+        return self.hits_unchanged + self.assignments_unchanged
+
+    @property
+    def api_requests(self):
+        return sum(self.api_calls.values())
+
+    @property
+    def rows_written(self):
+        return (self.hits_inserted + self.hits_updated +
+                self.assignments_inserted + self.assignments_updated)
+
+    def as_dict(self):
+        result = dict((counter, getattr(self, counter))
+                      for counter in self.COUNTERS)
+        result['rows_skipped'] = self.rows_skipped
+        result['rows_written'] = self.rows_written
+        result['duration'] = self.duration
+        result['api_calls'] = dict(self.api_calls)
+        result['api_errors'] = dict(self.api_errors)
+        result['api_time'] = dict(self.api_time)
+        result['api_latency'] = dict(
+                (operation, {'buckets': list(LATENCY_BUCKETS),
+                             'counts': list(histogram)})
+                for operation, histogram in self.api_latency.items())
+        return result
+
+    def __unicode__(self):
+        return (u"%d HITs (%d new, %d changed), %d assignments "
+                u"(%d new, %d changed), %d rows written, %d unchanged rows "
+                u"skipped, %d pages, %d errors, %d requests (%.1fs), "
+                u"%d queries (%.1fs) in %.1fs" % (
+                    self.hits, self.hits_inserted, self.hits_updated,
+                    self.assignments, self.assignments_inserted,
+                    self.assignments_updated, self.rows_written,
+                    self.rows_skipped, self.pages, self.errors,
+                    self.api_requests, sum(self.api_time.values()),
+                    self.db_queries, self.db_time, self.duration or 0))
+    __str__ = __unicode__
+
+    def requests_summary(self):
+        """Describe the requests made, by operation, on one line"""
+        return u", ".join(
+                u"%s: %d (%d failed, %.3fs average)" % (
+                    operation, count, self.api_errors.get(operation, 0),
+                    self.api_time[operation] / count)
+                for operation, count in sorted(self.api_calls.items()))
+
+
+class _Instrumentation(object):
+    def __init__(self, stats, requests, queries):
+        self.stats = stats
+        self.requests = requests
+        self.counter = queries and QueryCounter() or None
+
+    def __enter__(self):
+        if self.requests:
+            mturk_request.connect(self.stats._on_request, weak=False,
+                                  dispatch_uid=('djurk.stats',
+                                                id(self.stats)))
+        if self.counter is not None:
+            self.counter.__enter__()
+        return self.stats
+
+    def __exit__(self, *exc_info):
+        if self.requests:
+            mturk_request.disconnect(dispatch_uid=('djurk.stats',
+                                                   id(self.stats)))
+        if self.counter is not None:
+            self.counter.__exit__(*exc_info)
+            self.stats.db_queries += self.counter.queries
+            self.stats.db_time += self.counter.time
@@ -13,19 +13,63 @@
 # certain that this code does get exercised.
 
 import datetime
+import json
 import os
+import socket
+import StringIO
 import tempfile
+import threading
 
 import boto
+import boto.mturk.question
+from boto.exception import BotoServerError
+from boto.mturk.connection import MTurkRequestError
 import django
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
 django_version = (django.VERSION[0] * 10.0 + django.VERSION[1] * 1.0) / 10
 if django_version >= 1.4:
     from django.test.utils import override_settings
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
+from django.test.client import RequestFactory
 
-from djurk.common import (PRODUCTION_HOST, PRODUCTION_WORKER_URL, SANDBOX_HOST,
-        SANDBOX_WORKER_URL, InvalidDjurkSettings, amazon_string_to_datetime,
-        get_host, get_connection, get_worker_url, is_sandbox)
+from djurk.admin import (EstimatedCountPaginator, HighScaleAssignmentAdmin,
+        HighScaleHITAdmin, HIT_Admin, AssignmentAdmin, approve_assignment,
+        dispose_hit, estimated_count, poll_all_hits, update_hit)
+from djurk.benchmark import SCENARIOS, Benchmark
+from djurk.common import (FAKE_HOST, PRODUCTION_HOST, PRODUCTION_WORKER_URL,
+        SANDBOX_HOST, SANDBOX_WORKER_URL, ConnectionPool, InvalidDjurkSettings,
+        amazon_string_to_datetime, get_host, get_connection, get_worker_url,
+        get_admin_mode, get_config, get_response_cache, is_sandbox,
+        iter_pages, MAX_PAGE_SIZE, DEFAULT_ADMIN, HIGH_SCALE_ADMIN)
+from djurk import common
+from djurk.engine import PipelinedSync
+from djurk.fake import FakeMTurk, FakeMTurkConnection, seeded_hit_id
+from djurk.helpers import (ALL_HITS, _sync_hit_page, _update_hits,
+        update_all_hits, update_reviewable_hits)
+from djurk.jobs import (DEFAULT_LEASE, claim_job, fail_stale_jobs,
+        run_job)
+from djurk.management.commands.export_results import read_watermark
+from djurk.models import HIT, Assignment, Job, KeyValue, Mutation
+from djurk.outbox import Dispatcher, apply_confirmed
+from djurk.publish import HITTemplate, is_duplicate_request
+from djurk.question import MAX_SKELETONS, QuestionTemplate, _skeletons
+from djurk.cache import CachedMTurkConnection, ResponseCache
+from djurk.throttle import ThrottledMTurkConnection, TokenBucket
+from djurk.scheduler import (ACTIVE_INTERVAL, MILESTONE_DELAY,
+        TERMINAL_INTERVAL, PollScheduler, next_poll_time)
+from djurk import metrics
+from djurk.metrics import (AGGREGATES_CACHE_KEY, SyncMetrics, snapshot_key,
+        store_snapshot)
+from djurk.signals import sync_finished
+from djurk.stats import LATENCY_BUCKETS, QueryCounter, SyncStats
 
 
 # This needs @override_settings/self.settings which is only available
@@ -156,6 +200,48 @@ if django_version >= 1.4:
                 self.assertTrue(isinstance(get_connection(),
                                 boto.mturk.connection.MTurkConnection))
 
+        def test_fake_host(self):
+            with self.settings(DJURK={'host': FAKE_HOST, 'fake_hits': 1000},
+                               DJURK_CONFIG_FILE=None):
+                connection = get_connection()
+                self.assertTrue(isinstance(connection, FakeMTurkConnection))
+                self.assertTrue(connection.service is
+                                get_connection().service)
+                self.assertEqual(connection.search_hits().TotalNumResults,
+                                 '1000')
+
+        def test_config_is_cached(self):
+            with self.settings(DJURK={'host': SANDBOX_HOST},
+                               DJURK_CONFIG_FILE=None):
+                config = get_config()
+                self.assertTrue(get_config() is config)
+                # Changing settings without the signal is not noticed
+                settings.DJURK = {'host': PRODUCTION_HOST}
+                self.assertEqual(get_host(), SANDBOX_HOST)
+
+            with self.settings(DJURK={'host': PRODUCTION_HOST},
+                               DJURK_CONFIG_FILE=None):
+                self.assertFalse(get_config() is config)
+                self.assertEqual(get_host(), PRODUCTION_HOST)
+
+        def test_config_file_change_invalidates_config(self):
+            check_interval = common.CONFIG_CHECK_INTERVAL
+            common.CONFIG_CHECK_INTERVAL = 0
+            try:
+                with self.settings(DJURK=None,
+                        DJURK_CONFIG_FILE=self.djurk_config_filename):
+                    f = open(self.djurk_config_filename, 'w')
+                    f.write("[Connection]\nhost: %s\n" % SANDBOX_HOST)
+                    f.close()
+                    self.assertEqual(get_host(), SANDBOX_HOST)
+                    f = open(self.djurk_config_filename, 'w')
+                    f.write("[Connection]\nhost: http://%s\n" %
+                            PRODUCTION_HOST)
+                    f.close()
+                    self.assertEqual(get_host(), PRODUCTION_HOST)
+            finally:
+                common.CONFIG_CHECK_INTERVAL = check_interval
+
         def test_get_worker_url(self):
             with self.settings(DJURK={'host': PRODUCTION_HOST},
                                DJURK_CONFIG_FILE=None):
@@ -165,3 +251,1635 @@ if django_version >= 1.4:
                                DJURK_CONFIG_FILE=None):
                 self.assertEqual(get_worker_url(), SANDBOX_WORKER_URL)
                 self.assertNotEqual(get_worker_url(), PRODUCTION_WORKER_URL)
+
+
+class ConnectionPoolTests(TestCase):
+    class FakeConnection(object):
+        closed = False
+
+        def close(self):
+            self.closed = True
+
+    def setUp(self):
+        self.created = []
+        self.pool = ConnectionPool(max_size=2, factory=self.factory)
+
+    def factory(self):
+        connection = self.FakeConnection()
+        self.created.append(connection)
+        return connection
+
+    def test_connections_are_created_lazily(self):
+        self.assertEqual(self.created, [])
+        with self.pool.connection() as connection:
+            self.assertTrue(connection is self.created[0])
+        self.assertEqual(len(self.created), 1)
+
+    def test_connections_are_reused(self):
+        with self.pool.connection() as first:
+            pass
+        with self.pool.connection() as second:
+            self.assertTrue(first is second)
+        self.assertEqual(len(self.created), 1)
+
+    def test_concurrent_checkouts_get_distinct_connections(self):
+        with self.pool.connection() as first:
+            with self.pool.connection() as second:
+                self.assertFalse(first is second)
+        self.assertEqual(len(self.created), 2)
+
+    def test_clear_retires_connections(self):
+        with self.pool.connection() as checked_out:
+            self.pool.clear()
+        self.assertTrue(checked_out.closed)
+        with self.pool.connection() as connection:
+            self.assertFalse(connection is checked_out)
+
+    def test_model_instantiation_does_not_connect(self):
+        hit = HIT(mturk_id='ABC')
+        self.assertFalse(hasattr(hit, 'connection'))
+
+
+def make_mturk_hit(hit_id, **attributes):
+    """Return a Boto HIT object like the ones returned by SearchHITs"""
+
+    mturk_hit = boto.mturk.connection.HIT(None)
+    values = {
+        'HITId': hit_id,
+        'HITTypeId': 'TYPE1',
+        'HITStatus': 'Assignable',
+        'Amount': '0.05',
+        'AssignmentDurationInSeconds': '900',
+        'AutoApprovalDelayInSeconds': '2592000',
+        'MaxAssignments': '1',
+        'CreationTime': '2012-04-04T22:31:03Z',
+        'Description': 'A description',
+        'Title': 'A title',
+        'Keywords': 'a, b',
+        'NumberOfAssignmentsPending': '0',
+        'NumberOfAssignmentsAvailable': '1',
+        'NumberOfAssignmentsCompleted': '0',
+    }
+    values.update(attributes)
+    for name, value in values.items():
+        setattr(mturk_hit, name, value)
+    return mturk_hit
+
+
+class HITSyncTests(TestCase):
+    def test_sync_from_mturk_inserts_and_updates(self):
+        HIT.objects.sync_from_mturk([make_mturk_hit('A'),
+                                     make_mturk_hit('B')])
+        self.assertEqual(HIT.objects.count(), 2)
+        hit = HIT.objects.get(mturk_id='A')
+        self.assertEqual(hit.status, HIT.ASSIGNABLE)
+        self.assertEqual(hit.max_assignments, 1)
+        self.assertEqual(hit.number_of_assignments_available, 1)
+
+        counts = HIT.objects.sync_from_mturk([
+                make_mturk_hit('A', HITStatus='Reviewable'),
+                make_mturk_hit('B'),
+                make_mturk_hit('C')])
+        self.assertEqual(counts, {'inserted': 1, 'updated': 1,
+                                  'unchanged': 1, 'columns_written': 1})
+        self.assertEqual(HIT.objects.get(mturk_id='A').status,
+                         HIT.REVIEWABLE)
+
+    def test_unchanged_hits_are_not_written(self):
+        mturk_hits = [make_mturk_hit(str(i)) for i in range(20)]
+        HIT.objects.sync_from_mturk(mturk_hits)
+        # One query finds the existing rows; nothing is written
+        self.assertNumQueries(1, HIT.objects.sync_from_mturk, mturk_hits)
+
+    def test_update_skips_unchanged_hit(self):
+        hit = HIT(mturk_id='A')
+        self.assertTrue(hit.update(make_mturk_hit('A')))
+        self.assertNumQueries(0, hit.update, make_mturk_hit('A'))
+        self.assertTrue(hit.update(make_mturk_hit('A', Title='New title')))
+        self.assertEqual(HIT.objects.get().title, 'New title')
+
+    def test_changed_hits_are_counted(self):
+        HIT.objects.sync_from_mturk([make_mturk_hit('A')])
+        counts = HIT.objects.sync_from_mturk([make_mturk_hit(
+                'A', Title='New title', Description='New description')])
+        self.assertEqual(counts['updated'], 1)
+        self.assertEqual(counts['columns_written'], 2)
+
+    def test_update_hits_in_batches(self):
+        mturk_hits = [make_mturk_hit(str(i)) for i in range(25)]
+        _update_hits(mturk_hits, batch_size=10)
+        self.assertEqual(HIT.objects.count(), 25)
+
+
+def make_mturk_assignment(assignment_id, hit_id, answers=None, **attributes):
+    """Return a Boto Assignment object like GetAssignmentsForHIT does"""
+
+    mturk_assignment = boto.mturk.connection.Assignment(None)
+    values = {
+        'AssignmentId': assignment_id,
+        'HITId': hit_id,
+        'WorkerId': 'WORKER1',
+        'AssignmentStatus': 'Submitted',
+        'AutoApprovalTime': '2012-05-04T22:31:03Z',
+        'AcceptTime': '2012-04-04T22:31:03Z',
+        'SubmitTime': '2012-04-04T22:35:03Z',
+    }
+    values.update(attributes)
+    for name, value in values.items():
+        setattr(mturk_assignment, name, value)
+    question_form_answer = boto.mturk.connection.QuestionFormAnswer(None)
+    question_form_answer.fields = sorted((answers or {}).items())
+    mturk_assignment.answers = [[question_form_answer]]
+    return mturk_assignment
+
+
+class AnswerSyncTests(TestCase):
+    def setUp(self):
+        self.hit = HIT.objects.create(mturk_id='HIT1')
+        self.assignment = Assignment.objects.create(mturk_id='ASSIGNMENT1',
+                                                    hit=self.hit)
+
+    def answers(self):
+        return dict(self.assignment.answers.values_list('key', 'value'))
+
+    def test_sync_answers(self):
+        counts = KeyValue.objects.sync_answers({self.assignment.pk: {
+                'color': 'blue', 'comments': 'none', 'age': '4'}})
+        self.assertEqual(counts['inserted'], 3)
+
+        counts = KeyValue.objects.sync_answers({self.assignment.pk: {
+                'color': 'red', 'comments': 'none', 'size': 'L'}})
+        self.assertEqual(counts, {'inserted': 1, 'updated': 1,
+                                  'deleted': 1, 'unchanged': 1})
+        self.assertEqual(self.answers(),
+                         {'color': 'red', 'comments': 'none', 'size': 'L'})
+
+    def test_unchanged_answers_cost_one_query(self):
+        answers = dict(('field%d' % i, str(i)) for i in range(40))
+        KeyValue.objects.sync_answers({self.assignment.pk: answers})
+        self.assertNumQueries(1, KeyValue.objects.sync_answers,
+                              {self.assignment.pk: answers})
+
+    def test_unchanged_assignments_skip_answers(self):
+        mturk_assignments = [
+                make_mturk_assignment('A%d' % i, 'HIT1',
+                                      dict(('field%d' % j, str(j))
+                                           for j in range(40)))
+                for i in range(10)]
+        Assignment.objects.sync_from_mturk(self.hit, mturk_assignments)
+        self.assertEqual(KeyValue.objects.count(), 400)
+        # Only the fingerprints are read
+        self.assertNumQueries(1, Assignment.objects.sync_from_mturk,
+                              self.hit, mturk_assignments)
+
+        mturk_assignments[3] = make_mturk_assignment('A3', 'HIT1',
+                                                     {'field0': 'changed'})
+        counts = Assignment.objects.sync_from_mturk(self.hit,
+                                                    mturk_assignments)
+        self.assertEqual((counts['updated'], counts['unchanged']), (1, 9))
+        self.assertEqual(KeyValue.objects.count(), 361)
+
+    def test_assignment_update_stores_answers(self):
+        self.assignment.update(make_mturk_assignment(
+                'ASSIGNMENT1', 'HIT1', {'color': 'blue'}), hit=self.hit)
+        self.assertEqual(self.assignment.status, Assignment.SUBMITTED)
+        self.assertEqual(self.answers(), {'color': 'blue'})
+
+    def test_packed_answers(self):
+        answers = dict(('field%d' % i, u'Answer \u00e9 %d' % i)
+                       for i in range(60))
+        mturk_assignments = [make_mturk_assignment('A%d' % i, 'HIT1', answers)
+                             for i in range(5)]
+        # A plain setting, which doesn't need the connection settings
+        with override_settings(DJURK_ANSWER_STORAGE='packed', DJURK=None,
+                               DJURK_CONFIG_FILE=None):
+            Assignment.objects.sync_from_mturk(self.hit, mturk_assignments)
+            self.assertEqual(KeyValue.objects.count(), 0)
+            assignment = Assignment.objects.get(mturk_id='A0')
+            self.assertNumQueries(0, assignment.get_answers)
+            self.assertEqual(assignment.get_answers(), answers)
+            pairs = assignment.answer_pairs()
+            self.assertEqual((pairs[0].key, pairs[0].short_value()),
+                             ('field0', u'Answer \u00e9 0'))
+
+            # Answers stored before packing was turned on are replaced
+            self.assignment.update(make_mturk_assignment(
+                    'ASSIGNMENT1', 'HIT1', {'color': 'blue'}), hit=self.hit)
+            KeyValue.objects.create(assignment=self.assignment, key='old')
+            self.assignment.update(make_mturk_assignment(
+                    'ASSIGNMENT1', 'HIT1', {'color': 'red'}), hit=self.hit)
+            self.assertEqual(self.answers(), {})
+            self.assertEqual(Assignment.objects.get(
+                    pk=self.assignment.pk).get_answers(), {'color': 'red'})
+
+    def test_pack_and_unpack_answers(self):
+        KeyValue.objects.sync_answers({self.assignment.pk: {
+                'color': 'blue', 'comments': 'none'}})
+        other = Assignment.objects.create(mturk_id='ASSIGNMENT2',
+                                          hit=self.hit)
+        Assignment.objects.pack_answers([self.assignment.pk, other.pk])
+        self.assertEqual(KeyValue.objects.count(), 0)
+        self.assertEqual(Assignment.objects.get(
+                pk=self.assignment.pk).get_answers(),
+                {'color': 'blue', 'comments': 'none'})
+        self.assertEqual(Assignment.objects.get(pk=other.pk).packed_answers,
+                         '{}')
+
+        Assignment.objects.unpack_answers([self.assignment.pk, other.pk])
+        self.assertEqual(self.answers(), {'color': 'blue',
+                                          'comments': 'none'})
+        self.assertFalse(Assignment.objects.filter(
+                packed_answers__isnull=False).exists())
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        self.hit = HIT.objects.create(mturk_id='HIT1', hit_type_id='TYPE1')
+        submitted = datetime.datetime(2012, 5, 1, 12, 0, 0)
+        self.assignments = [
+                Assignment.objects.create(
+                        mturk_id='A%d' % i, hit=self.hit, worker_id='W%d' % i,
+                        status=Assignment.APPROVED,
+                        submit_time=submitted + datetime.timedelta(days=i))
+                for i in range(3)]
+        KeyValue.objects.sync_answers({
+                self.assignments[0].pk: {'color': u'blue, \u00e9'},
+                self.assignments[1].pk: {'color': 'red', 'size': 'L'}})
+        Assignment.objects.filter(pk=self.assignments[2].pk).update(
+                packed_answers='{"comments":"none"}')
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, name))
+        os.rmdir(self.directory)
+
+    def export(self, **options):
+        output = os.path.join(self.directory, 'results')
+        call_command('export_results', output=output, chunk_size=2,
+                     **options)
+        with open(output) as output_file:
+            return output_file.read().decode('utf-8').splitlines()
+
+    def test_export_csv(self):
+        lines = self.export()
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[0].endswith(
+                'answer.color,answer.comments,answer.size'))
+        self.assertEqual(lines[1], u'A0,HIT1,TYPE1,W0,Approved,,'
+                         u'2012-05-01T12:00:00Z,,,,"blue, \u00e9",,')
+        self.assertTrue(lines[3].endswith(',,none,'))
+
+    def test_export_jsonl_with_filters(self):
+        lines = self.export(format='jsonl', submitted_after='2012-05-02',
+                            hit_types=['TYPE1'], statuses=['Approved'])
+        records = [json.loads(line) for line in lines]
+        self.assertEqual([record['assignment_id'] for record in records],
+                         ['A1', 'A2'])
+        self.assertEqual(records[0]['answers'], {'color': 'red', 'size': 'L'})
+        self.assertEqual(records[1]['answers'], {'comments': 'none'})
+
+    def test_incremental_export(self):
+        watermark = os.path.join(self.directory, 'watermark')
+        self.assertEqual(len(self.export(watermark=watermark,
+                                         watermark_lag=0)), 4)
+        self.assertEqual(len(self.export(watermark=watermark,
+                                         watermark_lag=0)), 1)
+        Assignment.objects.create(mturk_id='A3', hit=self.hit)
+        lines = self.export(watermark=watermark, watermark_lag=0,
+                            answer_keys='color')
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[1].startswith('A3,'))
+
+    def confirm(self, mutations):
+        Mutation.objects.filter(pk__in=[mutation.pk for mutation in mutations]
+                                ).update(status=Mutation.CONFIRMED,
+                                         confirmed=datetime.datetime.utcnow())
+        apply_confirmed()
+
+    def test_incremental_export_picks_up_changes(self):
+        watermark = os.path.join(self.directory, 'watermark')
+        Assignment.objects.filter(pk=self.assignments[0].pk).update(
+                status=Assignment.SUBMITTED)
+        lines = self.export(watermark=watermark, watermark_lag=0,
+                            statuses=['Approved'])
+        self.assertEqual(len(lines), 3)
+        # Approved since, and so exported with the status filter
+        self.confirm(Mutation.objects.approve(self.assignments[:1]))
+        lines = self.export(watermark=watermark, watermark_lag=0,
+                            statuses=['Approved'])
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[1].startswith('A0,'))
+        # Changes that may not be committed yet are left for later
+        self.confirm(Mutation.objects.reject(self.assignments[1:2]))
+        self.assertEqual(len(self.export(watermark=watermark)), 1)
+        self.assertEqual(len(self.export(watermark=watermark,
+                                         watermark_lag=0)), 2)
+
+    def test_earlier_watermark(self):
+        watermark = os.path.join(self.directory, 'watermark')
+        with open(watermark, 'w') as watermark_file:
+            json.dump({'assignment_pk': 1}, watermark_file)
+        self.assertRaises(CommandError, read_watermark, watermark)
+
+
+class PageStub(list):
+    """A page of results, like the ResultSets Boto returns"""
+    def __init__(self, items, total, page_number):
+        list.__init__(self, items)
+        self.TotalNumResults = str(total)
+        self.PageNumber = str(page_number)
+
+
+class PagingTests(TestCase):
+    def fetch_page(self, page_number, page_size):
+        self.fetched.append(page_number)
+        start = (page_number - 1) * page_size
+        return PageStub(range(start, min(start + page_size, 95)), 95,
+                        page_number)
+
+    def setUp(self):
+        self.fetched = []
+
+    def test_iter_pages(self):
+        for workers in (1, 3):
+            self.fetched = []
+            pages = list(iter_pages(self.fetch_page, page_size=10,
+                                    workers=workers))
+            self.assertEqual([item for page in pages for item in page],
+                             range(95))
+            self.assertEqual(sorted(self.fetched), range(1, 11))
+
+    def test_iter_pages_fetches_ahead_boundedly(self):
+        pages = iter_pages(self.fetch_page, page_size=10, workers=2)
+        pages.next()
+        pages.next()
+        # Page 2 was consumed; at most pages 3 and 4 are in flight
+        self.assertTrue(max(self.fetched) <= 4)
+        pages.close()
+
+
+class StubConnection(object):
+    """Answers requests from lists of Boto HITs and Assignments"""
+    # Connections of a pool share the lists, from concurrent threads
+    lock = threading.Lock()
+
+    def __init__(self, assignments=(), hits=(), log=None):
+        self.assignments = assignments
+        self.hits = hits
+        self.log = log if log is not None else []
+
+    def page(self, items, page_size, page_number):
+        start = (page_number - 1) * page_size
+        return PageStub(items[start:start + page_size], len(items),
+                        page_number)
+
+    def get_assignments(self, hit_id, page_size=10, page_number=1):
+        self.log.append(('get_assignments', hit_id))
+        assignments = [assignment for assignment in self.assignments
+                       if assignment.HITId == hit_id]
+        return self.page(assignments, page_size, page_number)
+
+    def search_hits(self, page_size=10, page_number=1):
+        return self.page(self.hits, page_size, page_number)
+
+    def get_reviewable_hits(self, page_size=10, page_number=1):
+        hits = [hit for hit in self.hits if hit.HITStatus == 'Reviewable']
+        return self.page(hits, page_size, page_number)
+
+    def get_hit(self, hit_id):
+        return [hit for hit in self.hits if hit.HITId == hit_id]
+
+    def approve_assignment(self, assignment_id, feedback=None):
+        if assignment_id == 'FAIL':
+            raise BotoServerError(400, 'Bad Request')
+        self.log.append(('approve_assignment', assignment_id))
+
+    def reject_assignment(self, assignment_id, feedback=None):
+        self.log.append(('reject_assignment', assignment_id))
+
+    def grant_bonus(self, worker_id, assignment_id, bonus_price, reason):
+        self.log.append(('grant_bonus', assignment_id))
+
+    def register_hit_type(self, title, description, reward, duration,
+                          **kwargs):
+        self.log.append(('register_hit_type', title))
+        result = PageStub([], 0, 1)
+        result.HITTypeId = 'TYPE1'
+        return result
+
+    def _process_request(self, request_type, params, marker_elems=None):
+        assert request_type == 'CreateHIT'
+        token = params['UniqueRequestToken']
+        with self.lock:
+            if [hit for hit in self.hits
+                if hit.RequesterAnnotation == token]:
+                raise boto.mturk.connection.MTurkRequestError(
+                        200, 'OK', '<Errors>AWS.MechanicalTurk.'
+                        'DuplicateRequest</Errors>')
+            self.log.append(('create_hit', params['Question']))
+            mturk_hit = make_mturk_hit('HIT%d' % len(self.hits),
+                                       RequesterAnnotation=token)
+            self.hits.append(mturk_hit)
+        return [mturk_hit]
+
+    def close(self):
+        pass
+
+
+class UpdateAssignmentsTests(TestCase):
+    def setUp(self):
+        self.hit = HIT.objects.create(mturk_id='HIT1')
+        self.mturk_assignments = [
+                make_mturk_assignment('A%d' % i, 'HIT1', {'n': str(i)})
+                for i in range(250)]
+        self.log = []
+        self.connection_pool = common.connection_pool
+        common.connection_pool = ConnectionPool(
+                factory=lambda: StubConnection(assignments=
+                                               self.mturk_assignments,
+                                               log=self.log))
+
+    def tearDown(self):
+        common.connection_pool = self.connection_pool
+
+    def test_update_assignments(self):
+        self.hit.update_assignments()
+        self.assertEqual(self.hit.assignments.count(), 250)
+        self.assertEqual(KeyValue.objects.count(), 250)
+        self.assertEqual(
+                KeyValue.objects.get(assignment__mturk_id='A249').value,
+                '249')
+
+        self.mturk_assignments[0] = make_mturk_assignment(
+                'A0', 'HIT1', {'n': 'changed'}, AssignmentStatus='Approved')
+        self.hit.update_assignments()
+        assignment = Assignment.objects.get(mturk_id='A0')
+        self.assertEqual(assignment.status, Assignment.APPROVED)
+        self.assertEqual(assignment.answers.get().value, 'changed')
+        self.assertEqual(self.hit.assignments.count(), 250)
+
+    def test_assignment_update_refreshes_siblings(self):
+        assignment = Assignment.objects.create(mturk_id='A7', hit=self.hit)
+        self.mturk_assignments[7] = make_mturk_assignment(
+                'A7', 'HIT1', AssignmentStatus='Rejected',
+                RejectionTime='2012-04-05T10:00:00Z')
+        assignment.update()
+        self.assertEqual(assignment.status, Assignment.REJECTED)
+        self.assertEqual(assignment.rejection_time,
+                         datetime.datetime(2012, 4, 5, 10, 0, 0))
+        # Siblings that were never synchronized are created
+        self.assertEqual(self.hit.assignments.count(), 250)
+
+    def test_bulk_approve_refreshes_each_hit_once(self):
+        self.hit.update_assignments()
+        other_hit = HIT.objects.create(mturk_id='HIT2')
+        Assignment.objects.create(mturk_id='FAIL', hit=other_hit)
+        for i in range(30):
+            self.mturk_assignments[i] = make_mturk_assignment(
+                    'A%d' % i, 'HIT1', {'n': str(i)},
+                    AssignmentStatus='Approved')
+        del self.log[:]
+
+        changed, failed = Assignment.objects.approve(
+                Assignment.objects.filter(mturk_id__in=['A%d' % i for i in
+                                                        range(30)] + ['FAIL']))
+        self.assertEqual(len(changed), 30)
+        self.assertEqual([assignment.mturk_id for assignment, error in failed],
+                         ['FAIL'])
+        approved = [entry for entry in self.log
+                    if entry[0] == 'approve_assignment']
+        self.assertEqual(len(approved), 30)
+        # 250 assignments of HIT1 are 3 pages, HIT2 has none
+        self.assertEqual(len(self.log), 30 + 3 + 1)
+        self.assertEqual(self.hit.assignments.filter(
+                status=Assignment.APPROVED).count(), 30)
+
+    def test_bulk_bonus(self):
+        self.hit.update_assignments()
+        changed, failed = Assignment.objects.bonus(
+                Assignment.objects.filter(mturk_id='A1'), value=0.5)
+        self.assertEqual((len(changed), failed), (1, []))
+        self.assertTrue(('grant_bonus', 'A1') in self.log)
+
+
+class UpdateHITsTests(TestCase):
+    def setUp(self):
+        self.mturk_hits = [make_mturk_hit('HIT%d' % i) for i in range(150)]
+        self.mturk_hits[3].HITStatus = 'Reviewable'
+        self.mturk_assignments = [
+                make_mturk_assignment('A%d' % i, 'HIT%d' % (i % 5))
+                for i in range(20)]
+        self.connection_pool = common.connection_pool
+        common.connection_pool = ConnectionPool(
+                factory=lambda: StubConnection(self.mturk_assignments,
+                                               self.mturk_hits))
+
+    def tearDown(self):
+        common.connection_pool = self.connection_pool
+
+    def test_update_all_hits(self):
+        for batch_size in (None, 40):
+            stats = update_all_hits(do_update_assignments=True,
+                                    batch_size=batch_size)
+            self.assertEqual(stats.hits, 150)
+            self.assertEqual(stats.pages, 2)
+            self.assertEqual(stats.assignments, 20)
+        self.assertEqual(HIT.objects.count(), 150)
+        self.assertEqual(Assignment.objects.count(), 20)
+        self.assertEqual(stats.hits_unchanged, 150)
+
+    def test_pipelined_sync_matches_update_all_hits(self):
+        stats = PipelinedSync(concurrency=3).run()
+        self.assertEqual(stats.hits_inserted, 150)
+        self.assertEqual(stats.assignments_inserted, 20)
+        self.assertEqual(stats.errors, 0)
+        pipelined = (list(HIT.objects.values().order_by('mturk_id')),
+                     list(Assignment.objects.values(
+                            'mturk_id', 'hit__mturk_id',
+                            'status').order_by('mturk_id')))
+
+        HIT.objects.all().delete()
+        update_all_hits(do_update_assignments=True)
+        helpers = (list(HIT.objects.values().order_by('mturk_id')),
+                   list(Assignment.objects.values('mturk_id', 'hit__mturk_id',
+                            'status').order_by('mturk_id')))
+        for rows in pipelined[0], helpers[0]:
+            for row in rows:
+                del row['id']
+        self.assertEqual(pipelined, helpers)
+
+    def test_update_reviewable_hits(self):
+        stats = update_reviewable_hits()
+        self.assertEqual(stats.hits_inserted, 1)
+        self.assertEqual(HIT.objects.get().mturk_id, 'HIT3')
+
+    def test_sync_hit_page(self):
+        stats, total = _sync_hit_page((ALL_HITS, 2, True))
+        self.assertEqual(total, 150)
+        self.assertEqual(stats.hits_inserted, 50)
+        self.assertEqual(stats.pages, 1)
+
+    def test_sync_hit_page_counts_errors(self):
+        common.connection_pool = ConnectionPool(factory=object)
+        stats, total = _sync_hit_page((ALL_HITS, 1, False))
+        self.assertEqual(total, None)
+        self.assertEqual(stats.errors, 1)
+
+
+class SchedulerTests(TestCase):
+    def setUp(self):
+        self.now = datetime.datetime(2012, 4, 5, 12, 0, 0)
+        self.mturk_hits = [make_mturk_hit('HIT%d' % i) for i in range(3)]
+        self.mturk_assignments = []
+        self.connection_pool = common.connection_pool
+        common.connection_pool = ConnectionPool(
+                factory=lambda: StubConnection(self.mturk_assignments,
+                                               self.mturk_hits))
+
+    def tearDown(self):
+        common.connection_pool = self.connection_pool
+
+    def minutes(self, minutes):
+        return self.now + datetime.timedelta(minutes=minutes)
+
+    def test_next_poll_time(self):
+        hit = HIT(status=HIT.DISPOSED)
+        self.assertEqual(next_poll_time(hit, self.now), None)
+        hit = HIT(status=HIT.REVIEWABLE, number_of_assignments_pending=0)
+        self.assertEqual(next_poll_time(hit, self.now),
+                         self.minutes(TERMINAL_INTERVAL / 60))
+        hit = HIT(status=HIT.ASSIGNABLE)
+        self.assertEqual(next_poll_time(hit, self.now),
+                         self.minutes(ACTIVE_INTERVAL / 60))
+
+        # Polled just after expiring or an auto-approval
+        hit = HIT(status=HIT.ASSIGNABLE, creation_time=self.now,
+                  lifetime_in_seconds=120)
+        self.assertEqual(next_poll_time(hit, self.now), self.minutes(2) +
+                         datetime.timedelta(seconds=MILESTONE_DELAY))
+        hit = HIT(status=HIT.REVIEWABLE)
+        self.assertEqual(next_poll_time(hit, self.now, self.minutes(60)),
+                         self.minutes(60) +
+                         datetime.timedelta(seconds=MILESTONE_DELAY))
+
+    def test_scheduler_polls_due_hits(self):
+        clock = [self.now]
+        scheduler = PollScheduler(clock=lambda: clock[0])
+        # Nothing is stored yet, so every HIT is discovered and polled
+        stats = scheduler.run_once()
+        self.assertEqual(stats.hits_inserted, 3)
+        self.assertEqual(stats.hits_unchanged, 3)
+        self.assertEqual(
+                set(HIT.objects.values_list('next_poll_time', flat=True)),
+                set([self.minutes(ACTIVE_INTERVAL / 60)]))
+
+        self.mturk_hits[0].HITStatus = 'Disposed'
+        clock[0] = self.minutes(ACTIVE_INTERVAL / 60)
+        stats = scheduler.run_once()
+        self.assertEqual(stats.hits_updated, 1)
+        self.assertEqual(HIT.objects.get(mturk_id='HIT0').next_poll_time,
+                         None)
+
+        # A restarted scheduler picks up the stored queue
+        scheduler = PollScheduler(clock=lambda: clock[0])
+        scheduler.load()
+        self.assertEqual(len(scheduler.due), 2)
+        self.assertEqual(scheduler.next_wakeup(),
+                         self.minutes(2 * ACTIVE_INTERVAL / 60))
+        self.assertEqual(scheduler.run_once().hits, 0)
+
+    def test_assignment_deadline_is_scheduled(self):
+        self.mturk_hits[0].HITStatus = 'Reviewable'
+        self.mturk_assignments.append(make_mturk_assignment(
+                'A1', 'HIT0', AcceptTime='2012-04-05T11:55:00Z',
+                SubmitTime='2012-04-05T11:56:00Z'))
+        PollScheduler(clock=lambda: self.now).run_once()
+
+        # Accepted five minutes ago, for 900 seconds
+        assignment = Assignment.objects.get(mturk_id='A1')
+        self.assertEqual(assignment.deadline, self.minutes(10))
+        self.assertEqual(HIT.objects.get(mturk_id='HIT0').next_poll_time,
+                         self.minutes(10) +
+                         datetime.timedelta(seconds=MILESTONE_DELAY))
+
+    def test_run_forever_sleeps_until_due(self):
+        clock = [self.now]
+        sleeps = []
+
+        class Stop(Exception):
+            pass
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            raise Stop()
+
+        def almost_due(stats):
+            clock[0] = scheduler.next_wakeup() - datetime.timedelta(
+                    milliseconds=500)
+        scheduler = PollScheduler(clock=lambda: clock[0], sleep=sleep)
+        self.assertRaises(Stop, scheduler.run_forever, callback=almost_due)
+        self.assertEqual(sleeps, [0.5])
+
+
+class FakeClock(object):
+    """A clock that only advances when something sleeps"""
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeResponse(object):
+    status = 200
+    reason = 'OK'
+
+    def __init__(self, body):
+        self.body = body
+
+    def read(self):
+        return self.body
+
+
+class ThrottleTests(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def bucket(self, **kwargs):
+        return TokenBucket(clock=self.clock, sleep=self.clock.sleep,
+                           **kwargs)
+
+    def test_token_bucket_limits_rate(self):
+        bucket = self.bucket(rate=10, burst=5)
+        for i in range(5):
+            self.assertEqual(bucket.acquire(), 0)
+        self.assertAlmostEqual(bucket.acquire(), 0.1)
+        for i in range(9):
+            bucket.acquire()
+        self.assertAlmostEqual(self.clock.now, 1001.0)
+        self.assertAlmostEqual(bucket.status()['wait_time'], 1.0)
+
+    def test_throttling_slows_down(self):
+        bucket = self.bucket(rate=10)
+        bucket.throttled()
+        self.assertEqual(bucket.rate, 5)
+        self.assertAlmostEqual(bucket.acquire(), 0.2)
+        for i in range(10):
+            bucket.succeeded()
+        self.assertEqual(bucket.rate, 10)
+
+    def test_bucket_shared_through_file(self):
+        path = tempfile.mkstemp()[1]
+        self.addCleanup(os.remove, path)
+        first = self.bucket(rate=1, burst=1, path=path)
+        second = self.bucket(rate=1, burst=1, path=path)
+        self.assertEqual(first.acquire(), 0)
+        self.assertAlmostEqual(second.acquire(), 1.0)
+
+    def test_connection_retries_throttled_requests(self):
+        responses = [BotoServerError(503, 'Service Unavailable'),
+                     FakeResponse('<GetHITResponse></GetHITResponse>')]
+
+        def make_request(*args, **kwargs):
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        bucket = self.bucket(rate=10)
+        connection = ThrottledMTurkConnection(
+                aws_access_key_id='123', aws_secret_access_key='456',
+                rate_limiter=bucket, sleep=self.clock.sleep)
+        connection.make_request = make_request
+        connection.get_hit('HIT1')
+        self.assertEqual(responses, [])
+        self.assertEqual(bucket.status()['throttles'], 1)
+        self.assertEqual(bucket.requests, 2)
+
+        responses.append(BotoServerError(400, 'Bad Request'))
+        self.assertRaises(BotoServerError, connection.get_hit, 'HIT1')
+
+
+class ResponseCacheTests(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = ResponseCache(ttl=10, max_size=2, clock=self.clock)
+        self.calls = []
+
+    def test_caching_is_off_unless_configured(self):
+        with self.settings(DJURK={'host': FAKE_HOST},
+                           DJURK_CONFIG_FILE=None):
+            self.assertEqual(get_response_cache(), None)
+        with self.settings(DJURK={'host': FAKE_HOST, 'cache_ttl': '5'},
+                           DJURK_CONFIG_FILE=None):
+            self.assertEqual(get_response_cache().ttl, 5)
+
+    def request(self, name):
+        def function():
+            self.calls.append(name)
+            return [name]
+        return function
+
+    def test_entries_expire(self):
+        self.assertEqual(self.cache.get('a', 'HIT1', self.request('a')), ['a'])
+        self.cache.get('a', 'HIT1', self.request('a'))
+        self.assertEqual(self.calls, ['a'])
+        self.clock.sleep(10)
+        self.cache.get('a', 'HIT1', self.request('a'))
+        self.assertEqual(self.calls, ['a', 'a'])
+
+    def test_least_recently_used_are_dropped(self):
+        for key in 'a', 'b', 'a', 'c', 'a', 'b':
+            self.cache.get(key, 'HIT1', self.request(key))
+        self.assertEqual(self.calls, ['a', 'b', 'c', 'b'])
+
+    def test_concurrent_requests_are_coalesced(self):
+        started, release = threading.Event(), threading.Event()
+
+        def slow_request():
+            started.set()
+            release.wait()
+            self.calls.append('a')
+            return ['a']
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(
+                self.cache.get('a', 'HIT1', slow_request)))
+        leader.start()
+        started.wait()
+        follower = threading.Thread(target=lambda: results.append(
+                self.cache.get('a', 'HIT1', self.request('b'))))
+        follower.start()
+        while not self.cache.coalesced:
+            follower.join(0.01)
+        release.set()
+        leader.join()
+        follower.join()
+        self.assertEqual(results, [['a'], ['a']])
+        self.assertEqual(self.calls, ['a'])
+
+    def test_mutations_invalidate(self):
+        requests = []
+
+        def make_request(action, params, verb='GET'):
+            requests.append(action)
+            if action == 'GetAssignmentsForHIT':
+                return FakeResponse('<GetAssignmentsForHITResult>'
+                                    '<Assignment><AssignmentId>A1'
+                                    '</AssignmentId></Assignment>'
+                                    '</GetAssignmentsForHITResult>')
+            return FakeResponse('<%sResponse/>' % action)
+
+        connection = CachedMTurkConnection(
+                aws_access_key_id='123', aws_secret_access_key='456',
+                response_cache=ResponseCache())
+        connection.make_request = make_request
+        for i in range(2):
+            connection.get_hit('HIT1')
+            connection.get_hit('HIT2')
+            connection.get_assignments('HIT1')
+        self.assertEqual(len(requests), 3)
+
+        connection.approve_assignment('A1')
+        connection.get_hit('HIT2')
+        connection.get_assignments('HIT1')
+        connection.expire_hit('HIT2')
+        connection.get_hit('HIT1')
+        connection.get_hit('HIT2')
+        self.assertEqual(requests[3:], ['ApproveAssignment',
+                'GetAssignmentsForHIT', 'ForceExpireHIT', 'GetHIT', 'GetHIT'])
+
+
+class PublishTests(TestCase):
+    def setUp(self):
+        self.mturk_hits = []
+        self.log = []
+        self.connection_pool = common.connection_pool
+        common.connection_pool = ConnectionPool(
+                factory=lambda: StubConnection(hits=self.mturk_hits,
+                                               log=self.log))
+        self.template = HITTemplate(
+                'A title', 'A description', 0.05, batch='test',
+                question=lambda row: boto.mturk.question.ExternalQuestion(
+                        'https://example.com/%s' % row['id'], 600))
+        content_type = ContentType.objects.get_for_model(HIT)
+        self.rows = [{'id': i, 'attached_object': content_type}
+                     for i in range(25)]
+
+    def tearDown(self):
+        common.connection_pool = self.connection_pool
+
+    def creates(self):
+        return [entry for entry in self.log if entry[0] == 'create_hit']
+
+    def test_publish_batch(self):
+        counts = HIT.objects.publish_batch(self.template, self.rows,
+                                           workers=4, chunk_size=10)
+        self.assertEqual(counts, {'created': 25, 'recovered': 0,
+                                  'skipped': 0, 'failed': 0})
+        self.assertEqual(len(self.creates()), 25)
+        self.assertEqual(len([entry for entry in self.log
+                              if entry[0] == 'register_hit_type']), 1)
+        hit = HIT.objects.get(publish_token=self.template.token(
+                self.rows[3]))
+        self.assertEqual(hit.hit_type_id, 'TYPE1')
+        self.assertEqual(hit.status, HIT.ASSIGNABLE)
+        self.assertTrue(hit.creation_time is not None)
+        self.assertTrue(hit.mturk_id.startswith('HIT'))
+        self.assertEqual(hit.attached_object,
+                         ContentType.objects.get_for_model(HIT))
+
+    def test_publish_batch_is_resumable(self):
+        HIT.objects.publish_batch(self.template, self.rows[:10])
+        # As if the process stopped before storing the last HIT created
+        HIT.objects.filter(publish_token=self.template.token(
+                self.rows[9])).update(mturk_id=None)
+        del self.log[:]
+
+        counts = HIT.objects.publish_batch(self.template, self.rows)
+        self.assertEqual(counts, {'created': 15, 'recovered': 1,
+                                  'skipped': 9, 'failed': 0})
+        self.assertEqual(len(self.creates()), 15)
+        self.assertEqual(HIT.objects.count(), 25)
+        self.assertEqual(HIT.objects.filter(mturk_id=None).count(), 0)
+
+    def test_is_duplicate_request(self):
+        error_xml = ('<?xml version="1.0"?><Response><Errors><Error>'
+                     '<Code>%s</Code><Message>%s</Message></Error></Errors>'
+                     '</Response>')
+        self.assertTrue(is_duplicate_request(MTurkRequestError(
+                200, 'OK', error_xml % (
+                        'AWS.MechanicalTurk.DuplicateRequest',
+                        'There is already a HIT with this token.'))))
+        self.assertFalse(is_duplicate_request(MTurkRequestError(
+                200, 'OK', error_xml % (
+                        'AWS.MechanicalTurk.InvalidParameterValue',
+                        'UniqueRequestToken is too long.'))))
+        self.assertFalse(is_duplicate_request(socket.error()))
+
+
+def build_color_question(fields):
+    content = boto.mturk.question.QuestionContent()
+    content.append_field('Title', fields['title'])
+    content.append(boto.mturk.question.FormattedContent(
+            u'<p>What color is %s?</p>' % fields['thing']))
+    question = boto.mturk.question.Question(
+            identifier='color', content=content,
+            answer_spec=boto.mturk.question.AnswerSpecification(
+                    boto.mturk.question.FreeTextAnswer()))
+    question_form = boto.mturk.question.QuestionForm()
+    question_form.append(question)
+    return question_form
+
+
+class QuestionTemplateTests(TestCase):
+    def setUp(self):
+        self.builds = []
+
+        def build(fields):
+            self.builds.append(fields)
+            return build_color_question(fields)
+        self.build = build
+
+    def test_form_is_built_once(self):
+        template = QuestionTemplate(self.build, ['title', 'thing'])
+        for thing in (u'the sky', u'grass'):
+            QuestionTemplate(self.build, ['title', 'thing']).render(
+                    title=u'Colors', thing=thing)
+        template.render(title=u'Colors', thing=u'snow')
+        self.assertEqual(len(self.builds), 1)
+
+    def test_skeleton_cache_is_bounded(self):
+        xml = u'<Text>%d ${thing}</Text>'
+        templates = [QuestionTemplate.from_xml(xml % i)
+                     for i in range(MAX_SKELETONS + 10)]
+        for template in templates:
+            template.render_xml(thing=u'the sky')
+        self.assertEqual(len(_skeletons), MAX_SKELETONS)
+        # Keyed by a digest of the XML
+        self.assertFalse(templates[0].key in _skeletons)
+        self.assertTrue(templates[-1].key in _skeletons)
+        self.assertEqual(len(templates[-1].key), 40)
+        self.assertEqual(QuestionTemplate.from_xml(xml % 0).render_xml(
+                thing=u'grass'), u'<Text>0 grass</Text>')
+
+    def test_render_matches_boto(self):
+        template = QuestionTemplate(self.build, ['title', 'thing'])
+        fields = {'title': u'Colors', 'thing': u'caf\xe9 <b>'}
+        self.assertEqual(template.render_xml(**fields),
+                         build_color_question(fields).get_as_xml())
+
+    def test_values_are_escaped(self):
+        template = QuestionTemplate(self.build, ['title', 'thing'])
+        xml = template.render_xml(title=u'<Colors>', thing=u']]><script>')
+        self.assertTrue(u'<Title>&lt;Colors&gt;</Title>' in xml)
+        self.assertTrue(u'<![CDATA[<p>What color is ]]]]><![CDATA[>'
+                        u'<script>?</p>]]>' in xml)
+
+    def test_from_xml(self):
+        template = QuestionTemplate.from_xml(
+                '<Text>${thing} is ${color}</Text><Text>${thing}</Text>')
+        self.assertEqual(template({'thing': u'"Grass"', 'color': u'green',
+                                   'attached_object': None}).get_as_xml(),
+                         u'<Text>&quot;Grass&quot; is green</Text>'
+                         u'<Text>&quot;Grass&quot;</Text>')
+
+
+class FakeMTurkTests(TestCase):
+    def setUp(self):
+        self.service = FakeMTurk(hits=30, assignments_per_hit=2,
+                                 reviewable=0.2)
+        self.connection_pool = common.connection_pool
+        common.connection_pool = ConnectionPool(factory=self.connection)
+
+    def tearDown(self):
+        common.connection_pool = self.connection_pool
+
+    def connection(self, **kwargs):
+        return FakeMTurkConnection(host=FAKE_HOST, service=self.service,
+                                   **kwargs)
+
+    def test_sync_from_seeded_hits(self):
+        stats = update_all_hits(do_update_assignments=True,
+                                batch_size=MAX_PAGE_SIZE)
+        self.assertEqual(stats.hits_inserted, 30)
+        self.assertEqual(stats.assignments_inserted, 60)
+        hit = HIT.objects.get(mturk_id=seeded_hit_id(0))
+        self.assertEqual(hit.status, HIT.REVIEWABLE)
+        self.assertEqual(str(hit.reward), '0.05')
+        self.assertEqual(HIT.objects.filter(
+                status=HIT.ASSIGNABLE).count(), 24)
+        assignment = hit.assignments.all()[0]
+        self.assertEqual(assignment.status, Assignment.SUBMITTED)
+        self.assertEqual(sorted(assignment.answers.values_list(
+                'key', flat=True)), ['comments', 'favorite_color'])
+
+        self.assertEqual(update_reviewable_hits().hits_unchanged, 6)
+
+    def test_pipelined_sync_stops_listing_when_writer_fails(self):
+        self.service = FakeMTurk(hits=1000, latency=0.05)
+        sync = PipelinedSync(do_update_assignments=False, concurrency=1)
+
+        def write(*args):
+            raise ValueError("The database is gone")
+        sync.write = write
+        self.assertRaises(ValueError, sync.run)
+        # Not all 10 pages
+        self.assertTrue(self.service.requests['SearchHITs'] <= 3)
+
+    def test_millions_of_seeded_hits(self):
+        service = FakeMTurk(hits=5000000)
+        connection = FakeMTurkConnection(host=FAKE_HOST, service=service)
+        page = connection.search_hits(page_size=100, page_number=40001)
+        self.assertEqual(page.TotalNumResults, '5000000')
+        self.assertEqual([hit.HITId for hit in page[:2]],
+                         [seeded_hit_id(4000000), seeded_hit_id(4000001)])
+
+    def test_mutations(self):
+        connection = self.connection()
+        hit_id = seeded_hit_id(1)
+        assignments = connection.get_assignments(hit_id)
+        connection.approve_assignment(assignments[0].AssignmentId)
+        self.assertRaises(MTurkRequestError, connection.approve_assignment,
+                          assignments[0].AssignmentId)
+        self.assertRaises(MTurkRequestError, connection.dispose_hit, hit_id)
+        connection.reject_assignment(assignments[1].AssignmentId)
+        connection.dispose_hit(hit_id)
+        self.assertEqual(connection.get_hit(hit_id)[0].HITStatus,
+                         'Disposed')
+        self.assertEqual(connection.search_hits().TotalNumResults, '29')
+        self.assertEqual(connection.get_reviewable_hits(
+                page_size=100).TotalNumResults, '5')
+
+        hit_id = seeded_hit_id(10)
+        connection.expire_hit(hit_id)
+        self.assertEqual(len(connection.get_reviewable_hits(
+                page_size=100)), 6)
+        connection.extend_hit(hit_id, assignments_increment=1)
+        self.assertEqual(connection.get_hit(hit_id)[0].HITStatus,
+                         'Assignable')
+        self.service.submit_assignment(hit_id, {'favorite_color': 'blue'})
+        self.service.submit_assignment(hit_id, {'favorite_color': 'red'})
+        self.assertEqual(connection.get_hit(hit_id)[0].HITStatus,
+                         'Reviewable')
+        self.assertEqual(self.service.requests['GetHIT'], 3)
+
+    def test_publish_batch(self):
+        template = HITTemplate(
+                'A title', 'A description', 0.05, batch='fake',
+                question=lambda row: boto.mturk.question.ExternalQuestion(
+                        'https://example.com/%s' % row['id'], 600))
+        rows = [{'id': i} for i in range(5)]
+        HIT.objects.publish_batch(template, rows)
+        HIT.objects.all().update(mturk_id=None)
+        counts = HIT.objects.publish_batch(template, rows)
+        self.assertEqual(counts['recovered'], 5)
+        self.assertEqual(self.service.requests['CreateHIT'], 10)
+        self.assertEqual(HIT.objects.filter(
+                hit_type_id=template.hit_type_id).count(), 5)
+
+    def test_injected_failures(self):
+        clock = FakeClock()
+        self.service = FakeMTurk(hits=3, rate_limit=1, clock=clock)
+        connection = self.connection(sleep=clock.sleep)
+        for i in range(3):
+            connection.get_hit(seeded_hit_id(i))
+        # The throttled requests were retried until they went through
+        self.assertTrue(self.service.requests['GetHIT'] > 3)
+        self.assertTrue(clock.now >= 1002)
+
+        # Without the rate limit, which would answer some of the retries
+        # with 503 instead
+        self.service.rate_limit = None
+        self.service.error_rate = 1
+        try:
+            connection.get_hit(seeded_hit_id(0))
+        except MTurkRequestError as error:
+            self.assertEqual(error.status, 500)
+        else:
+            self.fail("The injected error was not raised")
+
+
+class InstrumentationTests(TestCase):
+    def setUp(self):
+        self.service = FakeMTurk(hits=250)
+        self.connection_pool = common.connection_pool
+        common.connection_pool = ConnectionPool(
+                factory=lambda **kwargs: FakeMTurkConnection(
+                        host=FAKE_HOST, service=self.service, **kwargs))
+
+    def tearDown(self):
+        common.connection_pool = self.connection_pool
+
+    def test_update_all_hits_is_instrumented(self):
+        finished = []
+
+        def receiver(sender, source, stats, **kwargs):
+            finished.append((source, stats))
+        sync_finished.connect(receiver)
+        try:
+            stats = update_all_hits(do_update_assignments=True,
+                                    batch_size=MAX_PAGE_SIZE)
+        finally:
+            sync_finished.disconnect(receiver)
+        self.assertEqual(finished, [(ALL_HITS, stats)])
+        self.assertEqual(stats.api_calls, {'SearchHITs': 3,
+                                           'GetAssignmentsForHIT': 250})
+        self.assertEqual(stats.api_errors, {})
+        self.assertEqual(sum(stats.api_latency['SearchHITs']), 3)
+        self.assertTrue(stats.db_queries > 250)
+        self.assertEqual(stats.as_dict()['api_calls']['SearchHITs'], 3)
+
+    def test_request_statistics(self):
+        stats = SyncStats()
+        stats.record_request('GetHIT', 0.03)
+        stats.record_request('GetHIT', 30.0, error=socket.error())
+        other = SyncStats()
+        other.record_request('GetHIT', 0.01)
+        stats.merge(other)
+        self.assertEqual(stats.api_calls, {'GetHIT': 3})
+        self.assertEqual(stats.api_errors, {'GetHIT': 1})
+        self.assertEqual(stats.api_latency['GetHIT'],
+                         [1, 1] + [0] * (len(LATENCY_BUCKETS) - 2) + [1])
+        self.assertTrue(u'GetHIT: 3 (1 failed' in stats.requests_summary())
+
+    def test_query_counter(self):
+        with QueryCounter() as outer:
+            HIT.objects.count()
+            with QueryCounter() as inner:
+                HIT.objects.create(title='a', description='b', reward=1)
+        self.assertEqual((outer.queries, outer.rows_written), (2, 1))
+        self.assertEqual((inner.queries, inner.rows_written), (1, 1))
+        HIT.objects.count()
+        self.assertEqual(outer.queries, 2)
+
+
+class MetricsTests(TestCase):
+    urls = 'djurk.urls'
+
+    def setUp(self):
+        cache.clear()
+        # The metrics of this process are collected into a fresh object
+        self.sync_metrics = metrics.sync_metrics
+        metrics.sync_metrics = SyncMetrics()
+        metrics.connect_receivers()
+
+    def tearDown(self):
+        metrics.sync_metrics = self.sync_metrics
+        cache.clear()
+
+    def metrics(self):
+        response = self.client.get('/metrics/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        return response.content
+
+    def test_database_aggregates(self):
+        now = datetime.datetime.utcnow()
+        hit = HIT.objects.create(mturk_id='1', status=HIT.REVIEWABLE,
+                                 review_status=HIT.NOT_REVIEWED)
+        HIT.objects.create(mturk_id='2', status=HIT.ASSIGNABLE)
+        Assignment.objects.create(
+                mturk_id='1', hit=hit, status=Assignment.SUBMITTED,
+                submit_time=now - datetime.timedelta(hours=1),
+                auto_approval_time=now + datetime.timedelta(days=1))
+        content = self.metrics()
+        self.assertTrue('djurk_hits{review_status="NotReviewed",'
+                        'status="Reviewable"} 1.0' in content)
+        self.assertTrue('djurk_hits{review_status="Unknown",'
+                        'status="Assignable"} 1.0' in content)
+        self.assertTrue('djurk_assignments{status="Submitted"} 1.0'
+                        in content)
+        self.assertTrue('djurk_oldest_submitted_assignment_age_seconds 36'
+                        in content)
+        self.assertTrue('djurk_next_auto_approval_seconds 8639' in content)
+
+        # The aggregates are cached
+        Assignment.objects.all().delete()
+        self.assertTrue('djurk_assignments{status="Submitted"} 1.0'
+                        in self.metrics())
+        cache.delete(AGGREGATES_CACHE_KEY)
+        self.assertFalse('djurk_assignments{' in self.metrics())
+
+    def test_metrics_without_djurk_settings(self):
+        with override_settings(DJURK=None, DJURK_CONFIG_FILE=None):
+            self.assertTrue('djurk_assignments' in self.metrics())
+
+    def test_sync_metrics(self):
+        stats = SyncStats()
+        stats.finish()
+        metrics.sync_metrics.record_request('GetHIT', 0.2)
+        metrics.sync_metrics.record_request(
+                'GetHIT', 0.01, error=BotoServerError(
+                        503, 'Service Unavailable',
+                        '<Error><Code>ServiceUnavailable</Code></Error>'))
+        sync_finished.send(sender=HIT, source=ALL_HITS, stats=stats)
+        snapshot = cache.get(snapshot_key())
+        self.assertEqual(snapshot['pid'], os.getpid())
+        self.assertEqual(snapshot['api_calls'], {'GetHIT': 2})
+        content = self.metrics()
+        self.assertTrue('djurk_mturk_throttled_total{operation="GetHIT"}'
+                        in content)
+        self.assertTrue('djurk_mturk_request_duration_seconds_bucket{'
+                        'le="+Inf",operation="GetHIT"}' in content)
+        self.assertTrue('djurk_last_successful_sync_timestamp_seconds{'
+                        'source="all"}' in content)
+
+    def test_snapshots_of_processes_are_added_up(self):
+        for pid, (requests, finished) in enumerate([(1, 100), (2, 200)]):
+            process_metrics = SyncMetrics()
+            for _ in range(requests):
+                process_metrics.record_request('GetHIT', 0.2)
+            stats = SyncStats()
+            stats.duration = float(pid)
+            process_metrics.record_sync(ALL_HITS, stats, finished=finished)
+            snapshot = process_metrics.snapshot()
+            snapshot['pid'] = pid + 1
+            store_snapshot(snapshot)
+        content = self.metrics()
+        self.assertTrue('djurk_mturk_requests_total{operation="GetHIT"} 3.0'
+                        in content)
+        self.assertTrue('djurk_mturk_request_duration_seconds_count{'
+                        'operation="GetHIT"} 3.0' in content)
+        self.assertTrue('djurk_syncs_total{source="all"} 2.0' in content)
+        self.assertTrue('djurk_last_sync_timestamp_seconds{source="all"} '
+                        '200.0' in content)
+        self.assertTrue('djurk_last_sync_duration_seconds{source="all"} 1.0'
+                        in content)
+        self.assertTrue('djurk_metrics_processes 2.0' in content)
+
+        # A process whose snapshot expired is left out
+        cache.delete(snapshot_key(snapshot['host'], 2))
+        self.assertTrue('djurk_mturk_requests_total{operation="GetHIT"} 1.0'
+                        in self.metrics())
+
+
+class HighScaleAdminTests(TestCase):
+    def setUp(self):
+        self.user = User(username='admin', is_active=True, is_staff=True,
+                         is_superuser=True)
+        self.hits = [HIT.objects.create(mturk_id='HIT%d' % i,
+                                        description='A long description')
+                     for i in range(3)]
+        for i in range(6):
+            Assignment.objects.create(mturk_id='A%d' % i,
+                                      hit=self.hits[i % 3],
+                                      worker_id='WORKER%d' % (i % 2))
+
+    def changelist(self, model_admin, **params):
+        request = RequestFactory().get('/', params)
+        request.user = self.user
+        with QueryCounter() as counter:
+            response = model_admin.changelist_view(request)
+            response.render()
+        return response.context_data['cl'], counter.queries
+
+    def test_changelist_joins_hits(self):
+        model_admin = HighScaleAssignmentAdmin(Assignment, admin.site)
+        cl, queries = self.changelist(model_admin)
+        self.assertEqual(cl.result_count, 6)
+        for hit in self.hits[:2]:
+            Assignment.objects.create(mturk_id='B%s' % hit.pk, hit=hit)
+        cl, more_queries = self.changelist(model_admin)
+        self.assertEqual(cl.result_count, 8)
+        self.assertEqual(queries, more_queries)
+
+    def test_search_matches_ids(self):
+        model_admin = HighScaleAssignmentAdmin(Assignment, admin.site)
+        cl, queries = self.changelist(model_admin, q='WORKER1')
+        self.assertEqual(sorted(assignment.mturk_id
+                                for assignment in cl.result_list),
+                         ['A1', 'A3', 'A5'])
+        cl, queries = self.changelist(model_admin, q='HIT2')
+        self.assertEqual(len(cl.result_list), 2)
+        # No substring matches
+        cl, queries = self.changelist(model_admin, q='ORKER')
+        self.assertEqual(len(cl.result_list), 0)
+
+        cl, queries = self.changelist(
+                HighScaleHITAdmin(HIT, admin.site), status=HIT.ASSIGNABLE)
+        self.assertEqual(cl.result_count, 0)
+        cl, queries = self.changelist(HighScaleHITAdmin(HIT, admin.site))
+        self.assertFalse('description' in cl.result_list[0].__dict__)
+
+    def test_admin_mode_without_connection_settings(self):
+        with override_settings(DJURK=None, DJURK_CONFIG_FILE=None):
+            self.assertEqual(get_admin_mode(), DEFAULT_ADMIN)
+            with override_settings(DJURK_ADMIN_MODE='high_scale'):
+                self.assertEqual(get_admin_mode(), HIGH_SCALE_ADMIN)
+            with override_settings(DJURK_ADMIN_MODE='fast'):
+                self.assertRaises(InvalidDjurkSettings, get_admin_mode)
+
+    def test_estimated_count(self):
+        paginator = EstimatedCountPaginator(HIT.objects.all(), 2)
+        self.assertEqual(paginator.count, 3)
+        self.assertEqual(estimated_count(
+                Assignment.objects.filter(worker_id='WORKER0')), 3)
+
+
+class JobTests(TestCase):
+    def setUp(self):
+        self.service = FakeMTurk(hits=5, assignments_per_hit=1,
+                                 reviewable=0.2)
+        self.connection_pool = common.connection_pool
+        common.connection_pool = ConnectionPool(
+                factory=lambda **kwargs: FakeMTurkConnection(
+                        host=FAKE_HOST, service=self.service, **kwargs))
+        self.model_admin = HIT_Admin(HIT, admin.site)
+
+    def tearDown(self):
+        common.connection_pool = self.connection_pool
+
+    def request(self):
+        request = RequestFactory().post('/')
+        request.user = User(username='admin')
+        request._messages = CookieStorage(request)
+        return request
+
+    def run_worker(self):
+        output = StringIO.StringIO()
+        call_command('djurk_worker', once=True, stdout=output)
+        return output.getvalue()
+
+    def test_actions_queue_jobs(self):
+        poll_all_hits(self.model_admin, self.request(), HIT.objects.none())
+        poll_all_hits(self.model_admin, self.request(), HIT.objects.none())
+        job = Job.objects.get()
+        self.assertEqual((job.kind, job.status, job.requested_by),
+                         (Job.POLL_ALL_HITS, Job.PENDING, 'admin'))
+        self.assertEqual(self.service.requests, {})
+
+        self.assertEqual(self.run_worker(), "1 jobs done, 0 failed\n")
+        job = Job.objects.get(pk=job.pk)
+        self.assertEqual(job.status, Job.DONE)
+        self.assertEqual(job.dedup_key, None)
+        self.assertEqual(job.progress, u"1 requests made")
+        self.assertEqual(json.loads(job.result)['hits_inserted'], 5)
+        self.assertEqual(HIT.objects.count(), 5)
+
+        hits = HIT.objects.filter(mturk_id__in=[seeded_hit_id(0),
+                                                seeded_hit_id(1)])
+        update_hit(self.model_admin, self.request(), hits)
+        update_hit(self.model_admin, self.request(), hits)
+        poll_all_hits(self.model_admin, self.request(), HIT.objects.none())
+        self.assertEqual(Job.objects.filter(status=Job.PENDING).count(), 3)
+
+    def test_failed_job(self):
+        update_all_hits()
+        # Seeded HIT 1 is assignable, so it can't be disposed of
+        hit = HIT.objects.get(mturk_id=seeded_hit_id(1))
+        dispose_hit(self.model_admin, self.request(), [hit])
+        self.assertEqual(self.run_worker(), "0 jobs done, 1 failed\n")
+        job = Job.objects.get()
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertTrue('DisposeException' in job.error)
+        self.assertTrue(job.finished >= job.started >= job.created)
+
+    def test_claim_job(self):
+        first = Job.objects.enqueue(Job.POLL_ALL_HITS)[0]
+        second = Job.objects.enqueue(Job.POLL_REVIEWABLE_HITS)[0]
+        self.assertEqual(claim_job(), first)
+        self.assertEqual(claim_job(), second)
+        self.assertEqual(claim_job(), None)
+        self.assertEqual(Job.objects.get(pk=first.pk).status, Job.RUNNING)
+        # A running job can be queued again
+        self.assertTrue(Job.objects.enqueue(Job.POLL_ALL_HITS)[1])
+
+    def test_progress_counts_requests_of_all_threads(self):
+        # Three pages of HITs, the last two fetched by other threads
+        self.service = FakeMTurk(hits=250, assignments_per_hit=0)
+        Job.objects.enqueue(Job.POLL_ALL_HITS)
+        self.run_worker()
+        job = Job.objects.get()
+        self.assertEqual(self.service.requests['SearchHITs'], 3)
+        self.assertEqual(job.progress, u"3 requests made")
+        self.assertTrue(job.heartbeat >= job.started)
+
+    def test_stale_jobs_fail(self):
+        Job.objects.enqueue(Job.POLL_ALL_HITS)
+        Job.objects.enqueue(Job.POLL_REVIEWABLE_HITS)
+        stale, running = claim_job(), claim_job()
+        Job.objects.filter(pk=stale.pk).update(
+                heartbeat=datetime.datetime.utcnow() -
+                datetime.timedelta(seconds=DEFAULT_LEASE + 1))
+        self.assertEqual(fail_stale_jobs(), 1)
+        stale = Job.objects.get(pk=stale.pk)
+        self.assertEqual(stale.status, Job.FAILED)
+        self.assertTrue('stopped' in stale.error)
+        self.assertEqual(Job.objects.get(pk=running.pk).status, Job.RUNNING)
+
+    def test_stale_job_finishing(self):
+        Job.objects.enqueue(Job.POLL_ALL_HITS)
+        job = claim_job()
+        Job.objects.filter(pk=job.pk).update(
+                heartbeat=datetime.datetime.utcnow() -
+                datetime.timedelta(seconds=DEFAULT_LEASE + 1))
+        fail_stale_jobs()
+        # The worker wasn't dead after all: its outcome is left out
+        self.assertTrue(run_job(job))
+        job = Job.objects.get(pk=job.pk)
+        self.assertEqual((job.status, job.result), (Job.FAILED, None))
+        self.assertTrue('stopped' in job.error)
+
+
+class OutboxTests(TestCase):
+    def setUp(self):
+        self.service = FakeMTurk(hits=5, assignments_per_hit=2,
+                                 reviewable=0.4)
+        self.connection_pool = common.connection_pool
+        # The injected errors are retried by the connection without delay
+        common.connection_pool = ConnectionPool(
+                factory=lambda **kwargs: FakeMTurkConnection(
+                        host=FAKE_HOST, service=self.service,
+                        sleep=lambda seconds: None, **kwargs))
+        update_all_hits(do_update_assignments=True)
+        self.reviewable = HIT.objects.get(mturk_id=seeded_hit_id(0))
+
+    def tearDown(self):
+        common.connection_pool = self.connection_pool
+
+    def test_approve_and_bonus(self):
+        request = RequestFactory().post('/')
+        request.user = User(username='admin')
+        request._messages = CookieStorage(request)
+        assignments = self.reviewable.assignments.all()
+        model_admin = AssignmentAdmin(Assignment, admin.site)
+        approve_assignment(model_admin, request, assignments)
+        approve_assignment(model_admin, request, assignments)
+        self.assertEqual(Mutation.objects.count(), 2)
+        self.assertTrue('Queued 2 approval(s)' in
+                        [message.message for message in
+                         request._messages][0])
+        self.assertEqual(Job.objects.get().kind, Job.DISPATCH_MUTATIONS)
+        self.assertEqual(len(Mutation.objects.bonus(assignments, 0.5,
+                                                    key='week 1')), 2)
+        self.assertEqual(Mutation.objects.bonus(assignments, 0.5,
+                                                key='week 1'), [])
+        self.assertEqual(self.service.requests['ApproveAssignment'], 0)
+
+        # The worker sends them
+        call_command('djurk_worker', once=True, stdout=StringIO.StringIO())
+        self.assertEqual(json.loads(Job.objects.get().result)['confirmed'],
+                         4)
+        self.assertEqual(Mutation.objects.filter(
+                status=Mutation.DONE).count(), 4)
+        self.assertEqual(self.service.requests['ApproveAssignment'], 2)
+        self.assertEqual(len(self.service.bonuses), 2)
+        self.assertEqual(set(assignment.status for assignment in
+                             self.reviewable.assignments.all()),
+                         set([Assignment.APPROVED]))
+
+        # A bonus sent again, as after a crash, is not paid twice
+        Mutation.objects.filter(operation=Mutation.BONUS).update(
+                status=Mutation.PENDING)
+        counts = Dispatcher().dispatch()
+        self.assertEqual(counts['confirmed'], 2)
+        self.assertEqual(self.service.requests['GrantBonus'], 4)
+        self.assertEqual(len(self.service.bonuses), 2)
+
+    def test_retries(self):
+        assignment = self.reviewable.assignments.all()[0]
+        mutation = Mutation.objects.reject([assignment], "Blank")[0]
+        self.service.error_rate = 1
+        now = datetime.datetime.utcnow()
+        dispatcher = Dispatcher(max_attempts=2, clock=lambda: now)
+        self.assertEqual(dispatcher.dispatch()['retried'], 1)
+        mutation = Mutation.objects.get(pk=mutation.pk)
+        self.assertEqual((mutation.status, mutation.attempts),
+                         (Mutation.PENDING, 1))
+        self.assertTrue('500' in mutation.last_error)
+        self.assertEqual(dispatcher.dispatch()['retried'], 0)
+
+        now = mutation.next_attempt
+        self.assertEqual(dispatcher.dispatch()['failed'], 1)
+        self.assertEqual(Mutation.objects.get(pk=mutation.pk).status,
+                         Mutation.FAILED)
+
+        self.service.error_rate = 0
+        Mutation.objects.approve([assignment])
+        now = datetime.datetime.utcnow()
+        self.assertEqual(dispatcher.dispatch()['done'], 1)
+        self.assertEqual(Assignment.objects.get(pk=assignment.pk).status,
+                         Assignment.APPROVED)
+        # Mechanical Turk refuses to reject it now
+        Mutation.objects.reject([assignment])
+        now = datetime.datetime.utcnow()
+        self.assertEqual(dispatcher.dispatch()['failed'], 1)
+
+    def test_hit_mutations(self):
+        assignable = HIT.objects.get(mturk_id=seeded_hit_id(4))
+        Mutation.objects.expire([assignable])
+        Mutation.objects.extend([self.reviewable], assignments_increment=1)
+        Mutation.objects.extend([self.reviewable], assignments_increment=1)
+        reviewable = HIT.objects.get(mturk_id=seeded_hit_id(1))
+        Mutation.objects.set_reviewing([reviewable])
+        self.assertEqual(Mutation.objects.count(), 4)
+        output = StringIO.StringIO()
+        call_command('djurk_dispatch', once=True, stdout=output)
+        self.assertEqual(output.getvalue(), "4 mutations confirmed, 0 to "
+                                            "retry, 0 failed\n")
+        self.assertTrue(HIT.objects.get(pk=assignable.pk).next_poll_time)
+        self.assertEqual(HIT.objects.get(pk=reviewable.pk).status,
+                         HIT.REVIEWING)
+        self.assertEqual(self.service.requests['ExtendHIT'], 2)
+
+        # An extension sent again is not made twice
+        max_assignments = self.service._hits[seeded_hit_id(0)][
+                'MaxAssignments']
+        Mutation.objects.filter(operation=Mutation.EXTEND).update(
+                status=Mutation.PENDING)
+        self.assertEqual(Dispatcher().dispatch()['confirmed'], 2)
+        self.assertEqual(self.service.requests['ExtendHIT'], 4)
+        self.assertEqual(self.service._hits[seeded_hit_id(0)][
+                'MaxAssignments'], max_assignments)
+
+    def test_lost_response(self):
+        approved, rejected = self.reviewable.assignments.all()
+        connection = FakeMTurkConnection(host=FAKE_HOST,
+                                         service=self.service)
+        for assignment in (approved, rejected):
+            connection.approve_assignment(assignment.mturk_id)
+        # The approval was made by a first attempt whose response was
+        # lost; the rejection was never made
+        approval = Mutation.objects.approve([approved])[0]
+        rejection = Mutation.objects.reject([rejected])[0]
+        Mutation.objects.update(attempts=1)
+        counts = Dispatcher().dispatch()
+        self.assertEqual((counts['confirmed'], counts['failed']), (1, 1))
+        self.assertEqual(Mutation.objects.get(pk=approval.pk).status,
+                         Mutation.DONE)
+        self.assertEqual(Assignment.objects.get(pk=approved.pk).status,
+                         Assignment.APPROVED)
+        self.assertEqual(Mutation.objects.get(pk=rejection.pk).status,
+                         Mutation.FAILED)
+
+    def test_failed_mutations_are_sent_again(self):
+        assignment = self.reviewable.assignments.all()[0]
+        self.service.error_rate = 1
+        mutation = Mutation.objects.approve([assignment])[0]
+        Dispatcher(max_attempts=1).dispatch()
+        self.assertEqual(Mutation.objects.get(pk=mutation.pk).status,
+                         Mutation.FAILED)
+
+        self.service.error_rate = 0
+        self.assertEqual(Mutation.objects.approve([assignment]), [mutation])
+        mutation = Mutation.objects.get(pk=mutation.pk)
+        self.assertEqual((mutation.status, mutation.attempts),
+                         (Mutation.PENDING, 0))
+        self.assertEqual(Mutation.objects.approve([assignment]), [])
+        self.assertEqual(Dispatcher().dispatch()['done'], 1)
+        self.assertEqual(Mutation.objects.retry(Mutation.objects.all()), 0)
+
+    def test_retry_after_token_lifetime(self):
+        paid, unpaid = self.reviewable.assignments.all()
+        paid_bonus = Mutation.objects.bonus([paid], '0.50')[0]
+        Dispatcher().dispatch()
+        self.service.error_rate = 1
+        unpaid_bonus = Mutation.objects.bonus([unpaid], '0.50')[0]
+        extension = Mutation.objects.extend([self.reviewable],
+                                            assignments_increment=1)[0]
+        Dispatcher(max_attempts=1).dispatch()
+        self.service.error_rate = 0
+        self.assertEqual(len(self.service.bonuses), 1)
+        # As if the paid bonus's response was lost, two days ago
+        Mutation.objects.update(
+                status=Mutation.FAILED,
+                first_attempt=datetime.datetime.utcnow() -
+                datetime.timedelta(days=2))
+
+        self.assertEqual(Mutation.objects.retry(Mutation.objects.all()), 1)
+        self.assertEqual(Mutation.objects.get(pk=unpaid_bonus.pk).status,
+                         Mutation.PENDING)
+        for mutation in (paid_bonus, extension):
+            self.assertEqual(Mutation.objects.get(pk=mutation.pk).status,
+                             Mutation.FAILED)
+        self.assertEqual(Dispatcher().dispatch()['confirmed'], 1)
+        self.assertEqual(len(self.service.bonuses), 2)
+
+        # A recent failure is retried
+        Mutation.objects.filter(pk=extension.pk).update(
+                first_attempt=datetime.datetime.utcnow())
+        self.assertEqual(Mutation.objects.retry(Mutation.objects.all()), 1)
+
+    def test_lost_claim(self):
+        mutation = Mutation.objects.approve(
+                self.reviewable.assignments.all()[:1])[0]
+        dispatcher = Dispatcher()
+        send = dispatcher.send
+
+        def send_after_lease(mutation):
+            # Another dispatcher claims the mutation meanwhile
+            Mutation.objects.filter(pk=mutation.pk).update(claim='other')
+            return send(mutation)
+        dispatcher.send = send_after_lease
+        self.assertEqual(dispatcher.dispatch()['confirmed'], 0)
+        mutation = Mutation.objects.get(pk=mutation.pk)
+        self.assertEqual((mutation.status, mutation.claim),
+                         (Mutation.SENDING, 'other'))
+
+
+class BenchmarkTests(TransactionTestCase):
+    # query_plans creates indexes, which commits
+    def test_benchmark(self):
+        results = Benchmark(hits=20, assignments_per_hit=2, answer_fields=3,
+                            reviewable=0.25, sample=2).run()
+        self.assertEqual([result['scenario'] for result in results],
+                         list(SCENARIOS))
+        results = dict((result['scenario'], result) for result in results)
+        self.assertEqual(results['update_all_hits']['api_calls'], 1)
+        self.assertEqual(results['update_all_hits']['rows_written'], 20)
+        # Two HITs with two assignments with three answers each
+        self.assertEqual(results['answer_ingest']['rows_written'], 16)
+        self.assertEqual(results['dispose']['details'],
+                         {'hits': 2, 'approved': 4, 'failed': 0})
+        self.assertEqual(HIT.objects.filter(status=HIT.DISPOSED).count(), 2)
+        plans = results['query_plans']['details']
+        if connection.vendor == 'sqlite':
+            plan = plans['assignments_of_worker']
+            self.assertFalse('djurk_bench' in u' '.join(plan['before']))
+            self.assertTrue('djurk_bench_assignment_worker_id_submit_time'
+                            in u' '.join(plan['after']))
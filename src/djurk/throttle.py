@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Rate limiting of Mechanical Turk requests
+
+Every connection made by djurk.common.get_connection() is a
+ThrottledMTurkConnection. Before each request it takes a token from a
+TokenBucket shared by all connections of the process (and, if a lock
+file is configured, by all processes using that file). When Mechanical
+Turk reports that requests are being throttled, the bucket's rate is
+halved and the request is retried after a jittered delay; successful
+requests slowly restore the configured rate. Each attempt is reported
+with the djurk.signals.mturk_request signal.
+"""
+
+import httplib
+import random
+import socket
+import threading
+import time
+
+from boto.exception import BotoServerError
+from boto.mturk.connection import MTurkConnection
+
+from djurk.signals import mturk_request
+try:
+    import fcntl
+except ImportError:
+    # Sharing a bucket between processes is not available (Windows)
+    fcntl = None
+
+DEFAULT_RATE = 10.0  # requests per second
+DEFAULT_MAX_RETRIES = 5
+BACKOFF_BASE = 1.0  # seconds
+BACKOFF_CAP = 60.0
+# Fraction of the configured rate regained after each successful request
+RECOVERY_STEP = 0.05
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    """Return a random delay before retry number attempt (from 0)
+
+    The delay is drawn uniformly up to an exponentially growing bound,
+    so that clients throttled together do not retry together.
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def is_throttling_error(error):
+    """Return True if error means the request was throttled"""
+    if not isinstance(error, BotoServerError):
+        return False
+    body = error.body or ''
+    return (error.status == 503 or 'ServiceUnavailable' in body or
+            'Throttl' in body)
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket with an adaptive rate
+
+    Tokens accumulate at rate per second, up to burst. acquire() takes
+    a token, sleeping until it is available. throttled() halves the
+    rate (down to min_rate) and succeeded() raises it back towards the
+    configured rate.
+
+    If path is given, the bucket's state is kept in that file, under an
+    exclusive lock, so that every process using the same path shares
+    one bucket. Otherwise it is shared by the threads of this process.
+
+    The requests, throttles and wait_time (in seconds) counters, and the
+    current rate, describe the traffic of this process, to help tune
+    the number of concurrent workers.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, burst=None, path=None,
+                 min_rate=None, clock=time.time, sleep=time.sleep):
+        if path is not None and fcntl is None:
+            raise ValueError("Sharing a rate limit between processes "
+                             "requires fcntl")
+        self.max_rate = float(rate)
+        self.burst = float(burst or rate)
+        self.min_rate = float(min_rate or self.max_rate / 100)
+        self.path = path
+        self.clock = clock
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        self._state = (self.burst, clock(), self.max_rate)
+        self.requests = 0
+        self.throttles = 0
+        self.wait_time = 0.0
+
+    def _read_state(self, state_file):
+        state_file.seek(0)
+        try:
+            tokens, updated, rate = [float(value) for value in
+                                     state_file.read().split()]
+        except ValueError:
+            # A new (empty) file starts full
+            return (self.burst, self.clock(), self.max_rate)
+        return (tokens, updated, rate)
+
+    def _write_state(self, state_file, state):
+        state_file.seek(0)
+        state_file.truncate()
+        state_file.write('%r %r %r' % state)
+        state_file.flush()
+
+    def _update(self, function):
+        """Replace the state with function(state), returning its result
+
+        function returns a (new state, result) pair.
+        """
+        with self._lock:
+            if self.path is None:
+                self._state, result = function(self._state)
+                return result
+            with open(self.path, 'a+') as state_file:
+                fcntl.flock(state_file, fcntl.LOCK_EX)
+                try:
+                    state, result = function(self._read_state(state_file))
+                    self._write_state(state_file, state)
+                    self._state = state
+                finally:
+                    fcntl.flock(state_file, fcntl.LOCK_UN)
+                return result
+
+    def _take(self, state):
+        # The token is taken at once, leaving the bucket in debt if it
+        # was empty; the caller then waits until the debt is repaid.
+        tokens, updated, rate = state
+        now = self.clock()
+        tokens = min(self.burst, tokens + max(now - updated, 0) * rate) - 1
+        return (tokens, now, rate), max(-tokens / rate, 0)
+
+    def acquire(self):
+        """Take a token, waiting as long as needed
+
+        Returns the number of seconds waited.
+        """
+        wait = self._update(self._take)
+        if wait:
+            self.sleep(wait)
+        with self._lock:
+            self.requests += 1
+            self.wait_time += wait
+        return wait
+
+    def throttled(self):
+        """Halve the rate after Mechanical Turk throttled a request"""
+        def slow_down(state):
+            tokens, updated, rate = state
+            # Drop any remaining burst, so that the next requests wait
+            return (min(tokens, 0), updated, max(self.min_rate, rate / 2)),\
+                    None
+        self._update(slow_down)
+        with self._lock:
+            self.throttles += 1
+
+    def succeeded(self):
+        """Regain some of the configured rate after a request succeeded"""
+        if self.rate >= self.max_rate:
+            return
+
+        def speed_up(state):
+            tokens, updated, rate = state
+            rate = min(self.max_rate, rate + self.max_rate * RECOVERY_STEP)
+            return (tokens, updated, rate), None
+        self._update(speed_up)
+
+    @property
+    def rate(self):
+        """The current rate, in requests per second"""
+        return self._state[2]
+
+    def status(self):
+        """Return the current rate and the counters as a dictionary"""
+        with self._lock:
+            return {
+                'rate': self.rate,
+                'max_rate': self.max_rate,
+                'requests': self.requests,
+                'throttles': self.throttles,
+                'wait_time': self.wait_time,
+                'average_wait': self.wait_time / (self.requests or 1),
+            }
+
+
+class ThrottledMTurkConnection(MTurkConnection):
+    """An MTurkConnection whose requests go through a TokenBucket
+
+    Throttled requests, and requests that failed to reach Mechanical
+    Turk, are retried up to max_retries times with backoff_delay().
+    Boto's own retries are turned off, as they are not rate limited.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.rate_limiter = kwargs.pop('rate_limiter', None)
+        self.max_retries = kwargs.pop('max_retries', DEFAULT_MAX_RETRIES)
+        self.sleep = kwargs.pop('sleep', time.sleep)
+        MTurkConnection.__init__(self, *args, **kwargs)
+        self.num_retries = 0
+
+    def _timed_request(self, request_type, params, marker_elems):
+        """Make one attempt at a request, and report it"""
+        started = time.time()
+        try:
+            result = MTurkConnection._process_request(
+                    self, request_type, params, marker_elems)
+        except Exception as error:
+            mturk_request.send(sender=self.__class__, operation=request_type,
+                               duration=time.time() - started, error=error)
+            raise
+        mturk_request.send(sender=self.__class__, operation=request_type,
+                           duration=time.time() - started, error=None)
+        return result
+
+    def _process_request(self, request_type, params, marker_elems=None):
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            try:
+                result = self._timed_request(request_type, params,
+                                             marker_elems)
+            except (socket.error, httplib.HTTPException,
+                    BotoServerError) as error:
+                throttled = is_throttling_error(error)
+                if throttled and self.rate_limiter is not None:
+                    self.rate_limiter.throttled()
+                # Other errors reported by Mechanical Turk are final
+                retry = throttled or not isinstance(error, BotoServerError)
+                if not retry or attempt >= self.max_retries:
+                    raise
+                self.sleep(backoff_delay(attempt))
+                attempt += 1
+                continue
+            if self.rate_limiter is not None:
+                self.rate_limiter.succeeded()
+            return result
@@ -0,0 +1,8 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from django.conf.urls.defaults import patterns, url
+
+urlpatterns = patterns('djurk.views',
+    url(r'^metrics/$', 'metrics', name='djurk_metrics'),
+)
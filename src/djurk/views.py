@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Views of Djurk
+
+Include djurk.urls in the project's URLconf to serve them. They are not
+protected: restrict access to them in the web server if needed.
+"""
+
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Min
+from django.http import HttpResponse
+
+from djurk.metrics import (AGGREGATES_CACHE_KEY, CONTENT_TYPE,
+        DEFAULT_AGGREGATES_TIMEOUT, merge_snapshots, read_snapshots,
+        render_metrics, timestamp)
+from djurk.models import HIT, Assignment
+
+
+def database_aggregates():
+    """Return the counts and deadlines of the metrics, computing them
+    at most once every DJURK_METRICS_CACHE_TIMEOUT seconds (a Django
+    setting, 60 by default; no Mechanical Turk settings are needed)
+    """
+    aggregates = cache.get(AGGREGATES_CACHE_KEY)
+    if aggregates is not None:
+        return aggregates
+
+    statuses = dict(HIT.STATUS_CHOICES)
+    review_statuses = dict(HIT.REVIEW_CHOICES)
+    hits = {}
+    for row in HIT.objects.values('status', 'review_status').annotate(
+            count=Count('pk')).order_by():
+        key = (statuses.get(row['status'], u'Unknown'),
+               review_statuses.get(row['review_status'], u'Unknown'))
+        hits[key] = hits.get(key, 0) + row['count']
+
+    statuses = dict(Assignment.STATUS_CHOICES)
+    assignments = {}
+    for row in Assignment.objects.values('status').annotate(
+            count=Count('pk')).order_by():
+        status = statuses.get(row['status'], u'Unknown')
+        assignments[status] = assignments.get(status, 0) + row['count']
+
+    submitted = Assignment.objects.filter(
+            status=Assignment.SUBMITTED).aggregate(
+                    Min('submit_time'), Min('auto_approval_time'))
+    aggregates = {
+        'hits': hits,
+        'assignments': assignments,
+        'oldest_submit_time': timestamp(submitted['submit_time__min']),
+        'next_auto_approval_time': timestamp(
+                submitted['auto_approval_time__min']),
+        'computed': time.time(),
+    }
+    timeout = float(getattr(settings, 'DJURK_METRICS_CACHE_TIMEOUT',
+                            DEFAULT_AGGREGATES_TIMEOUT))
+    cache.set(AGGREGATES_CACHE_KEY, aggregates, timeout)
+    return aggregates
+
+
+def metrics(request):
+    """Serve the metrics of djurk.metrics, for Prometheus to scrape"""
+    return HttpResponse(render_metrics(database_aggregates(),
+                                       merge_snapshots(read_snapshots())),
+                        content_type=CONTENT_TYPE)
@@ -14,4 +14,7 @@ urlpatterns = patterns('',
 
     # Uncomment the next line to enable the admin:
     url(r'^admin/', include(admin.site.urls)),
+
+    # Djurk's metrics, for monitoring
+    url(r'^djurk/', include('djurk.urls')),
 )